@@ -0,0 +1,463 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+
+from cmake_one import Build
+
+# global options of cmake_one.py for each build mode, add more by --custom_mode
+MODES = {
+    "default": "",
+    "unity": "--unity_build",
+    "pch": "--pch",
+    "line_tables": "--debug_info line-tables",
+    "compiler_cache": "--compiler_cache",
+}
+
+# configure: cmake_one.py with a new build dir, ninja only check build.ninja
+# clean_build: build all and install after configure
+# noop_build: nothing changed
+# touch_source/touch_header: rebuild after touch one source or the most included header
+PHASES = ["configure", "clean_build", "noop_build", "touch_source", "touch_header"]
+REPEAT_PHASES = ["noop_build", "touch_source", "touch_header"]
+
+
+def write_if_changed(path: str, content: str):
+    # keep mtime of not changed files, so rerun the benchmark do not rebuild all
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            if f.read() == content:
+                return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def source_headers(target: int, index: int, files: int, headers: int, fan_in: int):
+    # deterministic, header 0 is included by every source
+    n = target * files + index
+    ret = [0] + [(n * 7 + k * 13) % headers for k in range(1, fan_in)]
+    return sorted(set(ret))
+
+
+def generate_project(
+    project_dir: str,
+    targets: int,
+    files: int,
+    headers: int,
+    fan_in: int,
+    template_weight: int,
+) -> dict:
+    """write a synthetic cmake project, return the files used by touch phases"""
+    fan_in = max(1, min(fan_in, headers))
+    for h in range(headers):
+        write_if_changed(
+            os.path.join(project_dir, "include", f"bench_h{h}.h"),
+            f"""#pragma once
+#include <algorithm>
+#include <map>
+#include <string>
+#include <vector>
+
+namespace bench {{
+template <typename T, int N>
+struct Sum{h} {{
+    static T run(const std::vector<T>& v) {{
+        return Sum{h}<T, N - 1>::run(v) + v[N % v.size()] * {h + 1};
+    }}
+}};
+template <typename T>
+struct Sum{h}<T, 0> {{
+    static T run(const std::vector<T>&) {{ return T(); }}
+}};
+inline std::string name_h{h}() {{ return "h{h}"; }}
+}}  // namespace bench
+""",
+        )
+
+    cmake = [
+        "cmake_minimum_required(VERSION 3.15...3.30)",
+        "",
+        "project(CmakeOneBenchmark LANGUAGES CXX)",
+        "",
+    ]
+    for t in range(targets):
+        srcs = []
+        for i in range(files):
+            src = f"lib{t}/src{i}.cpp"
+            srcs.append(src)
+            body = []
+            for h in source_headers(t, i, files, headers, fan_in):
+                for w in range(template_weight):
+                    body.append(f"    r += Sum{h}<long, {8 * (w + 1)}>::run(v);")
+                    body.append(f"    r += Sum{h}<double, {8 * (w + 1)}>::run(d);")
+                body.append(f"    r += static_cast<long>(name_h{h}().size());")
+            includes = "".join(
+                f'#include "bench_h{h}.h"\n'
+                for h in source_headers(t, i, files, headers, fan_in)
+            )
+            write_if_changed(
+                os.path.join(project_dir, src),
+                f"""{includes}
+namespace bench {{
+long t{t}_f{i}(long x) {{
+    std::vector<long> v(16, x);
+    std::vector<double> d(16, static_cast<double>(x));
+    long r = 0;
+{chr(10).join(body)}
+    return r;
+}}
+}}  // namespace bench
+""",
+            )
+        cmake.append(f"add_library(lib{t} STATIC {' '.join(srcs)})")
+        cmake.append(
+            f"target_include_directories(lib{t} PUBLIC ${{CMAKE_CURRENT_SOURCE_DIR}}/include)"
+        )
+        cmake.append("")
+
+    decls = "".join(f"long t{t}_f0(long x);\n" for t in range(targets))
+    calls = "".join(f"    r += bench::t{t}_f0(argc);\n" for t in range(targets))
+    write_if_changed(
+        os.path.join(project_dir, "main.cpp"),
+        f"""#include <cstdio>
+
+namespace bench {{
+{decls}}}  // namespace bench
+
+int main(int argc, char**) {{
+    long r = 0;
+{calls}    std::printf("%ld\\n", r);
+    return 0;
+}}
+""",
+    )
+    cmake.append("add_executable(bench_main main.cpp)")
+    cmake.append(
+        f"target_link_libraries(bench_main PRIVATE {' '.join(f'lib{t}' for t in range(targets))})"
+    )
+    cmake.append("install(TARGETS bench_main DESTINATION bin)")
+    write_if_changed(
+        os.path.join(project_dir, "CMakeLists.txt"), "\n".join(cmake) + "\n"
+    )
+    return {
+        "touch_source": os.path.join(project_dir, f"lib{targets // 2}", "src0.cpp"),
+        "touch_header": os.path.join(project_dir, "include", "bench_h0.h"),
+    }
+
+
+def target_args(target: str) -> list:
+    """cmake_one.py sub command and options of a matrix target string"""
+    b = Build()
+    b.detect_build_env()
+    ret = []
+    for name, (sub_command, options) in b.parse_matrix_targets([target]):
+        args = [sub_command]
+        for k, v in options.items():
+            args += [f"--{k}"] if v is True else [f"--{k}", v]
+        ret.append((name, args))
+    return ret
+
+
+def tool_versions() -> dict:
+    ret = {}
+    for tool in ["cmake", "ninja"]:
+        try:
+            out = subprocess.check_output([tool, "--version"], text=True)
+            ret[tool] = out.splitlines()[0]
+        except (OSError, subprocess.CalledProcessError):
+            ret[tool] = None
+    try:
+        ret["cmake_one"] = subprocess.check_output(
+            [
+                "git",
+                "-C",
+                os.path.dirname(os.path.abspath(__file__)),
+                "describe",
+                "--always",
+                "--dirty",
+            ],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        ret["cmake_one"] = None
+    return ret
+
+
+def run_phase(cmd: list, log_file: str) -> float:
+    """return the wall time, raise subprocess.CalledProcessError if failed"""
+    logging.debug(f"run: {shlex.join(cmd)}, log: {log_file}")
+    with open(log_file, "w") as f:
+        time_s = time.perf_counter()
+        ret = subprocess.run(cmd, stdout=f, stderr=subprocess.STDOUT).returncode
+        cost = time.perf_counter() - time_s
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+    return cost
+
+
+def run_benchmark(args, modes: dict, touch_files: dict) -> list:
+    results = []
+    log_dir = os.path.join(args.work_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    for target in args.targets.split():
+        for name, sub_command_args in target_args(target):
+            for mode, mode_options in modes.items():
+                build_dir = os.path.join(args.work_dir, f"build-{name}-{mode}")
+                base = (
+                    shlex.split(args.cmake_one_cmd)
+                    + shlex.split(mode_options)
+                    + shlex.split(args.extra_options or "")
+                    + [
+                        "--repo_dir",
+                        args.project_dir,
+                        "--build_dir",
+                        build_dir,
+                        "--not_do_link_build_and_install",
+                    ]
+                )
+                result = {"target": name, "mode": mode, "status": "success"}
+                result["phases"] = {}
+                for phase in PHASES:
+                    cmd = list(base)
+                    if phase == "configure":
+                        # build.ninja is up to date after configure, so ninja do nothing
+                        cmd += ["--remove_old_build", "--ninja_target", "build.ninja"]
+                    cmd += sub_command_args
+                    times = []
+                    log_file = os.path.join(log_dir, f"{name}-{mode}-{phase}.log")
+                    try:
+                        for _ in range(args.repeat if phase in REPEAT_PHASES else 1):
+                            if phase in touch_files:
+                                os.utime(touch_files[phase])
+                            times.append(run_phase(cmd, log_file))
+                    except subprocess.CalledProcessError:
+                        # configure failed as the toolchain of target is not in this env
+                        result["status"] = (
+                            "unavailable" if phase == "configure" else "failed"
+                        )
+                        result["log"] = log_file
+                        logging.error(
+                            f"{name} {mode} {phase}: {result['status']}, log: {log_file}"
+                        )
+                        break
+                    result["phases"][phase] = {
+                        "times": times,
+                        "median": statistics.median(times),
+                    }
+                    logging.info(
+                        f"{name} {mode} {phase}: {statistics.median(times):.3f}s"
+                    )
+                results.append(result)
+    return results
+
+
+def compare_baseline(
+    results: list, baseline_file: str, threshold: float, noise: float
+) -> list:
+    """return the phases slower than baseline by threshold ratio and noise seconds"""
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    old = {}
+    for r in baseline["results"]:
+        for phase, v in r["phases"].items():
+            old[(r["target"], r["mode"], phase)] = v["median"]
+    regressions = []
+    for r in results:
+        for phase, v in r["phases"].items():
+            key = (r["target"], r["mode"], phase)
+            if key not in old:
+                continue
+            if (
+                v["median"] > old[key] * (1 + threshold)
+                and v["median"] - old[key] > noise
+            ):
+                regressions.append(
+                    {
+                        "target": r["target"],
+                        "mode": r["mode"],
+                        "phase": phase,
+                        "baseline": old[key],
+                        "median": v["median"],
+                    }
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    LOG_FORMAT = "[benchmark] - %(asctime)s - %(levelname)s - %(message)s"
+    DATE_FORMAT = "%Y/%m/%d %H:%M:%S"
+    logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT, datefmt=DATE_FORMAT)
+    parser = argparse.ArgumentParser(
+        description="time cmake_one.py build modes on a synthetic cmake project"
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default=os.path.join("/tmp", "cmake_one_benchmark"),
+        help="dir of the generated project, build dirs and logs, default is /tmp/cmake_one_benchmark",
+    )
+    parser.add_argument(
+        "--num_targets",
+        type=int,
+        default=8,
+        help="number of static libraries, default is 8",
+    )
+    parser.add_argument(
+        "--files_per_target",
+        type=int,
+        default=20,
+        help="number of sources of each library, default is 20",
+    )
+    parser.add_argument(
+        "--num_headers",
+        type=int,
+        default=20,
+        help="number of shared headers, default is 20",
+    )
+    parser.add_argument(
+        "--header_fan_in",
+        type=int,
+        default=5,
+        help="number of headers included by each source, default is 5",
+    )
+    parser.add_argument(
+        "--template_weight",
+        type=int,
+        default=2,
+        help="template instantiations of each included header in each source, 0 for no templates, default is 2",
+    )
+    parser.add_argument(
+        "--targets",
+        type=str,
+        default="host",
+        help='matrix targets split by space, like "host ANDROID-aarch64" or "all", targets without toolchain are recorded as unavailable, default is host',
+    )
+    parser.add_argument(
+        "--modes",
+        type=str,
+        default="default",
+        help=f"build modes split by space, one of {list(MODES.keys())} or name of --custom_mode, default is default",
+    )
+    parser.add_argument(
+        "--custom_mode",
+        type=str,
+        action="append",
+        default=[],
+        help='more build mode like "name=cmake_one.py global options", for example: "lld=--linker lld", can be used many times, default is None',
+    )
+    parser.add_argument(
+        "--extra_options",
+        type=str,
+        default=None,
+        help="cmake_one.py global options for all modes, default is None",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help=f"run times of {REPEAT_PHASES}, the median is used, default is 3",
+    )
+    parser.add_argument(
+        "--cmake_one_cmd",
+        type=str,
+        default=f"{sys.executable} {os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cmake_one.py')}",
+        help="command to run cmake_one, for example python3 run_in_docker.py to benchmark in docker(work_dir should be mounted, like /tmp), default is cmake_one.py by this python",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="result json, default is benchmark.json in work_dir",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="result json of last run, exit with 1 if any phase is slower than it, default is None",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="slower ratio to baseline treated as regression, default is 0.1",
+    )
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=0.05,
+        help="slower seconds to baseline less than this are ignored, default is 0.05",
+    )
+    args = parser.parse_args()
+    args.work_dir = os.path.abspath(args.work_dir)
+    args.project_dir = os.path.join(args.work_dir, "project")
+
+    modes = dict(MODES)
+    for custom in args.custom_mode:
+        assert (
+            "=" in custom
+        ), f"error config --custom_mode {custom}, format should be name=options"
+        name, options = custom.split("=", 1)
+        modes[name] = options
+    for mode in args.modes.split():
+        assert (
+            mode in modes
+        ), f"error config --modes: {mode}, now support one of: {list(modes.keys())}"
+    modes = {mode: modes[mode] for mode in args.modes.split()}
+
+    params = {
+        "num_targets": args.num_targets,
+        "files_per_target": args.files_per_target,
+        "num_headers": args.num_headers,
+        "header_fan_in": args.header_fan_in,
+        "template_weight": args.template_weight,
+    }
+    logging.info(f"generate project: {args.project_dir}, {params}")
+    touch_files = generate_project(
+        args.project_dir,
+        args.num_targets,
+        args.files_per_target,
+        args.num_headers,
+        args.header_fan_in,
+        args.template_weight,
+    )
+    results = run_benchmark(args, modes, touch_files)
+    report = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": {
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            **tool_versions(),
+        },
+        "project": params,
+        "modes": modes,
+        "extra_options": args.extra_options,
+        "cmake_one_cmd": args.cmake_one_cmd,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    regressions = []
+    if args.baseline:
+        regressions = compare_baseline(
+            results, args.baseline, args.threshold, args.noise
+        )
+        for r in regressions:
+            logging.warning(
+                f"regression: {r['target']} {r['mode']} {r['phase']}: {r['baseline']:.3f}s -> {r['median']:.3f}s"
+            )
+        report["baseline"] = os.path.abspath(args.baseline)
+        report["regressions"] = regressions
+    output = args.output or os.path.join(args.work_dir, "benchmark.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"benchmark result json: {output}")
+    if regressions:
+        sys.exit(1)
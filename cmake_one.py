@@ -1,19 +1,2873 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import ctypes
+import ctypes.util
+import errno
+import filecmp
+import glob
+import hashlib
+import hmac
+import json
 import logging
 import os
 import platform
+import random
+import re
+import select
+import shlex
 import shutil
+import signal
+import socket
+import socketserver
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+try:
+    import pty
+    import termios
+except ImportError:
+    # Windows
+    pty = None
+
 
 class CODE_NOT_IMP(Exception):
     pass
 
 
+class CompileDatabase:
+    """rewrite and merge compile_commands.json of build dirs to one file
+
+    all path remaps are applied in one regex pass, entries of later build dirs are only
+    added when the file is not in former build dirs, entries are read and written one by
+    one, so a huge database is never loaded as a whole, the output is written atomically
+    and only when the content changed, so clangd will not reindex for nothing
+    """
+
+    FILE_NAME = "compile_commands.json"
+    CHUNK_SIZE = 1 << 20
+    SEPARATOR_RE = re.compile(r"[\s,]*")
+
+    def __init__(self, remaps=None):
+        # longest first, so a path is not replaced by the remap of its prefix
+        self.remaps = dict(sorted((remaps or {}).items(), key=lambda i: -len(i[0])))
+        self.pattern = None
+        if self.remaps:
+            self.pattern = re.compile("|".join(re.escape(k) for k in self.remaps))
+
+    def remap(self, value):
+        if self.pattern is None:
+            return value
+        if isinstance(value, list):
+            return [self.remap(v) for v in value]
+        if isinstance(value, str):
+            return self.pattern.sub(lambda m: self.remaps[m.group(0)], value)
+        return value
+
+    @classmethod
+    def db_file(cls, path):
+        if os.path.isdir(path):
+            return os.path.join(path, cls.FILE_NAME)
+        return path
+
+    def load(self, path):
+        path = self.db_file(path)
+        assert os.path.isfile(path), f"can not find compile database: {path}"
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def iter_entries(self, path):
+        """yield the entries of a compile database one by one, read by chunks"""
+        decoder = json.JSONDecoder()
+        buf = ""
+        pos = 0
+        started = False
+        with open(path, "r") as f:
+            while True:
+                pos = self.SEPARATOR_RE.match(buf, pos).end()
+                if pos < len(buf):
+                    if not started:
+                        assert (
+                            buf[pos] == "["
+                        ), f"compile database is not a json array: {path}"
+                        started = True
+                        pos += 1
+                        continue
+                    if buf[pos] == "]":
+                        return
+                    try:
+                        entry, pos = decoder.raw_decode(buf, pos)
+                        yield entry
+                        continue
+                    except ValueError:
+                        # the entry is not read completely
+                        pass
+                chunk = f.read(self.CHUNK_SIZE)
+                assert chunk, f"compile database is truncated or invalid: {path}"
+                buf = buf[pos:] + chunk
+                pos = 0
+
+    def write(self, build_dirs, output):
+        """return True if output changed, build dirs without compile database are skipped"""
+        output = os.path.abspath(output)
+        tmp = f"{output}.{os.getpid()}.{threading.get_ident()}.tmp"
+        count = 0
+        seen = set()
+        with open(tmp, "w") as f:
+            f.write("[")
+            for build_dir in build_dirs:
+                path = self.db_file(build_dir)
+                if not os.path.isfile(path):
+                    # like a build dir to merge which is not configured yet
+                    logging.warning(f"can not find compile database: {path}, skip it")
+                    continue
+                files = set()
+                for entry in self.iter_entries(path):
+                    entry = {k: self.remap(v) for k, v in entry.items()}
+                    file = os.path.normpath(
+                        os.path.join(entry.get("directory", ""), entry.get("file", ""))
+                    )
+                    if file in seen:
+                        continue
+                    files.add(file)
+                    f.write(",\n" if count else "\n")
+                    f.write(json.dumps(entry, indent=2))
+                    count += 1
+                seen |= files
+            f.write("\n]\n")
+        if os.path.isfile(output) and filecmp.cmp(tmp, output, shallow=False):
+            os.remove(tmp)
+            logging.debug(f"{output} not changed, skip write")
+            return False
+        # replace is atomic, clangd and other builds will never see a half written file
+        os.replace(tmp, output)
+        logging.debug(f"write {count} entries from {build_dirs} to {output}")
+        return True
+
+
+class BuildReport:
+    """build profile from .ninja_log of the last build, with ninja -t graph to find the critical path"""
+
+    COMPILE_EXTS = (".o", ".obj")
+    LINK_EXTS = (".so", ".a", ".dll", ".lib", ".exe", ".dylib")
+    PARALLELISM_BUCKETS = 20
+    MAX_EXTRA_GRAPH_TARGETS = 100
+
+    def __init__(self, build_dir, ninja="ninja"):
+        self.build_dir = build_dir
+        self.ninja = ninja
+        # list of [start_ms, end_ms, outputs]
+        self.edges = []
+        # output -> rule
+        self.rules = {}
+        # output -> inputs
+        self.inputs = {}
+
+    def parse_ninja_log(self):
+        ninja_log = os.path.join(self.build_dir, ".ninja_log")
+        assert os.path.isfile(
+            ninja_log
+        ), f"can not find {ninja_log}, please build with ninja first"
+        with open(ninja_log, "r") as f:
+            header = f.readline().strip()
+            assert header.startswith(
+                "# ninja log v"
+            ), f"error ninja log: {ninja_log}, header: {header}"
+            version = int(header[len("# ninja log v") :])
+            assert (
+                version >= 5
+            ), f"do not support ninja log version: {version}, please update ninja"
+            edges = {}
+            last_end = 0
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 5:
+                    continue
+                start, end, _, output, cmd_hash = parts
+                start, end = int(start), int(end)
+                # ninja append to the log, a smaller end time means a new build started
+                if end < last_end:
+                    edges = {}
+                last_end = end
+                # outputs of one edge have the same command hash and time
+                key = (start, end, cmd_hash)
+                if key not in edges:
+                    edges[key] = [start, end, []]
+                edges[key][2].append(output)
+        self.edges = sorted(edges.values(), key=lambda e: e[0])
+        logging.debug(f"parse {len(self.edges)} edges from {ninja_log}")
+
+    def parse_ninja_graph(self, targets=None):
+        try:
+            graph = subprocess.check_output(
+                [self.ninja, "-t", "graph", *(targets or [])],
+                cwd=self.build_dir,
+                stderr=subprocess.DEVNULL,
+            ).decode(errors="replace")
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(
+                f"can not get build graph by {self.ninja} -t graph: {e}, report will not have critical path"
+            )
+            return False
+        labels = {}
+        edge_nodes = {}
+        edge_outputs = {}
+        edge_inputs = {}
+        node_re = re.compile(r'^"(\w+)" \[label="(.*?)"(, shape=ellipse)?\]$')
+        link_re = re.compile(r'^"(\w+)" -> "(\w+)"(?: \[(.*)\])?$')
+        for line in graph.splitlines():
+            m = node_re.match(line)
+            if m:
+                labels[m.group(1)] = m.group(2)
+                if m.group(3):
+                    edge_nodes[m.group(1)] = m.group(2)
+                continue
+            m = link_re.match(line)
+            if not m:
+                continue
+            src, dst, attrs = m.group(1), m.group(2), m.group(3) or ""
+            if src in edge_nodes or "arrowhead=none" in attrs:
+                if "arrowhead=none" in attrs:
+                    edge_inputs.setdefault(dst, []).append(src)
+                else:
+                    edge_outputs.setdefault(src, []).append(dst)
+            else:
+                # one input and one output edge: "input" -> "output" [label=" rule"]
+                rule = attrs.replace('label="', "").rstrip('"').strip()
+                edge = f"{src}->{dst}"
+                edge_nodes[edge] = rule
+                edge_outputs[edge] = [dst]
+                edge_inputs[edge] = [src]
+        for edge, rule in edge_nodes.items():
+            for output in edge_outputs.get(edge, []):
+                output = labels.get(output, output)
+                self.rules[output] = rule
+                self.inputs[output] = [
+                    labels.get(i, i) for i in edge_inputs.get(edge, [])
+                ]
+        if not targets:
+            # ninja -t graph only show default targets, outputs like install/strip need ask for them
+            missing = [e[2][0] for e in self.edges if e[2][0] not in self.rules]
+            if missing and len(missing) <= self.MAX_EXTRA_GRAPH_TARGETS:
+                return self.parse_ninja_graph(missing)
+        return True
+
+    def kind(self, output):
+        rule = self.rules.get(output, "")
+        if "COMPILER" in rule:
+            return "compile"
+        if "LINKER" in rule:
+            return "link"
+        if output.endswith(self.COMPILE_EXTS):
+            return "compile"
+        if output.endswith(self.LINK_EXTS):
+            return "link"
+        return "other"
+
+    def critical_path(self):
+        """longest duration chain of the edges run in the last build"""
+        duration = {}
+        for start, end, outputs in self.edges:
+            for output in outputs:
+                duration[output] = end - start
+        # cost[node] = (path cost, prev node of path), iterative dfs as the graph can be very deep
+        cost = {}
+        for root in duration:
+            stack = [(root, False)]
+            while stack:
+                node, expanded = stack.pop()
+                if node in cost:
+                    continue
+                inputs = self.inputs.get(node, [])
+                if not expanded:
+                    stack.append((node, True))
+                    stack += [(i, False) for i in inputs if i not in cost]
+                    continue
+                best = (0, None)
+                for i in inputs:
+                    if cost[i][0] > best[0]:
+                        best = (cost[i][0], i)
+                cost[node] = (best[0] + duration.get(node, 0), best[1])
+        if not cost:
+            return []
+        node = max(duration, key=lambda o: cost[o][0])
+        path = []
+        while node is not None:
+            if node in duration:
+                path.append(node)
+            node = cost[node][1]
+        return list(reversed(path))
+
+    def parallelism(self, wall_ms):
+        bucket_ms = max(wall_ms / self.PARALLELISM_BUCKETS, 1)
+        buckets = [0.0] * self.PARALLELISM_BUCKETS
+        for start, end, _ in self.edges:
+            for i in range(self.PARALLELISM_BUCKETS):
+                b_s = i * bucket_ms
+                b_e = b_s + bucket_ms
+                overlap = min(end, b_e) - max(start, b_s)
+                if overlap > 0:
+                    buckets[i] += overlap
+        return [
+            {
+                "start_s": round(i * bucket_ms / 1000, 3),
+                "end_s": round((i + 1) * bucket_ms / 1000, 3),
+                "avg_jobs": round(b / bucket_ms, 2),
+            }
+            for i, b in enumerate(buckets)
+        ]
+
+    def generate(self, top=10):
+        self.parse_ninja_log()
+        has_graph = self.parse_ninja_graph()
+        if not self.edges:
+            return {"build_dir": self.build_dir, "edges": 0}
+        wall_ms = max(e[1] for e in self.edges) - min(e[0] for e in self.edges)
+        total_ms = sum(e[1] - e[0] for e in self.edges)
+        steps = [
+            {"output": e[2][0], "kind": self.kind(e[2][0]), "ms": e[1] - e[0]}
+            for e in self.edges
+        ]
+        steps.sort(key=lambda s: s["ms"], reverse=True)
+        durations = {o: e[1] - e[0] for e in self.edges for o in e[2]}
+        critical_path = self.critical_path() if has_graph else []
+        return {
+            "build_dir": self.build_dir,
+            "edges": len(self.edges),
+            "wall_s": round(wall_ms / 1000, 3),
+            "sum_of_edges_s": round(total_ms / 1000, 3),
+            "avg_parallelism": round(total_ms / max(wall_ms, 1), 2),
+            "compile_s": round(
+                sum(s["ms"] for s in steps if s["kind"] == "compile") / 1000, 3
+            ),
+            "link_s": round(
+                sum(s["ms"] for s in steps if s["kind"] == "link") / 1000, 3
+            ),
+            "slowest_compile": [s for s in steps if s["kind"] == "compile"][:top],
+            "slowest_link": [s for s in steps if s["kind"] == "link"][:top],
+            "slowest_other": [s for s in steps if s["kind"] == "other"][:top],
+            "parallelism": self.parallelism(wall_ms),
+            "critical_path_s": round(
+                sum(durations[o] for o in critical_path) / 1000, 3
+            ),
+            "critical_path": [{"output": o, "ms": durations[o]} for o in critical_path],
+        }
+
+    @staticmethod
+    def format_text(report):
+        lines = [f"build report of: {report['build_dir']}"]
+        if not report["edges"]:
+            lines.append("    no build step found in the last build")
+            return "\n".join(lines)
+        lines.append(
+            f"    steps: {report['edges']} wall: {report['wall_s']}s sum of steps: {report['sum_of_edges_s']}s avg parallelism: {report['avg_parallelism']}"
+        )
+        lines.append(
+            f"    compile: {report['compile_s']}s link: {report['link_s']}s critical path: {report['critical_path_s']}s"
+        )
+        for title, key in [
+            ("slowest compile", "slowest_compile"),
+            ("slowest link", "slowest_link"),
+            ("slowest other", "slowest_other"),
+        ]:
+            if not report[key]:
+                continue
+            lines.append(f"    {title}:")
+            lines += [
+                f"        {s['ms'] / 1000:>8.3f}s {s['output']}" for s in report[key]
+            ]
+        lines.append("    parallelism over time:")
+        for p in report["parallelism"]:
+            bar = "#" * int(round(p["avg_jobs"]))
+            lines.append(
+                f"        {p['start_s']:>8.2f}s-{p['end_s']:>8.2f}s {p['avg_jobs']:>6.2f} {bar}"
+            )
+        if report["critical_path"]:
+            lines.append("    critical path:")
+            lines += [
+                f"        {p['ms'] / 1000:>8.3f}s {p['output']}"
+                for p in report["critical_path"]
+            ]
+        return "\n".join(lines)
+
+
+class TimeTrace:
+    """aggregate clang -ftime-trace output of all objects in build_dir
+
+    clang write <object without ext>.json next to each object, times of headers and
+    templates are inclusive, nested ones are counted in their parents too, the same
+    as how clang report them
+    """
+
+    REPORT_FILE = "cmake_one_time_trace.json"
+    TEMPLATE_EVENTS = ("InstantiateClass", "InstantiateFunction")
+
+    def __init__(self, build_dir):
+        self.build_dir = build_dir
+
+    def trace_files(self):
+        """return ([(source, trace file)], count of objects without a valid trace)"""
+        compile_db = os.path.join(self.build_dir, CompileDatabase.FILE_NAME)
+        assert os.path.isfile(
+            compile_db
+        ), f"can not find {compile_db}, please build with cmake_one first"
+        with open(compile_db, "r") as f:
+            entries = json.load(f)
+        traces = []
+        missing = 0
+        for entry in entries:
+            args = PrecompiledHeader.command_args(entry)
+            output = PrecompiledHeader.output_of(entry, args)
+            if not output:
+                continue
+            output = os.path.join(entry["directory"], output)
+            trace = os.path.splitext(output)[0] + ".json"
+            # a trace older than its object is left by a build before
+            if not os.path.isfile(trace) or (
+                os.path.isfile(output)
+                and os.path.getmtime(trace) < os.path.getmtime(output)
+            ):
+                missing += 1
+                continue
+            traces.append((entry["file"], trace))
+        return traces, missing
+
+    @classmethod
+    def parse(cls, trace):
+        """return (total us, {phase: [us, count]}, {header: us}, {template: us}) of one trace"""
+        with open(trace, "r") as f:
+            events = json.load(f).get("traceEvents", [])
+        total = 0
+        phases = {}
+        headers = {}
+        templates = {}
+        for e in events:
+            if e.get("ph") != "X":
+                continue
+            name = e.get("name", "")
+            dur = e.get("dur", 0)
+            detail = e.get("args", {}).get("detail")
+            if name.startswith("Total "):
+                phases[name[len("Total ") :]] = [dur, e.get("args", {}).get("count", 1)]
+            elif name == "ExecuteCompiler":
+                total = max(total, dur)
+            elif name == "Source" and detail:
+                headers[detail] = headers.get(detail, 0) + dur
+            elif name in cls.TEMPLATE_EVENTS and detail:
+                templates[detail] = templates.get(detail, 0) + dur
+        total = max(total, phases.get("ExecuteCompiler", [0])[0])
+        return total, phases, headers, templates
+
+    @staticmethod
+    def ranked(items, top):
+        """items: {name: [us, count]}, return the top N with the most time"""
+        ranked = sorted(items.items(), key=lambda i: i[1][0], reverse=True)[:top]
+        return [
+            {
+                "name": name,
+                "s": round(us / 1e6, 3),
+                "count": count,
+                "avg_ms": round(us / 1e3 / max(count, 1), 1),
+            }
+            for name, (us, count) in ranked
+        ]
+
+    def generate(self, top=10):
+        traces, missing = self.trace_files()
+        units = []
+        phases = {}
+        # name -> [us, count of TU]
+        headers = {}
+        templates = {}
+        template_sets = {}
+        with concurrent.futures.ProcessPoolExecutor() as pool:
+            results = pool.map(
+                self.parse, [t for _, t in traces], chunksize=max(len(traces) // 64, 1)
+            )
+            for (source, _), (total, tu_phases, tu_headers, tu_templates) in zip(
+                traces, results
+            ):
+                units.append({"source": source, "s": round(total / 1e6, 3)})
+                for name, (us, count) in tu_phases.items():
+                    p = phases.setdefault(name, [0, 0])
+                    p[0] += us
+                    p[1] += count
+                for items, tu_items in [
+                    (headers, tu_headers),
+                    (templates, tu_templates),
+                ]:
+                    for name, us in tu_items.items():
+                        i = items.setdefault(name, [0, 0])
+                        i[0] += us
+                        i[1] += 1
+                # all specializations of one template, std::vector<int> -> std::vector
+                for name, us in tu_templates.items():
+                    i = template_sets.setdefault(name.split("<")[0], [0, 0])
+                    i[0] += us
+                    i[1] += 1
+        units.sort(key=lambda u: u["s"], reverse=True)
+        return {
+            "build_dir": self.build_dir,
+            "traces": len(traces),
+            "missing": missing,
+            "compile_s": round(sum(u["s"] for u in units), 3),
+            "phases": self.ranked(phases, len(phases)),
+            "slowest_units": units[:top],
+            "headers": self.ranked(headers, top),
+            "templates": self.ranked(templates, top),
+            "template_sets": self.ranked(template_sets, top),
+        }
+
+    @staticmethod
+    def format_text(report):
+        lines = [f"time trace report of: {report['build_dir']}"]
+        if not report["traces"]:
+            lines.append(
+                "    no time trace found, please build with --time_trace by clang"
+            )
+            return "\n".join(lines)
+        lines.append(
+            f"    traces: {report['traces']} missing: {report['missing']} compile: {report['compile_s']}s"
+        )
+        if report["phases"]:
+            lines.append("    phases:")
+            lines += [
+                f"        {p['s']:>10.3f}s {p['count']:>8} {p['name']}"
+                for p in report["phases"]
+            ]
+        if report["slowest_units"]:
+            lines.append("    slowest units:")
+            lines += [
+                f"        {u['s']:>10.3f}s {u['source']}"
+                for u in report["slowest_units"]
+            ]
+        for title, key in [
+            ("expensive headers", "headers"),
+            ("expensive template instantiations", "templates"),
+            ("expensive templates of all specializations", "template_sets"),
+        ]:
+            if not report[key]:
+                continue
+            lines.append(f"    {title} (total, units, avg per unit):")
+            lines += [
+                f"        {i['s']:>10.3f}s {i['count']:>8} {i['avg_ms']:>10.1f}ms {i['name']}"
+                for i in report[key]
+            ]
+        return "\n".join(lines)
+
+
+class PrecompiledHeader:
+    """precompiled headers of the hot system and third party headers of each target
+
+    headers are counted from the top level angle bracket includes of the sources in
+    compile_commands.json, includes under #if are skipped as they may not exist for the
+    toolchain, headers found in repo_dir or build_dir change often so they are skipped
+    too, unless they are under a third party dir
+    """
+
+    CMAKE_FILE = "cmake_one_pch.cmake"
+    THIRD_PARTY_DIRS = ("third_party", "thirdparty", "3rdparty", "external", "extern")
+    SOURCE_LANGS = {
+        ".c": "C",
+        ".cc": "CXX",
+        ".cp": "CXX",
+        ".cpp": "CXX",
+        ".cxx": "CXX",
+        ".c++": "CXX",
+    }
+    INCLUDE_DIR_FLAGS = ("-I", "-isystem", "/I", "-imsvc", "/imsvc")
+    INCLUDE_RE = re.compile(r"^\s*#\s*include\s*<([^>]+)>")
+    IF_RE = re.compile(r"^\s*#\s*if")
+    ENDIF_RE = re.compile(r"^\s*#\s*endif")
+    PCH_HEADER_RE = re.compile(r"(\S*cmake_pch\.h(?:xx)?)\b")
+
+    def __init__(self, build_dir, repo_dir, max_headers=32, min_ratio=0.5):
+        self.build_dir = os.path.realpath(build_dir)
+        self.repo_dir = os.path.realpath(repo_dir)
+        self.max_headers = max_headers
+        self.min_ratio = min_ratio
+        self.cmake_file = os.path.join(self.build_dir, self.CMAKE_FILE)
+
+    @staticmethod
+    def command_args(entry):
+        if "arguments" in entry:
+            return entry["arguments"]
+        return shlex.split(entry["command"])
+
+    @staticmethod
+    def output_of(entry, args):
+        if "output" in entry:
+            return entry["output"]
+        for i, arg in enumerate(args):
+            if arg == "-o" and i + 1 < len(args):
+                return args[i + 1]
+            if arg.startswith("/Fo") or arg.startswith("-Fo"):
+                return arg[3:]
+        return None
+
+    @staticmethod
+    def target_of(output):
+        # CMake write objects to CMakeFiles/<target>.dir/
+        for part in reversed(re.split(r"[\\/]", output or "")):
+            if part.endswith(".dir"):
+                return part[: -len(".dir")]
+        return None
+
+    def include_dirs(self, entry, args):
+        dirs = []
+        for i, arg in enumerate(args):
+            for flag in self.INCLUDE_DIR_FLAGS:
+                if arg == flag and i + 1 < len(args):
+                    path = args[i + 1]
+                elif arg.startswith(flag) and len(arg) > len(flag):
+                    path = arg[len(flag) :]
+                else:
+                    continue
+                dirs.append(os.path.join(entry["directory"], path))
+                break
+        return dirs
+
+    def is_project_header(self, header, include_dirs):
+        for d in include_dirs:
+            path = os.path.realpath(os.path.join(d, header))
+            if not os.path.isfile(path):
+                continue
+            for root in [self.build_dir, self.repo_dir]:
+                if path.startswith(root + os.sep):
+                    parts = os.path.relpath(path, root).split(os.sep)
+                    return not any(p in self.THIRD_PARTY_DIRS for p in parts)
+            return False
+        # not found in include dirs, so it is from the toolchain
+        return False
+
+    def sources_of(self, path):
+        # unity sources include the real sources
+        if os.path.basename(os.path.dirname(path)) != "Unity":
+            return [path]
+        sources = []
+        with open(path, "r", errors="replace") as f:
+            for line in f:
+                m = re.match(r'^#include "(.+)"', line)
+                if m:
+                    sources.append(m.group(1))
+        return sources
+
+    def top_level_includes(self, path):
+        includes = []
+        depth = 0
+        with open(path, "r", errors="replace") as f:
+            for line in f:
+                if self.IF_RE.match(line):
+                    depth += 1
+                elif self.ENDIF_RE.match(line):
+                    depth = max(depth - 1, 0)
+                elif depth == 0:
+                    m = self.INCLUDE_RE.match(line)
+                    if m:
+                        includes.append(m.group(1).strip())
+        return includes
+
+    def analyze(self):
+        """return {(target, lang): [headers]}, the most included first"""
+        # (target, lang) -> translation units and include count of headers
+        units = {}
+        counts = {}
+        project_headers = set()
+        for entry in CompileDatabase().load(self.build_dir):
+            path = os.path.join(entry["directory"], entry["file"])
+            name = os.path.basename(path)
+            lang = self.SOURCE_LANGS.get(os.path.splitext(name)[1].lower())
+            args = self.command_args(entry)
+            target = self.target_of(self.output_of(entry, args))
+            if lang is None or target is None or name.startswith("cmake_pch"):
+                continue
+            key = (target, lang)
+            include_dirs = self.include_dirs(entry, args)
+            for source in self.sources_of(path):
+                if not os.path.isfile(source):
+                    continue
+                units[key] = units.get(key, 0) + 1
+                for header in set(self.top_level_includes(source)):
+                    if header in project_headers:
+                        continue
+                    if self.is_project_header(header, include_dirs):
+                        project_headers.add(header)
+                        continue
+                    counts.setdefault(key, {})
+                    counts[key][header] = counts[key].get(header, 0) + 1
+        logging.debug(f"pch skip project headers: {sorted(project_headers)}")
+
+        headers = {}
+        for key, header_counts in sorted(counts.items()):
+            # at least two translation units to reuse the pch
+            min_count = max(2, units[key] * self.min_ratio)
+            hot = [h for h, c in header_counts.items() if c >= min_count]
+            hot.sort(key=lambda h: (-header_counts[h], h))
+            if hot:
+                headers[key] = hot[: self.max_headers]
+                logging.debug(
+                    f"pch for {key[0]}({key[1]}) of {units[key]} translation units: {headers[key]}"
+                )
+        return headers
+
+    def write_cmake(self, headers):
+        """write target_precompile_headers of all targets, only when changed, return True if changed"""
+        lines = [
+            "# generated by cmake_one --pch, do not edit",
+            "function(cmake_one_pch target)",
+            "  if(NOT TARGET ${target})",
+            "    return()",
+            "  endif()",
+            "  # keep the pch of project self",
+            "  get_target_property(reuse ${target} PRECOMPILE_HEADERS_REUSE_FROM)",
+            "  if(reuse)",
+            "    return()",
+            "  endif()",
+            "  target_precompile_headers(${target} PRIVATE ${ARGN})",
+            "endfunction()",
+        ]
+        targets = {}
+        for (target, lang), hot in headers.items():
+            targets.setdefault(target, [])
+            targets[target] += [f'"$<$<COMPILE_LANGUAGE:{lang}>:<{h}>>"' for h in hot]
+        for target, items in sorted(targets.items()):
+            lines.append(f"cmake_one_pch({target}")
+            lines += [f"  {i}" for i in items]
+            lines.append(")")
+        content = "\n".join(lines) + "\n"
+        if os.path.isfile(self.cmake_file):
+            with open(self.cmake_file, "r") as f:
+                if f.read() == content:
+                    logging.debug(f"pch not changed: {self.cmake_file}")
+                    return False
+        with open(self.cmake_file, "w") as f:
+            f.write(content)
+        logging.info(
+            f"write pch of {len(targets)} targets to {self.cmake_file}, cmake will rerun by ninja"
+        )
+        return True
+
+    def generate(self):
+        return self.write_cmake(self.analyze())
+
+    def ninja_deps(self, ninja="ninja"):
+        """output -> deps recorded by ninja, paths are absolute"""
+        deps = {}
+        out = subprocess.check_output(
+            [ninja, "-t", "deps"], cwd=self.build_dir, text=True
+        )
+        current = None
+        for line in out.splitlines():
+            if not line.strip():
+                continue
+            if not line.startswith(" "):
+                current = os.path.normpath(
+                    os.path.join(self.build_dir, line.split(": #deps")[0])
+                )
+                deps[current] = set()
+            elif current:
+                deps[current].add(
+                    os.path.normpath(os.path.join(self.build_dir, line.strip()))
+                )
+        return deps
+
+    def validate(self, ninja="ninja"):
+        """check the translation units reuse the pch instead of parsing the headers again
+
+        clang record the pch in deps, gcc silently parse the headers when the pch is invalid,
+        then all headers of the pch are in deps of the translation unit
+
+        only a report of a successful build, so errors are logged as warning instead of raised
+        """
+        try:
+            deps = self.ninja_deps(ninja)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(
+                f"pch: can not read deps by {ninja} -t deps: {e}, skip check"
+            )
+            return [], []
+        reused = []
+        not_reused = []
+        pchs = set()
+        try:
+            entries = CompileDatabase().load(self.build_dir)
+        except (OSError, ValueError, AssertionError) as e:
+            logging.warning(f"pch: can not load compile database: {e}, skip check")
+            return [], []
+        for entry in entries:
+            args = self.command_args(entry)
+            m = self.PCH_HEADER_RE.search(" ".join(args))
+            name = os.path.basename(entry["file"])
+            if m is None or name.startswith("cmake_pch"):
+                continue
+            pchs.add(m.group(1))
+            output = self.output_of(entry, args)
+            obj = os.path.normpath(os.path.join(entry["directory"], output or ""))
+            if obj not in deps:
+                continue
+            pch = None
+            for ext in [".gch", ".pch"]:
+                if os.path.normpath(m.group(1) + ext) in deps:
+                    pch = os.path.normpath(m.group(1) + ext)
+            if pch is None:
+                continue
+            headers = {h for h in deps[pch] if "cmake_pch" not in os.path.basename(h)}
+            if pch in deps[obj] or not headers.issubset(deps[obj]):
+                reused.append(obj)
+            else:
+                not_reused.append(obj)
+        logging.info(
+            f"pch: {len(pchs)} pch, {len(reused)} translation units reuse pch, {len(not_reused)} not"
+        )
+        if not_reused:
+            logging.warning(
+                f"pch not reused by: {[os.path.relpath(i, self.build_dir) for i in not_reused]}, flags of them may differ from the pch, see -Winvalid-pch warnings in build log"
+            )
+        return reused, not_reused
+
+
+class DistCompiler:
+    """compiler launcher to compile on dist workers
+
+    the source is preprocessed locally, then compiled by the same compiler on a worker,
+    compiles which need local files(pch, profile, plugin...) or have flags not in the
+    remote flags allowlist and any failure of workers fall back to compile locally, local
+    jobs are limited by slot files of dist dir
+    """
+
+    DIST_DIR = "cmake_one_dist"
+    LAUNCHER = "cmake_one_dist_cc"
+    CONNECT_TIMEOUT = 3
+    COMPILE_TIMEOUT = 600
+    # flags need local files or write more outputs
+    LOCAL_ONLY_FLAGS = (
+        "@",
+        "-B",
+        "-MJ",
+        "-Xclang",
+        "-fplugin",
+        "-fpass-plugin",
+        "-specs",
+        "--specs",
+        "-wrapper",
+        "-include-pch",
+        "-fmodules",
+        "-gsplit-dwarf",
+        "--coverage",
+        "-ftest-coverage",
+        "-fprofile-arcs",
+        "-fprofile-use",
+        "-fprofile-instr-use",
+        "-fsanitize-blacklist",
+        "-fsanitize-ignorelist",
+        "-save-temps",
+        "-ftime-trace",
+        "-fdump-",
+    )
+    # only these flags of code generation are compiled remotely, workers refuse others
+    REMOTE_FLAGS = ("-O", "-g", "-W", "-m", "-f", "-std=", "-stdlib=", "--target=")
+    REMOTE_EXACT_FLAGS = (
+        "-w",
+        "-pthread",
+        "-ansi",
+        "-pipe",
+        "-pedantic",
+        "-pedantic-errors",
+    )
+    REMOTE_FLAGS_WITH_VALUE = ("-target", "-arch", "--param")
+    # flags of REMOTE_FLAGS which read or write files, or pass args to other tools
+    REMOTE_DENY_FLAGS = (
+        "-mllvm",
+        "-gen-",
+        "-fprofile-",
+        "-fcoverage-",
+        "-fcrash-diagnostics",
+        "-fsave-optimization-record",
+        "-foptimization-record-",
+        "-fstack-usage",
+        "-fcallgraph-info",
+        "-fmodule",
+        "-fprebuilt-module",
+        "-fimplicit-module",
+        "-fxray-",
+        "-fsanitize-coverage-",
+        "-fthinlto-",
+        "-fbasic-block-sections",
+    )
+    # -f flags with a value, other values may be paths
+    REMOTE_F_VALUE_FLAGS = (
+        "-fvisibility=",
+        "-fsanitize=",
+        "-fno-sanitize=",
+        "-fsanitize-recover=",
+        "-fno-sanitize-recover=",
+        "-fsanitize-trap=",
+        "-fno-sanitize-trap=",
+        "-fdebug-prefix-map=",
+        "-ffile-prefix-map=",
+        "-fmacro-prefix-map=",
+        "-fdiagnostics-color=",
+        "-fmessage-length=",
+        "-ftemplate-depth=",
+        "-fconstexpr-depth=",
+        "-fconstexpr-steps=",
+        "-ffp-contract=",
+        "-ffp-model=",
+        "-fdenormal-fp-math=",
+        "-fcf-protection=",
+        "-flto=",
+        "-fopenmp=",
+        "-ftls-model=",
+        "-fmax-errors=",
+        "-ferror-limit=",
+        "-finput-charset=",
+        "-fexec-charset=",
+        "-fdebug-default-version=",
+        "-fms-compatibility-version=",
+        "-ftrivial-auto-var-init=",
+        "-fzero-call-used-regs=",
+        "-fpatchable-function-entry=",
+        "-fabi-version=",
+        "-fexcess-precision=",
+        "-falign-functions=",
+        "-falign-loops=",
+        "-falign-jumps=",
+        "-falign-labels=",
+    )
+    # a message larger than this is refused
+    MAX_MSG_SIZE = 1 << 30
+    # preprocessor flags are not needed for preprocessed source
+    DROP_FLAGS_WITH_VALUE = (
+        "-MF",
+        "-MT",
+        "-MQ",
+        "-I",
+        "-isystem",
+        "-iquote",
+        "-idirafter",
+        "-imsvc",
+        "-include",
+        "-imacros",
+        "-D",
+        "-U",
+        "--sysroot",
+        "-isysroot",
+    )
+    DROP_FLAGS = (
+        "-I",
+        "-D",
+        "-U",
+        "-MD",
+        "-MMD",
+        "-MF",
+        "-MT",
+        "-MQ",
+        "-isystem",
+        "-iquote",
+        "-idirafter",
+        "-imsvc",
+        "--sysroot=",
+        "-Winvalid-pch",
+    )
+    PREPROCESSED_EXTS = {"C": ".i", "CXX": ".ii"}
+    X_LANGS = {"c": "C", "c++": "CXX"}
+    # env needed by the compiler on worker
+    FORWARD_ENVS = ["QNX_HOST", "QNX_TARGET", "QNX_CONFIGURATION"]
+
+    def __init__(self):
+        self.workers = os.environ.get("CMAKE_ONE_DIST_WORKERS", "").split()
+        self.token = os.environ.get("CMAKE_ONE_DIST_TOKEN", "")
+        self.local_jobs = int(os.environ.get("CMAKE_ONE_DIST_LOCAL_JOBS", "0"))
+        self.dist_dir = os.environ.get("CMAKE_ONE_DIST_DIR")
+
+    @staticmethod
+    def send_msg(sock, header, payload=b""):
+        data = json.dumps(header).encode()
+        sock.sendall(struct.pack("!QQ", len(data), len(payload)) + data + payload)
+
+    @staticmethod
+    def recv_msg(sock):
+        def recv_exact(size):
+            chunks = []
+            while size > 0:
+                chunk = sock.recv(min(size, 1 << 20))
+                if not chunk:
+                    raise ConnectionError("connection closed")
+                chunks.append(chunk)
+                size -= len(chunk)
+            return b"".join(chunks)
+
+        header_size, payload_size = struct.unpack("!QQ", recv_exact(16))
+        if header_size + payload_size > DistCompiler.MAX_MSG_SIZE:
+            raise ValueError(f"message too large: {header_size + payload_size}")
+        header = json.loads(recv_exact(header_size))
+        return header, recv_exact(payload_size)
+
+    @staticmethod
+    def request(worker, header, payload=b"", timeout=None):
+        host, port = worker.rsplit(":", 1)
+        with socket.create_connection(
+            (host, int(port)), timeout=DistCompiler.CONNECT_TIMEOUT
+        ) as sock:
+            sock.settimeout(timeout)
+            DistCompiler.send_msg(sock, header, payload)
+            return DistCompiler.recv_msg(sock)
+
+    @staticmethod
+    def ping_workers(workers, token):
+        """return {worker: jobs} of available workers"""
+        available = {}
+        for worker in workers:
+            try:
+                resp, _ = DistCompiler.request(
+                    worker,
+                    {"type": "ping", "token": token},
+                    timeout=DistCompiler.CONNECT_TIMEOUT,
+                )
+            except (OSError, ValueError) as e:
+                logging.warning(f"dist worker {worker} is not available: {e}")
+                continue
+            if resp.get("status") != "ok":
+                logging.warning(
+                    f"dist worker {worker} is not available: {resp.get('error')}"
+                )
+                continue
+            available[worker] = resp["jobs"]
+        return available
+
+    @staticmethod
+    def compiler_id(compiler, cache=None):
+        """hash of compiler version and size, the worker must have the same compiler
+
+        it only checks the compilers are the same, not an auth, anyone can compute it
+        """
+        st = os.stat(compiler)
+        key = f"{os.path.realpath(compiler)}:{st.st_mtime_ns}:{st.st_size}"
+        if cache is not None and key in cache:
+            return cache[key]
+        p = subprocess.run([compiler, "--version"], capture_output=True)
+        h = hashlib.sha256(f"{st.st_size}\n".encode())
+        h.update(p.stdout + p.stderr)
+        if cache is not None:
+            cache[key] = h.hexdigest()
+        return h.hexdigest()
+
+    def cached_compiler_id(self, compiler):
+        cache = {}
+        cache_file = None
+        if self.dist_dir:
+            cache_file = os.path.join(self.dist_dir, "compiler_ids.json")
+            if os.path.isfile(cache_file):
+                with open(cache_file, "r") as f:
+                    cache = json.load(f)
+        size = len(cache)
+        compiler_id = self.compiler_id(compiler, cache)
+        if cache_file and len(cache) != size:
+            tmp = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, cache_file)
+        return compiler_id
+
+    @contextlib.contextmanager
+    def local_slot(self):
+        """limit local jobs of all launchers by flock of slot files"""
+        if fcntl is None or not self.dist_dir or self.local_jobs <= 0:
+            yield
+            return
+        os.makedirs(self.dist_dir, exist_ok=True)
+        while True:
+            for i in range(self.local_jobs):
+                f = open(os.path.join(self.dist_dir, f"slot_{i}"), "a")
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    f.close()
+                    continue
+                # close the file to release the lock
+                with f:
+                    yield
+                return
+            time.sleep(0.05)
+
+    @classmethod
+    def remote_args_allowed(cls, args):
+        """only flags of code generation in the allowlist, checked by the client and the worker"""
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if (
+                arg in cls.REMOTE_FLAGS_WITH_VALUE
+                and i + 1 < len(args)
+                and not args[i + 1].startswith(("-", "@"))
+            ):
+                i += 2
+                continue
+            if arg.startswith(cls.LOCAL_ONLY_FLAGS) or arg.startswith(
+                cls.REMOTE_DENY_FLAGS
+            ):
+                return False
+            if arg not in cls.REMOTE_EXACT_FLAGS and not arg.startswith(
+                cls.REMOTE_FLAGS
+            ):
+                return False
+            # -Wl, -Wa, -Wp, pass args to other tools
+            if arg.startswith("-W") and "," in arg:
+                return False
+            if (
+                arg.startswith("-f")
+                and "=" in arg
+                and not arg.startswith(cls.REMOTE_F_VALUE_FLAGS)
+            ):
+                return False
+            i += 1
+        return True
+
+    def remote_job(self, args):
+        """return (lang, source, output, remote args) or None if can not compile remotely"""
+        if "-c" not in args or any(
+            arg.startswith(self.LOCAL_ONLY_FLAGS) for arg in args
+        ):
+            return None
+        remote_args = []
+        sources = []
+        output = None
+        lang = None
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if arg == "-o" and i + 1 < len(args):
+                output = args[i + 1]
+                i += 2
+            elif arg == "-x" and i + 1 < len(args):
+                lang = self.X_LANGS.get(args[i + 1], "unknown")
+                i += 2
+            elif arg in self.DROP_FLAGS_WITH_VALUE:
+                i += 2
+            elif arg == "-c" or arg.startswith(self.DROP_FLAGS):
+                i += 1
+            elif not arg.startswith("-") and os.path.isfile(arg):
+                sources.append(arg)
+                i += 1
+            else:
+                remote_args.append(arg)
+                i += 1
+        if len(sources) != 1 or output is None:
+            return None
+        if not self.remote_args_allowed(remote_args):
+            logging.debug(f"compile locally for not allowed remote args: {remote_args}")
+            return None
+        if lang is None:
+            lang = PrecompiledHeader.SOURCE_LANGS.get(
+                os.path.splitext(sources[0])[1].lower()
+            )
+        if lang not in self.PREPROCESSED_EXTS:
+            return None
+        return lang, sources[0], output, remote_args
+
+    def compile_remote(self, compiler, args, job):
+        """return the exit code, or None if need compile locally"""
+        lang, _, output, remote_args = job
+        compiler = shutil.which(compiler)
+        if compiler is None:
+            return None
+        preprocessed = f"{output}.cmake_one{self.PREPROCESSED_EXTS[lang]}"
+        # keep depfile flags, so ninja get the deps from the local preprocess
+        pre_args = list(args)
+        pre_args[pre_args.index("-c")] = "-E"
+        pre_args[pre_args.index("-o") + 1] = preprocessed
+        try:
+            with self.local_slot():
+                if subprocess.call([compiler, *pre_args]) != 0:
+                    return None
+            with open(preprocessed, "rb") as f:
+                source = f.read()
+        finally:
+            if os.path.exists(preprocessed):
+                os.remove(preprocessed)
+
+        header = {
+            "type": "compile",
+            "token": self.token,
+            "compiler": compiler,
+            "compiler_id": self.cached_compiler_id(compiler),
+            "args": remote_args,
+            "ext": self.PREPROCESSED_EXTS[lang],
+            "cwd": os.getcwd(),
+            "env": {k: os.environ[k] for k in self.FORWARD_ENVS if k in os.environ},
+        }
+        workers = list(self.workers)
+        random.shuffle(workers)
+        for worker in workers:
+            try:
+                resp, obj = self.request(worker, header, source, self.COMPILE_TIMEOUT)
+            except (OSError, ValueError) as e:
+                logging.warning(f"dist worker {worker} failed: {e}")
+                continue
+            if resp.get("status") != "ok":
+                logging.warning(f"dist worker {worker} refused: {resp.get('error')}")
+                continue
+            if resp["returncode"] != 0:
+                # compile again locally for the exact diagnostics
+                return None
+            sys.stderr.write(resp["stderr"])
+            tmp = f"{output}.cmake_one.tmp"
+            with open(tmp, "wb") as f:
+                f.write(obj)
+            os.replace(tmp, output)
+            return 0
+        return None
+
+    def run(self, argv):
+        """compile argv: [compiler, args...], return the exit code"""
+        assert argv, "dist_cc need compiler command"
+        compiler, args = argv[0], argv[1:]
+        if self.workers:
+            job = self.remote_job(args)
+            if job:
+                ret = self.compile_remote(compiler, args, job)
+                if ret is not None:
+                    return ret
+        with self.local_slot():
+            return subprocess.call(argv)
+
+
+class DistWorker:
+    """worker daemon to compile preprocessed sources for DistCompiler
+
+    only the compilers configured on the worker are run, with the allowlist flags of
+    DistCompiler.remote_args_allowed, and all requests need the token
+    """
+
+    def __init__(self, jobs, token, compilers):
+        assert (
+            token
+        ), "error config: dist worker need export CMAKE_ONE_DIST_TOKEN, the same as the clients"
+        self.jobs = jobs
+        self.token = token
+        self.compilers = set()
+        for compiler in compilers:
+            assert os.path.isabs(compiler) and os.access(
+                compiler, os.X_OK
+            ), f"error config: worker compiler {compiler} is not an absolute path of executable"
+            self.compilers.add(os.path.normpath(compiler))
+        assert self.compilers, "error config: dist worker need --worker_compilers"
+        self.semaphore = threading.Semaphore(jobs)
+        self.compiler_ids = {}
+        self.lock = threading.Lock()
+
+    def compile(self, header, payload):
+        compiler = header.get("compiler")
+        args = header.get("args")
+        if not isinstance(compiler, str) or compiler not in self.compilers:
+            return {
+                "status": "error",
+                "error": f"compiler not allowed: {compiler}",
+            }, b""
+        if (
+            not isinstance(args, list)
+            or not all(isinstance(arg, str) for arg in args)
+            or not DistCompiler.remote_args_allowed(args)
+            or header.get("ext") not in DistCompiler.PREPROCESSED_EXTS.values()
+        ):
+            return {"status": "error", "error": f"args not allowed: {args}"}, b""
+        with self.lock:
+            compiler_id = DistCompiler.compiler_id(compiler, self.compiler_ids)
+        if compiler_id != header.get("compiler_id"):
+            return {"status": "error", "error": f"{compiler} is different"}, b""
+        # the compiler may run tools by these env, so only compile with the env of worker
+        for k in DistCompiler.FORWARD_ENVS:
+            if header.get("env", {}).get(k) != os.environ.get(k):
+                return {"status": "error", "error": f"env {k} is different"}, b""
+        env = dict(os.environ)
+        with self.semaphore, tempfile.TemporaryDirectory(
+            prefix="cmake_one_dist_"
+        ) as tmp:
+            source = os.path.join(tmp, f"source{header['ext']}")
+            obj = os.path.join(tmp, "source.o")
+            with open(source, "wb") as f:
+                f.write(payload)
+            # debug info use the dir of the client
+            cmd = [
+                compiler,
+                *args,
+                f"-fdebug-prefix-map={tmp}={header.get('cwd', '')}",
+                "-c",
+                source,
+                "-o",
+                obj,
+            ]
+            p = subprocess.run(cmd, cwd=tmp, env=env, capture_output=True)
+            data = b""
+            if p.returncode == 0:
+                with open(obj, "rb") as f:
+                    data = f.read()
+        logging.debug(
+            f"compile {len(payload)} bytes for {header.get('cwd')} by {compiler}, return: {p.returncode}"
+        )
+        resp = {
+            "status": "ok",
+            "returncode": p.returncode,
+            "stderr": p.stderr.decode(errors="replace"),
+        }
+        return resp, data
+
+    def handle(self, sock):
+        try:
+            header, payload = DistCompiler.recv_msg(sock)
+        except (OSError, ValueError) as e:
+            logging.debug(f"bad request: {e}")
+            return
+        if not hmac.compare_digest(str(header.get("token", "")), self.token):
+            DistCompiler.send_msg(sock, {"status": "error", "error": "bad token"})
+            return
+        if header.get("type") == "ping":
+            DistCompiler.send_msg(sock, {"status": "ok", "jobs": self.jobs})
+        elif header.get("type") == "compile":
+            DistCompiler.send_msg(sock, *self.compile(header, payload))
+        else:
+            DistCompiler.send_msg(sock, {"status": "error", "error": "bad type"})
+
+    def serve(self, listen):
+        host, port = listen.rsplit(":", 1)
+        worker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                worker.handle(self.request)
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        with Server((host, int(port)), Handler) as server:
+            logging.info(
+                f"dist worker listen at: {listen}, jobs: {self.jobs}, compilers: {sorted(self.compilers)}"
+            )
+            server.serve_forever()
+
+
+class Trash:
+    """remove dirs without waiting: rename them to a trash dir in the same parent, then delete by a detached process
+
+    the deleting process holds a flock of the trash dir, entries left by killed or crashed runs
+    are deleted by the next run, the oldest entries are deleted at once if trash is larger than max_size
+    """
+
+    DIR_NAME = ".cmake_one_trash"
+    LOCK_FILE = ".lock"
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+
+    @classmethod
+    def trash_dir_of(cls, path):
+        return os.path.join(os.path.dirname(os.path.abspath(path)), cls.DIR_NAME)
+
+    @classmethod
+    def entries(cls, trash_dir):
+        """entries of trash dir, the oldest first"""
+        if not os.path.isdir(trash_dir):
+            return []
+        entries = [
+            os.path.join(trash_dir, e)
+            for e in os.listdir(trash_dir)
+            if e != cls.LOCK_FILE
+        ]
+        return sorted(entries, key=lambda e: os.lstat(e).st_mtime)
+
+    @staticmethod
+    def dir_size(path):
+        size = 0
+        for root, _, files in os.walk(path):
+            for f in files:
+                try:
+                    size += os.lstat(os.path.join(root, f)).st_size
+                except OSError:
+                    pass
+        return size
+
+    @contextlib.contextmanager
+    def lock(self, trash_dir, blocking):
+        """yield True if locked, without fcntl always yield True"""
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(trash_dir, self.LOCK_FILE), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except OSError:
+                yield False
+                return
+            yield True
+
+    def remove(self, path):
+        """move path to trash, call clean_in_background to delete it"""
+        if not os.path.lexists(path):
+            return
+        if os.path.islink(path) or not os.path.isdir(path):
+            os.remove(path)
+            return
+        trash_dir = self.trash_dir_of(path)
+        os.makedirs(trash_dir, exist_ok=True)
+        # mtime of the entry is the time of remove, rename keep the old mtime
+        os.utime(path)
+        dst = os.path.join(
+            trash_dir, f"{os.path.basename(path)}.{time.time_ns()}.{os.getpid()}"
+        )
+        try:
+            os.rename(path, dst)
+        except OSError as e:
+            logging.warning(f"can not move {path} to trash: {e}, remove it now")
+            shutil.rmtree(path)
+            return
+        logging.debug(f"move {path} to {dst}")
+
+    def clean_in_background(self, trash_dir):
+        """start a detached process to empty trash dir if any entry and not cleaning"""
+        entries = self.entries(trash_dir)
+        if not entries:
+            return
+        with self.lock(trash_dir, False) as locked:
+            if not locked:
+                logging.debug(f"trash {trash_dir} is cleaning by other process")
+                return
+            # left by killed runs or deleting is slower than new entries
+            if len(entries) > 1:
+                sizes = [self.dir_size(e) for e in entries]
+                while len(entries) > 1 and sum(sizes) > self.max_size:
+                    logging.info(
+                        f"trash {trash_dir} is larger than {self.max_size}, remove {entries[0]} now"
+                    )
+                    shutil.rmtree(entries.pop(0), ignore_errors=True)
+                    sizes.pop(0)
+        logging.debug(f"clean trash {trash_dir} in background")
+        subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--trash_max_size",
+                str(self.max_size),
+                "clean_trash",
+                "--trash_dir",
+                trash_dir,
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def clean(self, trash_dir):
+        """delete all entries of trash dir, return at once if other process is cleaning it"""
+        if not os.path.isdir(trash_dir):
+            return
+        while True:
+            with self.lock(trash_dir, False) as locked:
+                if not locked:
+                    return
+                # new entries may be added when deleting
+                entries = self.entries(trash_dir)
+                while entries:
+                    for e in entries:
+                        logging.debug(f"delete {e}")
+                        if os.path.isdir(e) and not os.path.islink(e):
+                            shutil.rmtree(e, ignore_errors=True)
+                        else:
+                            os.remove(e)
+                    entries = self.entries(trash_dir)
+            # entries added after the last scan, their producer could not lock to start a cleaner
+            if not self.entries(trash_dir):
+                return
+
+
+class ArtifactCache:
+    """local store of install dirs, keyed by source, config and toolchain fingerprint
+
+    each entry is store_dir/<key>/install with a meta.json, entries are evicted by
+    age and then the least recently used ones until the store is under max size
+    """
+
+    META_FILE = "meta.json"
+    # untracked top level files and dirs in repo made by cmake_one, not part of the source
+    GENERATED_NAMES = [
+        "build",
+        "install",
+        "build-matrix-logs",
+        CompileDatabase.FILE_NAME,
+        Trash.DIR_NAME,
+    ]
+    # the default build dirs: build-host-Release, build-ANDROID-aarch64-Debug, build-host-Release-32bit
+    GENERATED_BUILD_DIR_RE = re.compile(r"^build-.+-(Release|Debug)(-32bit)?$")
+
+    @classmethod
+    def is_generated(cls, name):
+        return name in cls.GENERATED_NAMES or bool(
+            cls.GENERATED_BUILD_DIR_RE.match(name)
+        )
+
+    def __init__(self, cache_dir, max_size, max_age_days):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.max_age = max_age_days * 24 * 3600
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def git(repo_dir, *args):
+        return subprocess.check_output(
+            ["git", "-C", repo_dir, *args], stderr=subprocess.DEVNULL
+        )
+
+    @staticmethod
+    def hash_path(h, path):
+        """hash a file or all files of a dir, symlinks are hashed by target"""
+        paths = [path]
+        if os.path.isdir(path) and not os.path.islink(path):
+            paths = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                paths += [os.path.join(root, f) for f in sorted(files)]
+        for p in paths:
+            h.update(f"file:{p}\n".encode())
+            if os.path.islink(p):
+                h.update(os.readlink(p).encode())
+            elif os.path.isfile(p):
+                with open(p, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        h.update(chunk)
+
+    @classmethod
+    def source_fingerprint(cls, repo_dir, skip_dirs=()):
+        """git tree hash of HEAD with the content of dirty files, also for submodules
+
+        repo_dir may be a sub dir of the work tree, paths of git status are relative to
+        the top level dir, generated names are checked relative to repo_dir
+
+        return None if repo_dir is not a git repo
+        """
+        repo_dir = os.path.realpath(repo_dir)
+        try:
+            tree = cls.git(repo_dir, "rev-parse", "HEAD^{tree}").decode().strip()
+            top_dir = (
+                cls.git(repo_dir, "rev-parse", "--show-toplevel")
+                .decode(errors="surrogateescape")
+                .strip()
+            )
+            status = cls.git(
+                repo_dir,
+                "status",
+                "--porcelain=v1",
+                "-z",
+                "--untracked-files=normal",
+                "--ignore-submodules=all",
+            )
+            submodules = cls.git(
+                repo_dir, "submodule", "foreach", "--quiet", "--recursive", "pwd"
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        h = hashlib.sha256(f"tree:{tree}\n".encode())
+        entries = status.decode(errors="surrogateescape").split("\0")
+        i = 0
+        while i < len(entries):
+            entry = entries[i]
+            i += 1
+            if len(entry) < 4:
+                continue
+            state, path = entry[:2], entry[3:]
+            # renames have the old path as the next entry
+            if "R" in state or "C" in state:
+                i += 1
+            # not resolved, the links of cmake_one like repo_dir/build are checked by name
+            name = os.path.normpath(os.path.join(top_dir, path))
+            if state == "??" and name.startswith(repo_dir + os.sep):
+                top = os.path.relpath(name, repo_dir).split(os.sep)[0]
+                if cls.is_generated(top):
+                    continue
+            full = os.path.realpath(name)
+            if any(full == d or full.startswith(d + os.sep) for d in skip_dirs):
+                continue
+            h.update(f"{state}:{path}\n".encode())
+            cls.hash_path(h, full)
+        for sub in submodules.decode().split("\n"):
+            if sub:
+                sub_fingerprint = cls.source_fingerprint(sub, skip_dirs)
+                h.update(f"submodule:{sub}:{sub_fingerprint}\n".encode())
+        return h.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, install_dir):
+        """copy install dir of key to install_dir, return False if not in cache"""
+        entry = self.entry_dir(key)
+        meta_file = os.path.join(entry, self.META_FILE)
+        if not os.path.isfile(meta_file):
+            return False
+        # copy to a tmp dir then move it in, so install_dir is never half restored
+        tmp = f"{install_dir}.{os.getpid()}.tmp"
+        try:
+            shutil.copytree(os.path.join(entry, "install"), tmp, symlinks=True)
+        except OSError as e:
+            # evicted by another build or no space
+            logging.warning(f"can not restore artifact cache {key}: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        old = f"{install_dir}.{os.getpid()}.old"
+        try:
+            os.rename(install_dir, old)
+        except FileNotFoundError:
+            old = None
+        try:
+            os.replace(tmp, install_dir)
+        except OSError:
+            # restored by another build at the same time
+            shutil.rmtree(tmp, ignore_errors=True)
+        if old:
+            shutil.rmtree(old, ignore_errors=True)
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+        meta["last_used"] = time.time()
+        with open(meta_file, "w") as f:
+            json.dump(meta, f, indent=2)
+        logging.info(f"artifact cache hit: {key} of {meta['name']}")
+        return True
+
+    def store(self, key, install_dir, name):
+        entry = self.entry_dir(key)
+        if os.path.isfile(os.path.join(entry, self.META_FILE)):
+            return
+        tmp = f"{entry}.{os.getpid()}.tmp"
+        shutil.copytree(install_dir, os.path.join(tmp, "install"), symlinks=True)
+        size = 0
+        for root, _, files in os.walk(tmp):
+            size += sum(os.lstat(os.path.join(root, f)).st_size for f in files)
+        meta = {"name": name, "size": size, "created": time.time()}
+        meta["last_used"] = meta["created"]
+        with open(os.path.join(tmp, self.META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored by another build at the same time
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        logging.info(f"artifact cache store: {key} of {name}, size: {size}")
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta_file = os.path.join(self.entry_dir(key), self.META_FILE)
+            try:
+                with open(meta_file, "r") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                # tmp dirs of running stores or removed by other build
+                continue
+            entries.append((meta["last_used"], meta["size"], key))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        for last_used, size, key in entries:
+            if now - last_used <= self.max_age and total <= self.max_size:
+                break
+            logging.debug(f"artifact cache evict: {key}")
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+
+
+class ProbeCache:
+    """cache of cmake toolchain probes, to skip compiler identification, ABI detection and checks in new build dirs
+
+    cmake skip the probes of a language if CMakeFiles/<cmake version>/CMake<LANG>Compiler.cmake
+    exists and CMAKE_PLATFORM_INFO_INITIALIZED is in cache, so a new build dir is seeded with
+    these files and the cache entries of a build dir with the same toolchain and flags
+
+    each entry is cache_dir/<key> with:
+        platform/: CMakeSystem.cmake and CMake<LANG>Compiler.cmake
+        cmake_cache.txt: CMAKE_* entries of CMakeCache.txt
+        checks/<repo hash>.txt: other INTERNAL entries, like check_include_file results, they are project specific
+        meta.json: cmake version and mtime and size of compilers, the entry is removed if compilers changed
+    """
+
+    META_FILE = "meta.json"
+    PLATFORM_FILES = ["CMakeSystem.cmake", "CMake*Compiler.cmake"]
+    # entries of the build dir and project, not of the toolchain
+    SKIP_ENTRIES = [
+        "CMAKE_HOME_DIRECTORY",
+        "CMAKE_CACHEFILE_DIR",
+        "CMAKE_NUMBER_OF_MAKEFILES",
+        "CMAKE_INSTALL_PREFIX",
+        "CMAKE_PROJECT_INCLUDE",
+    ]
+    SKIP_ENTRY_PREFIXES = ("CMAKE_PROJECT_",)
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def checks_file(entry, repo_dir):
+        name = hashlib.sha256(os.path.realpath(repo_dir).encode()).hexdigest()[:16]
+        return os.path.join(entry, "checks", f"{name}.txt")
+
+    @staticmethod
+    def compilers(platform_dir):
+        """{compiler: [mtime_ns, size]} of CMake<LANG>Compiler.cmake in platform_dir"""
+        ret = {}
+        for f in os.listdir(platform_dir):
+            if not re.match(r"CMake\w+Compiler\.cmake$", f):
+                continue
+            with open(os.path.join(platform_dir, f), "r") as fp:
+                for compiler in re.findall(
+                    r'^set\(CMAKE_\w+_COMPILER "([^"]+)"\)', fp.read(), re.M
+                ):
+                    if os.path.isfile(compiler):
+                        st = os.stat(compiler)
+                        ret[compiler] = [st.st_mtime_ns, st.st_size]
+        return ret
+
+    def restore(self, key, build_dir, repo_dir):
+        """seed a new build dir, return False if not in cache or the compilers changed"""
+        entry = os.path.join(self.cache_dir, key)
+        meta_file = os.path.join(entry, self.META_FILE)
+        if not os.path.isfile(meta_file):
+            return False
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+        platform_dir = os.path.join(entry, "platform")
+        if self.compilers(platform_dir) != meta["compilers"]:
+            logging.info(f"probe cache: compilers changed, remove {entry}")
+            shutil.rmtree(entry, ignore_errors=True)
+            return False
+        dst = os.path.join(build_dir, "CMakeFiles", meta["cmake_version"])
+        os.makedirs(dst, exist_ok=True)
+        for f in os.listdir(platform_dir):
+            shutil.copy2(os.path.join(platform_dir, f), dst)
+        lines = ["# seeded by cmake_one probe cache: " + key]
+        for f in [
+            os.path.join(entry, "cmake_cache.txt"),
+            self.checks_file(entry, repo_dir),
+        ]:
+            if os.path.isfile(f):
+                with open(f, "r") as fp:
+                    lines.append(fp.read())
+        with open(os.path.join(build_dir, "CMakeCache.txt"), "w") as f:
+            f.write("\n".join(lines))
+        logging.info(f"probe cache hit: {key}, seed {build_dir}")
+        return True
+
+    def store(self, key, build_dir, repo_dir):
+        entry = os.path.join(self.cache_dir, key)
+        checks_file = self.checks_file(entry, repo_dir)
+        if os.path.isfile(os.path.join(entry, self.META_FILE)) and os.path.isfile(
+            checks_file
+        ):
+            return
+        platform_dirs = [
+            os.path.dirname(f)
+            for f in glob.glob(
+                os.path.join(build_dir, "CMakeFiles", "*", "CMakeSystem.cmake")
+            )
+        ]
+        cache_file = os.path.join(build_dir, "CMakeCache.txt")
+        if len(platform_dirs) != 1 or not os.path.isfile(cache_file):
+            logging.debug(f"probe cache: no or many cmake platform dirs in {build_dir}")
+            return
+        platform_dir = platform_dirs[0]
+        dirs = [os.path.realpath(build_dir), os.path.realpath(repo_dir)]
+        toolchain_entries = []
+        check_entries = []
+        with open(cache_file, "r") as f:
+            for line in f:
+                m = re.match(r"([^#/\s][^:]*):(\w+)=(.*)$", line.rstrip("\n"))
+                if not m:
+                    continue
+                name, entry_type, value = m.groups()
+                if name in self.SKIP_ENTRIES or name.startswith(
+                    self.SKIP_ENTRY_PREFIXES
+                ):
+                    continue
+                if any(d in value for d in dirs):
+                    continue
+                if name.startswith("CMAKE_"):
+                    toolchain_entries.append(line.rstrip("\n"))
+                elif entry_type == "INTERNAL":
+                    check_entries.append(line.rstrip("\n"))
+
+        # write all to a tmp dir then rename, other builds may store the same key now
+        tmp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(os.path.join(tmp, "checks"))
+        with open(self.checks_file(tmp, repo_dir), "w") as f:
+            f.write("\n".join(check_entries) + "\n")
+        if os.path.isfile(os.path.join(entry, self.META_FILE)):
+            # only add the checks of this project
+            os.replace(self.checks_file(tmp, repo_dir), checks_file)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        os.makedirs(os.path.join(tmp, "platform"))
+        for pattern in self.PLATFORM_FILES:
+            for f in glob.glob(os.path.join(platform_dir, pattern)):
+                shutil.copy2(f, os.path.join(tmp, "platform"))
+        with open(os.path.join(tmp, "cmake_cache.txt"), "w") as f:
+            f.write("\n".join(toolchain_entries) + "\n")
+        meta = {
+            "cmake_version": os.path.basename(platform_dir),
+            "compilers": self.compilers(os.path.join(tmp, "platform")),
+        }
+        with open(os.path.join(tmp, self.META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        logging.info(f"probe cache store: {key}, compilers: {list(meta['compilers'])}")
+
+
+class IncrementalInstall:
+    """install only the changed artifacts, and strip them in parallel
+
+    cmake install to build_dir/STAGE_DIR without strip, so cmake itself skip the up to date
+    files, then the files changed since the last install are copied to install_dir and
+    stripped by the strip rules of cmake_install.cmake, manifest of the last install is
+    build_dir/MANIFEST_FILE: {relative path: [stage (size, mtime_ns), install (size, mtime_ns)]}
+
+    mode link: reflink the files from stage dir if the filesystem support, else hardlink, the
+    stripped files are never hardlinked as strip would change the stage file too, cmake
+    write the up to date stage files in place, the same as ninja install write install_dir
+    """
+
+    STAGE_DIR = "cmake_one_install_stage"
+    MANIFEST_FILE = "cmake_one_install_manifest.json"
+    CMAKE_MANIFEST_FILE = "install_manifest.txt"
+    DEST_PREFIX = "$ENV{DESTDIR}${CMAKE_INSTALL_PREFIX}/"
+    MODES = ["copy", "link"]
+    # ioctl of linux to reflink a whole file
+    FICLONE = 0x40049409
+
+    def __init__(self, build_dir, install_dir, strip=True, jobs=None, mode="copy"):
+        self.build_dir = os.path.abspath(build_dir)
+        self.install_dir = os.path.abspath(install_dir)
+        self.stage_dir = os.path.join(self.build_dir, self.STAGE_DIR)
+        self.manifest_file = os.path.join(self.build_dir, self.MANIFEST_FILE)
+        self.strip = strip
+        self.jobs = jobs or os.cpu_count() or 1
+        assert (
+            mode in self.MODES
+        ), f"error config: install mode {mode} not in {self.MODES}"
+        self.mode = mode
+        # skip reflink after the first failure, the filesystem not support it
+        self.can_reflink = platform.system() in ["Linux", "Darwin"]
+
+    @staticmethod
+    def file_stat(path):
+        st = os.lstat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def cmake_strip(self):
+        cache_file = os.path.join(self.build_dir, "CMakeCache.txt")
+        if os.path.isfile(cache_file):
+            with open(cache_file, "r") as f:
+                m = re.search(r"^CMAKE_STRIP:\w+=(.*)$", f.read(), re.M)
+                if m:
+                    return m.group(1)
+        return "strip"
+
+    def strip_rules(self):
+        """{relative path: strip command} from if(CMAKE_INSTALL_DO_STRIP) of cmake_install.cmake
+
+        the path is in the strip command, or in foreach(file ...) for the libraries with
+        VERSION or SOVERSION, like libfoo.so.1.2.3 and libfoo.so.1
+        """
+        rules = {}
+        cmake_strip = None
+        for root, dirs, files in os.walk(self.build_dir):
+            dirs[:] = [d for d in dirs if d not in [self.STAGE_DIR, "CMakeFiles"]]
+            if "cmake_install.cmake" not in files:
+                continue
+            in_strip = False
+            # files of the current foreach(file ...)
+            foreach_files = []
+            in_foreach_list = False
+            with open(os.path.join(root, "cmake_install.cmake"), "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line == "foreach(file":
+                        foreach_files = []
+                        in_foreach_list = True
+                    elif in_foreach_list:
+                        if line == ")":
+                            in_foreach_list = False
+                        else:
+                            foreach_files += shlex.split(line)
+                    elif line == "endforeach()":
+                        foreach_files = []
+                    elif line == "if(CMAKE_INSTALL_DO_STRIP)":
+                        in_strip = True
+                    elif line == "endif()":
+                        in_strip = False
+                    elif in_strip:
+                        m = re.match(r"execute_process\(COMMAND (.+)\)$", line)
+                        if not m:
+                            continue
+                        args = shlex.split(m.group(1))
+                        paths = [args[-1]]
+                        if args[-1] == "${file}":
+                            paths = foreach_files
+                        paths = [p for p in paths if p.startswith(self.DEST_PREFIX)]
+                        if not paths:
+                            # a new form of cmake, the installed file would differ from install/strip
+                            logging.warning(
+                                f"can not find the file to strip of: {line} in {root}/cmake_install.cmake, it is not stripped"
+                            )
+                            continue
+                        if args[0] == "${CMAKE_STRIP}":
+                            cmake_strip = cmake_strip or self.cmake_strip()
+                            args[0] = cmake_strip
+                        for path in paths:
+                            rules[path[len(self.DEST_PREFIX) :]] = args[:-1]
+        return rules
+
+    def stage(self):
+        """cmake install to stage dir, return the installed files relative to stage dir"""
+        subprocess.check_call(
+            ["cmake", "--install", self.build_dir, "--prefix", self.stage_dir]
+        )
+        cmake_manifest = os.path.join(self.build_dir, self.CMAKE_MANIFEST_FILE)
+        with open(cmake_manifest, "r") as f:
+            files = [
+                os.path.relpath(line.rstrip("\n"), self.stage_dir)
+                for line in f
+                if line.strip()
+            ]
+        # the same as ninja install, so tools like uninstall scripts still work
+        with open(cmake_manifest, "w") as f:
+            f.write("".join(os.path.join(self.install_dir, i) + "\n" for i in files))
+        return files
+
+    def reflink(self, src, dst):
+        """copy on write clone src to dst, return False if the filesystem not support it"""
+        try:
+            if platform.system() == "Darwin":
+                libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+                if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+                    raise OSError(ctypes.get_errno(), "clonefile failed")
+            else:
+                with open(src, "rb") as s, open(dst, "wb") as d:
+                    fcntl.ioctl(d.fileno(), self.FICLONE, s.fileno())
+        except OSError as e:
+            logging.debug(f"can not reflink {src} to {dst}: {e}, fall back")
+            self.can_reflink = False
+            if os.path.lexists(dst):
+                os.remove(dst)
+            return False
+        shutil.copystat(src, dst)
+        return True
+
+    def copy_file(self, src, dst, hardlink):
+        """copy src to dst by install mode, return how it is copied"""
+        if self.mode == "link":
+            if self.can_reflink and self.reflink(src, dst):
+                return "reflink"
+            if hardlink:
+                try:
+                    os.link(src, dst)
+                    return "hardlink"
+                except OSError as e:
+                    # like install_dir on another filesystem
+                    logging.debug(f"can not hardlink {src} to {dst}: {e}, fall back")
+        shutil.copy2(src, dst)
+        return "copy"
+
+    def install_file(self, rel, strip_cmd):
+        """copy(and strip) one file from stage dir to install dir, return the log line"""
+        src = os.path.join(self.stage_dir, rel)
+        dst = os.path.join(self.install_dir, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        time_s = time.time()
+        if os.path.islink(src):
+            link = os.readlink(src)
+            if os.path.islink(dst) and os.readlink(dst) == link:
+                return None
+            tmp = f"{dst}.cmake_one.tmp"
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.symlink(link, tmp)
+            os.replace(tmp, dst)
+            return f"link: {rel} -> {link}"
+        strip = self.strip and strip_cmd
+        if not strip and os.path.isfile(dst) and os.path.samefile(src, dst):
+            # hardlinked by last install, cmake already write the new content
+            return f"hardlink: {rel}"
+        tmp = f"{dst}.cmake_one.tmp"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        action = self.copy_file(src, tmp, not strip)
+        if strip:
+            subprocess.check_call([*strip_cmd, tmp])
+            action = f"{action} and strip({os.path.getsize(src)} -> {os.path.getsize(tmp)} bytes)"
+        os.replace(tmp, dst)
+        return f"{action}: {rel} cost: {time.time() - time_s:.3f}s"
+
+    def run(self):
+        time_s = time.time()
+        files = self.stage()
+        strip_rules = self.strip_rules() if self.strip else {}
+        manifest = {}
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+        changed = []
+        for rel in files:
+            dst = os.path.join(self.install_dir, rel)
+            old = manifest.get(rel)
+            if (
+                old
+                and os.path.lexists(dst)
+                and old[0] == self.file_stat(os.path.join(self.stage_dir, rel))
+                and old[1] == self.file_stat(dst)
+            ):
+                continue
+            changed.append(rel)
+        new_manifest = {rel: manifest[rel] for rel in files if rel in manifest}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = {
+                rel: pool.submit(self.install_file, rel, strip_rules.get(rel))
+                for rel in changed
+            }
+            for rel, future in futures.items():
+                msg = future.result()
+                if msg:
+                    logging.info(f"install: {msg}")
+                new_manifest[rel] = [
+                    self.file_stat(os.path.join(self.stage_dir, rel)),
+                    self.file_stat(os.path.join(self.install_dir, rel)),
+                ]
+        with open(self.manifest_file, "w") as f:
+            json.dump(new_manifest, f, indent=2)
+        logging.info(
+            f"install to {self.install_dir}: {len(changed)} changed, {len(files) - len(changed)} up to date, mode: {self.mode}, jobs: {self.jobs}, cost: {time.time() - time_s:.2f}s"
+        )
+
+
+class MemoryBuildDir:
+    """build dir on a RAM backed dir like tmpfs /dev/shm, for build dirs on slow disks
+
+    the build dir in memory is memory_dir/cmake_one/<name>-<hash of persistent build dir>,
+    it is the same for each run, so the snapshot can be restored to the same path which is
+    recorded in CMakeCache.txt, install dir and compile_commands.json are in the persistent
+    build dir, snapshot is persistent build dir/SNAPSHOT_DIR, synced by size and mtime, as
+    ninja check outputs by mtime
+    """
+
+    SNAPSHOT_DIR = "cmake_one_memory_snapshot"
+    # written after the snapshot is complete
+    SNAPSHOT_DONE = "cmake_one_memory_snapshot.done"
+    # written when a build start in memory, a snapshot older than it is stale
+    LAST_BUILD_FILE = "cmake_one_memory_last_build"
+    # warn when memory dir have less free space than it and the size of build dir is unknown
+    MIN_FREE_SIZE = 1 << 30
+
+    def __init__(self, persistent_dir, build_dir):
+        self.persistent_dir = persistent_dir
+        self.build_dir = build_dir
+        self.snapshot_dir = os.path.join(persistent_dir, self.SNAPSHOT_DIR)
+        self.done_file = os.path.join(persistent_dir, self.SNAPSHOT_DONE)
+        self.last_build_file = os.path.join(persistent_dir, self.LAST_BUILD_FILE)
+
+    @staticmethod
+    def memory_build_dir(persistent_dir, memory_dir):
+        assert memory_dir and os.path.isdir(
+            memory_dir
+        ), f"error config: --memory_dir {memory_dir} not exist, please set it to a tmpfs or RAM disk"
+        key = hashlib.sha256(persistent_dir.encode()).hexdigest()[:12]
+        return os.path.join(
+            os.path.abspath(memory_dir),
+            "cmake_one",
+            f"{os.path.basename(persistent_dir)}-{key}",
+        )
+
+    @staticmethod
+    def sync(src, dst):
+        """make dst the same as src, only copy the files changed by size or mtime, return (copied, removed)"""
+        copied = 0
+        removed = 0
+        for root, dirs, files in os.walk(src):
+            dst_root = os.path.join(dst, os.path.relpath(root, src))
+            if os.path.islink(dst_root) or os.path.isfile(dst_root):
+                os.remove(dst_root)
+            os.makedirs(dst_root, exist_ok=True)
+            names = set(dirs + files)
+            for name in os.listdir(dst_root):
+                if name in names:
+                    continue
+                path = os.path.join(dst_root, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+            for name in names:
+                s = os.path.join(root, name)
+                d = os.path.join(dst_root, name)
+                if os.path.islink(s):
+                    link = os.readlink(s)
+                    if os.path.islink(d) and os.readlink(d) == link:
+                        continue
+                elif os.path.isdir(s):
+                    # os.walk will create it
+                    continue
+                elif (
+                    os.path.isfile(d)
+                    and not os.path.islink(d)
+                    and IncrementalInstall.file_stat(s)
+                    == IncrementalInstall.file_stat(d)
+                ):
+                    continue
+                if os.path.isdir(d) and not os.path.islink(d):
+                    shutil.rmtree(d)
+                elif os.path.lexists(d):
+                    os.remove(d)
+                if os.path.islink(s):
+                    os.symlink(os.readlink(s), d)
+                else:
+                    shutil.copy2(s, d)
+                copied += 1
+        return copied, removed
+
+    def expected_size(self, install_dir):
+        """size of the build dir in memory, 0 if not built
+
+        it is the size of the snapshot, or of the persistent build dir which may be built on disk before
+        """
+        if os.path.isfile(self.done_file):
+            return Trash.dir_size(self.snapshot_dir)
+        skip = {os.path.abspath(install_dir), os.path.abspath(self.snapshot_dir)}
+        size = 0
+        for root, dirs, files in os.walk(self.persistent_dir):
+            dirs[:] = [d for d in dirs if os.path.join(root, d) not in skip]
+            for f in files:
+                try:
+                    size += os.lstat(os.path.join(root, f)).st_size
+                except OSError:
+                    pass
+        return size
+
+    def check_space(self, install_dir):
+        """fail before build if the memory dir is smaller than the build dir, instead of ENOSPC in build"""
+        memory_dir = self.build_dir
+        while not os.path.exists(memory_dir):
+            memory_dir = os.path.dirname(memory_dir)
+        need = self.expected_size(install_dir)
+        # the build dir in memory is reused
+        free = shutil.disk_usage(memory_dir).free + Trash.dir_size(self.build_dir)
+        logging.debug(f"memory dir {memory_dir} free: {free}, build dir need: {need}")
+        assert (
+            free >= need
+        ), f"error config: memory dir {memory_dir} only have {free >> 20}M free, but the build dir need about {need >> 20}M(the size of the last build), please use a larger tmpfs(like docker run --shm-size or --tmpfs) or another --memory_dir"
+        if not need and free < self.MIN_FREE_SIZE:
+            logging.warning(
+                f"memory dir {memory_dir} only have {free >> 20}M free, the build may fail with no space left on device, please use a larger tmpfs(like docker run --shm-size or --tmpfs) or another --memory_dir"
+            )
+
+    def mark_build(self):
+        with open(self.last_build_file, "w") as f:
+            f.write(f"{time.time()}\n")
+
+    def restore(self):
+        """restore the snapshot to a new build dir in memory, for example after reboot"""
+        if os.path.isfile(os.path.join(self.build_dir, "CMakeCache.txt")):
+            return False
+        if not os.path.isfile(self.done_file):
+            return False
+        if os.path.isfile(self.last_build_file) and os.path.getmtime(
+            self.last_build_file
+        ) > os.path.getmtime(self.done_file):
+            logging.warning(
+                f"memory snapshot {self.snapshot_dir} is older than the last build in memory at {time.ctime(os.path.getmtime(self.last_build_file))}, restore it anyway, ninja rebuild the outputs older than their inputs, add --memory_snapshot to every build to keep it up to date"
+            )
+        time_s = time.time()
+        copied, _ = self.sync(self.snapshot_dir, self.build_dir)
+        logging.info(
+            f"restore memory build dir {self.build_dir} from {self.snapshot_dir}, {copied} files, cost: {time.time() - time_s:.2f}s"
+        )
+        return True
+
+    def snapshot(self):
+        time_s = time.time()
+        if os.path.isfile(self.done_file):
+            os.remove(self.done_file)
+        copied, removed = self.sync(self.build_dir, self.snapshot_dir)
+        with open(self.done_file, "w") as f:
+            f.write(f"{self.build_dir}\n")
+        logging.info(
+            f"snapshot memory build dir to {self.snapshot_dir}, copied: {copied} removed: {removed}, cost: {time.time() - time_s:.2f}s"
+        )
+
+    def remove_snapshot(self, trash):
+        if os.path.isfile(self.done_file):
+            os.remove(self.done_file)
+        trash.remove(self.snapshot_dir)
+
+    def write_back(self):
+        """compile_commands.json of the build dir to the persistent build dir"""
+        src = os.path.join(self.build_dir, CompileDatabase.FILE_NAME)
+        dst = os.path.join(self.persistent_dir, CompileDatabase.FILE_NAME)
+        if os.path.isfile(src) and not (
+            os.path.isfile(dst) and filecmp.cmp(src, dst, shallow=False)
+        ):
+            shutil.copy2(src, dst)
+            logging.debug(f"write back {src} to {dst}")
+
+
+class FileWatcher:
+    """wait for changed files under a dir by inotify, fallback to polling if inotify is not available
+
+    skip_dirs, symlinks and the build/install dirs made by cmake_one in the top dir are not watched
+    """
+
+    # see sys/inotify.h
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_DONT_FOLLOW = 0x2000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (
+        IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_ONLYDIR
+        | IN_DONT_FOLLOW
+    )
+    EVENT = struct.Struct("iIII")
+    SKIP_NAMES = (".git",)
+    # editor swap and backup files
+    SKIP_SUFFIXES = ("~", ".swp", ".swx")
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, top_dir, skip_dirs=(), debounce=0.2):
+        self.top_dir = os.path.realpath(top_dir)
+        self.skip_dirs = {os.path.realpath(d) for d in skip_dirs}
+        self.debounce = debounce
+        self.fd = None
+        self.wds = {}
+        # created in this wait, for temp files
+        self.created = set()
+        self.snapshot = None
+        try:
+            self.init_inotify()
+        except OSError as e:
+            self.fallback_to_polling(e)
+
+    def skip(self, path):
+        name = os.path.basename(path)
+        if name in self.SKIP_NAMES or name.endswith(self.SKIP_SUFFIXES):
+            return True
+        if os.path.dirname(path) == self.top_dir and ArtifactCache.is_generated(name):
+            return True
+        return path in self.skip_dirs or os.path.islink(path)
+
+    def walk(self, top):
+        for root, dirs, files in os.walk(top):
+            dirs[:] = [d for d in dirs if not self.skip(os.path.join(root, d))]
+            yield root, [f for f in files if not self.skip(os.path.join(root, f))]
+
+    def init_inotify(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(f"no inotify on {sys.platform}")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self.fd = fd
+        for root, _ in self.walk(self.top_dir):
+            self.add_watch(root)
+        logging.debug(f"inotify watch {len(self.wds)} dirs of {self.top_dir}")
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # removed before watch
+            if err in [errno.ENOENT, errno.ENOTDIR]:
+                return
+            # ENOSPC: more dirs than fs.inotify.max_user_watches
+            raise OSError(err, f"inotify_add_watch {path}: {os.strerror(err)}")
+        self.wds[wd] = path
+
+    def fallback_to_polling(self, reason):
+        logging.warning(
+            f"can not watch by inotify: {reason}, fallback to polling every {self.POLL_INTERVAL}s"
+        )
+        self.close()
+        self.snapshot = self.scan()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.wds = {}
+
+    def scan(self):
+        snapshot = {}
+        for root, files in self.walk(self.top_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def read_events(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # lost events, so treat all as changed
+                changed.add(self.top_dir)
+                continue
+            if mask & self.IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+            if wd not in self.wds or not name:
+                continue
+            path = os.path.join(self.wds[wd], name)
+            if self.skip(path):
+                continue
+            changed.add(path)
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.created.add(path)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                # files may be created in the new dir before the watch
+                for root, files in self.walk(path):
+                    self.add_watch(root)
+                    changed.update(os.path.join(root, f) for f in files)
+        return changed
+
+    def changes(self, timeout):
+        """changed paths in timeout seconds, block until changed if timeout is None"""
+        if self.fd is not None:
+            try:
+                return self.read_events(timeout)
+            except OSError as e:
+                self.fallback_to_polling(e)
+                return {self.top_dir}
+        time.sleep(self.POLL_INTERVAL if timeout is None else timeout)
+        snapshot = self.scan()
+        old, self.snapshot = self.snapshot, snapshot
+        return {
+            p for p in old.keys() | snapshot.keys() if old.get(p) != snapshot.get(p)
+        }
+
+    def wait(self):
+        """block until files changed and no more changes in debounce seconds, return the changed paths"""
+        changed = set()
+        while True:
+            new = self.changes(self.debounce if changed else None)
+            if changed and not new:
+                # temp files created and removed, for example by cmake or editors
+                changed = {
+                    p for p in changed if p not in self.created or os.path.lexists(p)
+                }
+                self.created.clear()
+                if changed:
+                    return changed
+            changed |= new
+
+
+class BuildMonitor:
+    """run the phases of a build, show ninja progress with ETA and write events as JSON lines
+
+    ETA is the remaining edges by the mean edge time in .ninja_log of the last build,
+    divided by the edge time finished per second in this build
+
+    events: build_start, phase_start, edge(from .ninja_log, with duration), progress,
+    error(FAILED edges of ninja or output tail of a failed phase), phase_end, build_end
+
+    the output is written to a log file with stderr merged, or to the terminal with stderr
+    not touched, then stdout is a pty if out is a terminal, so ninja still show the status
+    in one line and keep the colors of compilers
+    """
+
+    # set NINJA_STATUS to this, in case of user custom one
+    NINJA_STATUS = "[%f/%t] "
+    STATUS_RE = re.compile(r"^\[(\d+)/(\d+)\] (.*)$")
+    # escape codes of the terminal, like colors and erase line of ninja status
+    ESCAPE_RE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+    TAIL_LINES = 50
+    events_lock = threading.Lock()
+
+    def __init__(
+        self, name, build_dir, out, events_file=None, interval=10, merge_stderr=True
+    ):
+        """out: binary file to write the output of phases, merge_stderr: also write stderr to out"""
+        self.name = name
+        self.build_dir = build_dir
+        self.out = out
+        self.events_file = events_file
+        self.interval = interval
+        self.merge_stderr = merge_stderr
+        self.lock = threading.Lock()
+
+    @property
+    def ninja_log(self):
+        return os.path.join(self.build_dir, ".ninja_log")
+
+    def event(self, event, **kwargs):
+        if not self.events_file:
+            return
+        line = json.dumps(
+            {
+                "time": round(time.time(), 3),
+                "target": self.name,
+                "event": event,
+                **kwargs,
+            }
+        )
+        with self.events_lock:
+            with open(self.events_file, "a") as f:
+                f.write(line + "\n")
+
+    def read_ninja_log(self, offset=0):
+        """return ([(output, start_ms, end_ms)], offset of end), only whole lines are read"""
+        entries = []
+        if not os.path.isfile(self.ninja_log):
+            return entries, 0
+        with open(self.ninja_log, "rb") as f:
+            # ninja recompact the log at start
+            if os.fstat(f.fileno()).st_size < offset:
+                offset = 0
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode(errors="replace").splitlines():
+            parts = line.split("\t")
+            if len(parts) == 5 and not line.startswith("#"):
+                entries.append((parts[3], int(parts[0]), int(parts[1])))
+        return entries, offset + end
+
+    def start_ninja(self):
+        entries, self.log_offset = self.read_ninja_log()
+        # the last duration of each output
+        self.history = {output: end - start for output, start, end in entries}
+        self.mean = (
+            sum(self.history.values()) / len(self.history) if self.history else 1
+        )
+        self.finished = 0
+        self.total = 0
+        self.done_work = 0
+        self.last_edge_time = self.start_time = self.work_start_time = time.time()
+        self.failed = None
+        self.stop = threading.Event()
+        self.ticker = threading.Thread(target=self.tick, daemon=True)
+        self.ticker.start()
+
+    def stop_ninja(self):
+        self.flush_error()
+        self.stop.set()
+        self.ticker.join()
+        self.tail_ninja_log()
+        self.progress()
+
+    def tail_ninja_log(self):
+        if not self.events_file:
+            return
+        entries, self.log_offset = self.read_ninja_log(self.log_offset)
+        for output, start, end in entries:
+            self.event(
+                "edge",
+                output=output,
+                start_ms=start,
+                end_ms=end,
+                duration_ms=end - start,
+            )
+
+    def eta(self):
+        with self.lock:
+            elapsed = time.time() - self.work_start_time
+            if not self.finished or not self.done_work or elapsed <= 0:
+                return None
+            remaining = max(0, self.total - self.finished) * self.mean
+            return remaining / (self.done_work / elapsed)
+
+    def progress(self):
+        eta = self.eta()
+        elapsed = time.time() - self.start_time
+        idle = time.time() - self.last_edge_time
+        percent = 100 * self.finished / self.total if self.total else 0
+        logging.info(
+            f"{self.name} progress: {self.finished}/{self.total} ({percent:.0f}%), elapsed: {elapsed:.0f}s, eta: {'unknown' if eta is None else f'{eta:.0f}s'}, no edge finished in: {idle:.0f}s"
+        )
+        self.event(
+            "progress",
+            finished=self.finished,
+            total=self.total,
+            elapsed=round(elapsed, 3),
+            eta=None if eta is None else round(eta, 3),
+            idle=round(idle, 3),
+        )
+
+    def tick(self):
+        last_progress = time.time()
+        while not self.stop.wait(1):
+            self.tail_ninja_log()
+            if time.time() - last_progress >= self.interval:
+                last_progress = time.time()
+                self.progress()
+
+    def flush_error(self):
+        if self.failed:
+            output, lines = self.failed
+            self.event("error", phase="build", output=output, message="\n".join(lines))
+            self.failed = None
+
+    def ninja_line(self, line):
+        m = self.STATUS_RE.match(line)
+        if m:
+            self.flush_error()
+            finished, total, description = int(m.group(1)), int(m.group(2)), m.group(3)
+            with self.lock:
+                # ninja restart the count after rerun cmake, the work done before is not of the new total
+                if total != self.total:
+                    self.done_work = 0
+                    self.work_start_time = time.time()
+                # a smart terminal also show the status when an edge start
+                if finished > self.finished or total != self.total:
+                    self.last_edge_time = time.time()
+                    # the output is the last word of cmake descriptions, like: Building CXX object a.o
+                    self.done_work += self.history.get(
+                        description.split(" ")[-1], self.mean
+                    )
+                self.finished, self.total = finished, total
+            return
+        if line.startswith("FAILED: "):
+            self.flush_error()
+            # new ninja print: FAILED: [code=1] output
+            output = re.sub(r"^\[code=\d+\]\s*", "", line[len("FAILED: ") :].strip())
+            self.failed = (output, [])
+        elif line.startswith("ninja: "):
+            self.flush_error()
+        elif self.failed and len(self.failed[1]) < self.TAIL_LINES * 4:
+            self.failed[1].append(line)
+
+    def open_pty(self):
+        """return (master, slave) of a new pty with the size of out, None if out is not a terminal"""
+        if pty is None or self.merge_stderr or not self.out.isatty():
+            return None
+        master, slave = pty.openpty()
+        try:
+            size = fcntl.ioctl(self.out.fileno(), termios.TIOCGWINSZ, b"\0" * 8)
+            fcntl.ioctl(slave, termios.TIOCSWINSZ, size)
+        except OSError:
+            pass
+        return master, slave
+
+    @staticmethod
+    def read_pty(master):
+        """yield the output of pty until all writers are closed"""
+        try:
+            while True:
+                try:
+                    data = os.read(master, 1 << 16)
+                except OSError:
+                    # EIO of linux when the slave is closed
+                    break
+                if not data:
+                    break
+                yield data
+        finally:
+            os.close(master)
+
+    def run_phase(self, phase, script, env, on_start=None):
+        """run script of phase by bash, return the exit code"""
+        self.event("phase_start", phase=phase)
+        logging.debug(f"{self.name} phase: {phase}")
+        time_s = time.time()
+        ninja = phase == "build"
+        if ninja:
+            env = dict(env, NINJA_STATUS=self.NINJA_STATUS)
+        stdout = subprocess.PIPE
+        stderr = subprocess.STDOUT if self.merge_stderr else None
+        terminal = self.open_pty()
+        if terminal:
+            stdout = terminal[1]
+        # new session, so the whole process group (bash, ninja, compilers) can be stopped
+        p = subprocess.Popen(
+            ["bash", "-c", script],
+            cwd=self.build_dir,
+            env=env,
+            stdout=stdout,
+            stderr=stderr,
+            start_new_session=on_start is not None,
+        )
+        if terminal:
+            os.close(terminal[1])
+        if on_start:
+            on_start(p)
+        if ninja:
+            self.start_ninja()
+        tail = collections.deque(maxlen=self.TAIL_LINES)
+
+        def handle(raw):
+            line = self.ESCAPE_RE.sub("", raw.decode(errors="replace"))
+            tail.append(line)
+            if ninja:
+                self.ninja_line(line)
+
+        # lines end with \r in pty, like the status of ninja, all output is written at once
+        pending = b""
+        for data in self.read_pty(terminal[0]) if terminal else p.stdout:
+            self.out.write(data)
+            self.out.flush()
+            *lines, pending = re.split(rb"[\r\n]", pending + data)
+            for raw in lines:
+                if raw.strip():
+                    handle(raw)
+        if pending.strip():
+            handle(pending)
+        ret = p.wait()
+        if ninja:
+            self.stop_ninja()
+        elif ret != 0:
+            self.event("error", phase=phase, message="\n".join(tail))
+        self.event(
+            "phase_end",
+            phase=phase,
+            returncode=ret,
+            cost=round(time.time() - time_s, 3),
+        )
+        return ret
+
+
+class BuildConfig(argparse.Namespace):
+    """options of one build, the same as the command line options of cmake_one.py
+
+    options not specified use the command line defaults, for example:
+        BuildConfig("cross_build", cross_build_target_os="LINUX", build_type="Debug")
+
+    the defaults are parsed by a new parser each time, as some of them are from env,
+    so configs can be made in any thread
+    """
+
+    def __init__(self, sub_command="host_build", **kwargs):
+        assert sub_command in [
+            "host_build",
+            "cross_build",
+        ], f"BuildConfig only support host_build and cross_build, not: {sub_command}"
+        super().__init__(**vars(Build().parser().parse_args([sub_command])))
+        for k, v in kwargs.items():
+            assert hasattr(self, k), f"unknown option: {k} for {sub_command}"
+            setattr(self, k, v)
+
+
+class BuildPlan:
+    """resolved commands of one build, made by Build.plan() and run by Build.execute()"""
+
+    CONFIG_FINGERPRINT_FILE = "cmake_one_config.fingerprint"
+    PROJECT_INCLUDE_FILE = "cmake_one_project_include.cmake"
+    SETTINGS_FILE = "cmake_one_build_settings.json"
+
+    def __init__(self, config):
+        self.config = config
+        # the same as the default build dir name, also used as log name by Build.execute_plans
+        if config.sub_command == "cross_build":
+            self.name = f"{config.cross_build_target_os}-{config.cross_build_target_arch}-{config.build_type}"
+        else:
+            self.name = f"host-{config.build_type}"
+            if config.build_for_32bit:
+                self.name = f"{self.name}-32bit"
+        self.repo_dir = config.repo_dir
+        self.build_dir = config.build_dir
+        self.install_dir = config.install_dir
+        # extra env of config.sh
+        self.env = {}
+        # commands to setup toolchain env, run before cmake and ninja
+        self.env_cmds = []
+        self.cmake_cmd = ""
+        # commands run after cmake, before ninja
+        self.post_configure_cmds = []
+        self.compile_db_cmd = ""
+        self.ninja = "ninja"
+        self.ninja_cmd = ""
+        # commands run once before and after ninja in the build phase, not by --watch rebuild
+        self.pre_build_cmds = []
+        self.post_ninja_cmds = []
+        # install changed artifacts after ninja, by --incremental_install
+        self.install_cmd = ""
+        self.post_build_cmds = []
+        self.fingerprint = ""
+        self.qnx_license = None
+        # cmake code run after every project() call by CMAKE_PROJECT_INCLUDE
+        self.project_include = ""
+        # build settings recorded in build dir, like debug info and linker
+        self.settings = {}
+        # compiler launcher of --dist_workers
+        self.dist_launcher = None
+        # key of --artifact_cache, None if disabled
+        self.artifact_cache_key = None
+        # the build dir not in memory, by --build_in_memory
+        self.persistent_build_dir = None
+        # key of --probe_cache, None if disabled
+        self.probe_cache_key = None
+
+    @property
+    def fingerprint_file(self):
+        return os.path.join(self.build_dir, self.CONFIG_FINGERPRINT_FILE)
+
+    @property
+    def project_include_file(self):
+        return os.path.join(self.build_dir, self.PROJECT_INCLUDE_FILE)
+
+    def write_project_include(self):
+        """write project include file only when changed, as CMake reruns when it is touched"""
+        path = self.project_include_file
+        # CMAKE_PROJECT_INCLUDE is kept in CMakeCache.txt, so keep the file even if not needed now
+        if not self.project_include and not os.path.exists(path):
+            return
+        # CMake include it after every project() call, the blocks only need to run once, at the first one
+        content = (
+            "# generated by cmake_one, do not edit\ninclude_guard(GLOBAL)\n"
+            + self.project_include
+        )
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                if f.read() == content:
+                    return
+        logging.debug(f"write project include: {path}")
+        with open(path, "w") as f:
+            f.write(content)
+
+    def write_dist_launcher(self):
+        if not self.dist_launcher:
+            return
+        os.makedirs(os.path.dirname(self.dist_launcher), exist_ok=True)
+        with open(self.dist_launcher, "w") as f:
+            f.write(
+                f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" dist_cc "$@"\n'
+            )
+        os.chmod(self.dist_launcher, 0o755)
+
+    def write_settings(self):
+        path = os.path.join(self.build_dir, self.SETTINGS_FILE)
+        logging.debug(f"build settings: {self.settings}, write to: {path}")
+        with open(path, "w") as f:
+            json.dump(self.settings, f, indent=2)
+
+    def need_configure(self):
+        """only rerun cmake when config fingerprint changed, CMake will rerun by ninja if CMakeLists.txt changed"""
+        args = self.config
+        old_fingerprint = ""
+        if os.path.isfile(self.fingerprint_file):
+            with open(self.fingerprint_file, "r") as f:
+                old_fingerprint = f.read().strip()
+        not_call_rerun_cmake = args.not_call_rerun_cmake
+        if args.force_rerun_cmake:
+            logging.debug("force rerun cmake")
+            return True
+        elif not not_call_rerun_cmake:
+            if self.fingerprint == old_fingerprint:
+                logging.debug(
+                    f"config fingerprint not changed: {self.fingerprint}, skip rerun cmake"
+                )
+                not_call_rerun_cmake = True
+            else:
+                logging.debug(
+                    f"config fingerprint changed: {old_fingerprint or None} -> {self.fingerprint}, need rerun cmake"
+                )
+        elif self.fingerprint != old_fingerprint:
+            logging.warning(
+                f"config fingerprint changed: {old_fingerprint or None} -> {self.fingerprint}, but --not_call_rerun_cmake is on, build may use stale cmake config"
+            )
+
+        if not_call_rerun_cmake:
+            if not os.path.exists(os.path.join(self.build_dir, "CMakeCache.txt")):
+                not_call_rerun_cmake = False
+                logging.debug(
+                    f"need call rerun cmake, but CMakeCache.txt not exist, so call cmake again"
+                )
+            if not os.path.exists(os.path.join(self.build_dir, "build.ninja")):
+                not_call_rerun_cmake = False
+                logging.debug(
+                    f"need call rerun cmake, but build.ninja not exist, so call cmake again"
+                )
+        return not not_call_rerun_cmake
+
+    def phases(self, configure=True):
+        """[(phase, commands)] of the build, run with env_cmds one by one"""
+        phases = []
+        if configure:
+            phases.append(
+                (
+                    "configure",
+                    [
+                        # remove the old fingerprint first, a failed cmake run should not leave a valid one
+                        f"rm -f {self.fingerprint_file}",
+                        self.cmake_cmd,
+                        *self.post_configure_cmds,
+                        # update compile_commands.json even if the build failed
+                        self.compile_db_cmd,
+                        f"echo {self.fingerprint} > {self.fingerprint_file}",
+                    ],
+                )
+            )
+        phases.append(
+            ("build", [*self.pre_build_cmds, self.ninja_cmd, *self.post_ninja_cmds])
+        )
+        if self.install_cmd:
+            phases.append(("install", [self.install_cmd]))
+        if self.post_build_cmds:
+            phases.append(("post_build", list(self.post_build_cmds)))
+        return phases
+
+    def phase_sh(self, cmds):
+        lines = ["#!/bin/bash", "set -ex", *self.env_cmds, *cmds]
+        return "\n".join(lines) + "\n"
+
+    def config_sh(self, configure=True):
+        """all phases in one script, to run the build by hand"""
+        return self.phase_sh([c for _, cmds in self.phases(configure) for c in cmds])
+
+    def ninja_sh(self):
+        """only env, ninja and install, for rebuild of --watch, pre_build_cmds and post_ninja_cmds are skipped"""
+        lines = ["#!/bin/bash", "set -e", *self.env_cmds, self.ninja_cmd]
+        if self.install_cmd:
+            lines.append(self.install_cmd)
+        return "\n".join(lines) + "\n"
+
+
 class Build:
     BUILD_ENV = "Linux"
     NINJA_BASE = "ninja"
@@ -60,6 +2914,88 @@ class Build:
 
     msvcenv_native_config_cmd = ""
     qnx_native_config_cmd = ""
+    compiler_cache_env_cmd = ""
+    compiler_cache_zero_stats_cmd = ""
+    compiler_cache_stats_cmd = ""
+    qnx_license = None
+    plan_env = {}
+    project_include = []
+    build_settings = {}
+
+    # state of one plan, reset before make a new plan, plan() of all threads hold this lock
+    plan_lock = threading.Lock()
+    PLAN_STATE = [
+        "NINJA_INSTALL_STR",
+        "NINJA_VERBOSE",
+        "toolchains_config",
+        "NINJA_JOBS",
+        "NINJA_TARGET",
+        "CMAKE_C_FLAGS_CONFIG",
+        "CMAKE_CXX_FLAGS_CONFIG",
+        "msvcenv_native_config_cmd",
+        "qnx_native_config_cmd",
+        "compiler_cache_env_cmd",
+        "compiler_cache_zero_stats_cmd",
+        "compiler_cache_stats_cmd",
+        "qnx_license",
+        "plan_env",
+        "project_include",
+        "build_settings",
+    ]
+
+    BUILD_REPORT_FILE = "cmake_one_build_report.json"
+    # toolchain env which may change the toolchain without changing cmake args
+    CONFIG_FINGERPRINT_ENVS = [
+        "NDK_ROOT",
+        "OHOS_NDK_ROOT",
+        "MSVC_SDK_DST",
+        "QNX_SDP_ROOT",
+        "QNX_SDP710_ROOT",
+        "QNX_SDP800_ROOT",
+        "ARM_GNU_TOOLCHAIN_PATH",
+        "HEXAGON_SDK_ROOT_PATH",
+    ]
+
+    # -g1 is the same as -gline-tables-only for clang
+    DEBUG_INFO_FLAGS = {
+        "none": "",
+        "line-tables": "-g1",
+        "full": "-g",
+        "split-dwarf": "-g -gsplit-dwarf",
+        "compressed": "-g -gz",
+    }
+    DEBUG_INFO_ELF_ONLY = ["split-dwarf", "compressed"]
+    # value of CMAKE_LINKER_TYPE
+    LINKER_TYPES = {"bfd": "BFD", "gold": "GOLD", "lld": "LLD", "mold": "MOLD"}
+    LINKER_TYPE_MIN_CMAKE = (3, 29)
+    LINKER_BINS = {"bfd": "ld.bfd", "gold": "ld.gold", "lld": "ld.lld", "mold": "mold"}
+    # linkers can be selected for the toolchain, others use the linker of toolchain self
+    TOOLCHAIN_LINKERS = {
+        "host-Linux": ["bfd", "gold", "lld", "mold"],
+        "LINUX": ["bfd", "gold", "lld", "mold"],
+        "ANDROID": ["lld"],
+        "OHOS": ["lld"],
+    }
+    # toolchains build by clang, LINUX is clang only with --force_clang
+    TIME_TRACE_TOOLCHAINS = [
+        "host-Linux",
+        "host-Darwin",
+        "ANDROID",
+        "OHOS",
+        "IOS",
+        "WINDOWS",
+        "LINUX",
+    ]
+
+    SIZE_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    # ninja pool of link steps, defined by CMAKE_JOB_POOLS
+    LINK_JOB_POOL = "cmake_one_link"
+    # cache var of the depth of link pool
+    LINK_JOBS_VAR = "CMAKE_ONE_LINK_JOBS"
+
+    DEFAULT_COMPILER_CACHE_DIR = os.path.join(
+        os.path.expanduser("~"), ".cache", "cmake_one", "compiler_cache"
+    )
 
     def code_not_imp():
         raise CODE_NOT_IMP
@@ -73,8 +3009,600 @@ class Build:
             self.NINJA_BASE = "Ninja"
         logging.debug(f"build at host env: {self.BUILD_ENV}")
 
-    def build(self):
-        self.detect_build_env()
+    def parse_matrix_targets(self, targets):
+        """convert matrix target strings to BuildConfig options, return list of (sub_command, options)"""
+        if "all" in targets:
+            targets = []
+            for target_os, archs in self.cross_build_configs.items():
+                if target_os == "IOS" and self.BUILD_ENV != "Darwin":
+                    logging.debug(f"skip IOS targets for 'all' at: {self.BUILD_ENV}")
+                    continue
+                targets += [f"{target_os}-{arch}" for arch in archs]
+
+        ret = []
+        for target in targets:
+            if target == "host":
+                ret.append(("host_build", {}))
+                continue
+            if target == "host-32bit":
+                ret.append(("host_build", {"build_for_32bit": True}))
+                continue
+            # arch may have '-', like armv7-a, so only split the first '-'
+            assert (
+                "-" in target
+            ), f"error config matrix target: {target}, format should be OS-ARCH, like ANDROID-aarch64"
+            target_os, target_arch = target.split("-", 1)
+            assert (
+                target_os in self.cross_build_configs
+            ), f"error config matrix target: {target}, not support os: {target_os} now support one of: {self.cross_build_configs.keys()}"
+            assert (
+                target_arch in self.cross_build_configs[target_os]
+            ), f"error config matrix target: {target}, not support arch: {target_arch} now support one of: {self.cross_build_configs[target_os]}"
+            ret.append(
+                (
+                    "cross_build",
+                    {
+                        "cross_build_target_os": target_os,
+                        "cross_build_target_arch": target_arch,
+                    },
+                )
+            )
+
+        assert len(targets) == len(
+            set(targets)
+        ), f"error config matrix targets: duplicate target in {targets}"
+        return list(zip(targets, ret))
+
+    def build_matrix(self, args):
+        targets = self.parse_matrix_targets(args.targets)
+        args.repo_dir = os.path.abspath(args.repo_dir)
+        assert os.path.isfile(
+            os.path.join(args.repo_dir, "CMakeLists.txt")
+        ), f"error config --repo_dir {args.repo_dir} is not a valid dir: can not find CMakeLists.txt"
+
+        max_parallel = args.max_parallel if args.max_parallel else len(targets)
+        max_parallel = max(1, min(max_parallel, len(targets)))
+        compile_jobs, link_jobs = self.job_limits(args)
+        jobs_budget = args.jobs_budget if args.jobs_budget else compile_jobs
+        # share the cpu and memory between the running targets, so each ninja do not think it own all
+        jobs = max(1, jobs_budget // max_parallel)
+        link_jobs = max(1, link_jobs // max_parallel)
+        log_dir = args.log_dir
+        if log_dir is None:
+            log_dir = os.path.join(args.repo_dir, "build-matrix-logs")
+        log_dir = os.path.abspath(log_dir)
+        logging.info(
+            f"matrix build {len(targets)} targets, max_parallel: {max_parallel}, jobs_budget: {jobs_budget}, ninja jobs of each target: {jobs}, link jobs of each target: {link_jobs}, logs at: {log_dir}"
+        )
+
+        plans = []
+        results = {}
+        for name, (sub_command, options) in targets:
+            config = BuildConfig(sub_command, **options)
+            # global options before 'matrix' are used by all targets
+            for k, v in vars(args).items():
+                if hasattr(config, k) and k != "sub_command":
+                    setattr(config, k, v)
+            # each target have its own build dir, install dir and jobs
+            config.ninja_jobs = jobs
+            config.link_jobs = link_jobs
+            config.install_dir = None
+            config.build_dir = None
+            if args.build_dir:
+                config.build_dir = os.path.join(
+                    os.path.abspath(args.build_dir), f"build-{name}-{args.build_type}"
+                )
+            # repo/build and repo/install link can only point to one target
+            config.not_do_link_build_and_install = True
+            try:
+                plan = self.plan(config)
+            except (AssertionError, CODE_NOT_IMP) as e:
+                logging.error(f"target: {name} config failed: {e}")
+                results[name] = ("failed", 0.0, "")
+                continue
+            plan.name = name
+            plans.append(plan)
+        if args.fail_fast and results:
+            plans = []
+
+        time_s = time.time()
+        results.update(self.execute_plans(plans, max_parallel, args.fail_fast, log_dir))
+        time_e = time.time()
+
+        logging.info("matrix build summary:")
+        failed = []
+        for name, _ in targets:
+            status, cost, log_file = results.get(name, ("skipped", 0.0, ""))
+            if status != "success":
+                failed.append(name)
+            logging.info(f"    {name:<24} {status:<8} {cost:>8.2f}s {log_file}")
+        logging.info(
+            f"matrix build done, cost: {time_e - time_s:.2f}s, sum of targets: {sum(i[1] for i in results.values()):.2f}s"
+        )
+        assert not failed, f"matrix build failed for targets: {failed}"
+
+    @classmethod
+    def parse_size(cls, size):
+        """parse size like 512M, 4G to bytes"""
+        m = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)B?", size.strip().upper())
+        assert m, f"error config size: {size}, format like 512M, 4G"
+        return int(float(m.group(1)) * cls.SIZE_UNITS.get(m.group(2), 1))
+
+    def read_cgroup(self, v2_name, v1_controller, v1_name):
+        """read limit of cgroup v2 or v1 of this process, None if not found"""
+        paths = {}
+        if os.path.isfile("/proc/self/cgroup"):
+            with open("/proc/self/cgroup", "r") as f:
+                for line in f:
+                    parts = line.strip().split(":", 2)
+                    if len(parts) != 3:
+                        continue
+                    for controller in parts[1].split(","):
+                        paths[controller] = parts[2].lstrip("/")
+        candidates = [
+            os.path.join("/sys/fs/cgroup", paths.get("", ""), v2_name),
+            os.path.join(
+                "/sys/fs/cgroup", v1_controller, paths.get(v1_controller, ""), v1_name
+            ),
+            # cgroup of the container is mounted as root in docker
+            os.path.join("/sys/fs/cgroup", v2_name),
+            os.path.join("/sys/fs/cgroup", v1_controller, v1_name),
+        ]
+        for path in candidates:
+            if os.path.isfile(path):
+                with open(path, "r") as f:
+                    return f.read().strip()
+        return None
+
+    def available_cpus(self):
+        """cpus can be used by this process, with cpu affinity and cgroup cpu quota"""
+        if hasattr(os, "sched_getaffinity"):
+            cpus = len(os.sched_getaffinity(0))
+        else:
+            cpus = os.cpu_count() or 1
+        quota = None
+        cpu_max = self.read_cgroup("cpu.max", "cpu", "cpu.cfs_quota_us")
+        if cpu_max and cpu_max.split()[0] not in ["max", "-1"]:
+            quota = int(cpu_max.split()[0])
+            period = cpu_max.split()[1] if len(cpu_max.split()) > 1 else None
+            if period is None:
+                # cgroup v1 have period in another file
+                period = self.read_cgroup("cpu.max", "cpu", "cpu.cfs_period_us")
+            cpus = min(cpus, max(1, quota // int(period)))
+        return cpus
+
+    def available_memory(self):
+        """physical memory can be used by this process, with cgroup memory limit, None if unknown"""
+        memory = None
+        if hasattr(os, "sysconf") and "SC_PHYS_PAGES" in os.sysconf_names:
+            memory = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        limit = self.read_cgroup("memory.max", "memory", "memory.limit_in_bytes")
+        # cgroup v1 use a huge number for no limit
+        if limit and limit.isdigit() and (memory is None or int(limit) < memory):
+            memory = int(limit)
+        return memory
+
+    def job_limits(self, args):
+        """return (compile jobs, link jobs) by cpu and memory, --ninja_jobs and --link_jobs take precedence"""
+        cpus = self.available_cpus()
+        memory = self.available_memory()
+        # ASAN objects and links need about double memory
+        scale = 2 if args.ASAN else 1
+        compile_jobs = args.ninja_jobs or cpus
+        link_jobs = args.link_jobs or compile_jobs
+        if memory:
+            compile_memory = self.parse_size(args.compile_job_memory) * scale
+            link_memory = self.parse_size(args.link_job_memory) * scale
+            if not args.ninja_jobs:
+                compile_jobs = max(1, min(compile_jobs, memory // compile_memory))
+            if not args.link_jobs:
+                link_jobs = max(1, min(link_jobs, memory // link_memory))
+        logging.debug(
+            f"cpus: {cpus}, memory: {memory}, compile jobs: {compile_jobs}, link jobs: {link_jobs}"
+        )
+        return compile_jobs, link_jobs
+
+    def compiler_cache_namespace(self, args):
+        """cache dir name for the toolchain, objects build by different toolchain or ASAN type never share one cache dir"""
+        if args.sub_command == "cross_build":
+            name = f"{args.cross_build_target_os}-{args.cross_build_target_arch}"
+            if args.force_clang:
+                name = f"{name}-clang"
+        else:
+            name = f"host-{self.BUILD_ENV}"
+            if args.build_for_32bit:
+                name = f"{name}-32bit"
+        if args.ASAN:
+            name = f"{name}-{args.ASAN}"
+        # toolchains_config have toolchain file, ABI and sdk path, so changing any of them will use a new cache dir
+        key = f"{self.toolchains_config} {self.ASAN_CMAKE_CONFIG[args.ASAN]} {args.cuda_arch}"
+        return f"{name}-{hashlib.sha1(key.encode()).hexdigest()[:8]}"
+
+    def config_compiler_cache(self, args):
+        """config ccache env for config.sh and return the cmake launcher flags"""
+        ccache = shutil.which("ccache")
+        assert (
+            ccache
+        ), "can not find ccache, please install it(apt install ccache) or remove --compiler_cache"
+        cache_root = args.compiler_cache_dir
+        if cache_root is None:
+            cache_root = os.environ.get(
+                "CMAKE_ONE_COMPILER_CACHE_DIR", self.DEFAULT_COMPILER_CACHE_DIR
+            )
+        cache_dir = os.path.join(
+            os.path.abspath(cache_root), self.compiler_cache_namespace(args)
+        )
+        os.makedirs(cache_dir, exist_ok=True)
+        logging.debug(f"use compiler cache dir: {cache_dir}")
+
+        # ccache evicts the least recently used objects when CCACHE_MAXSIZE of the namespace dir is exceeded
+        # CCACHE_BASEDIR makes objects build from different checkout of repo can be shared
+        self.compiler_cache_env_cmd = (
+            f'export CCACHE_DIR="{cache_dir}"\n'
+            f"export CCACHE_MAXSIZE={args.compiler_cache_max_size}\n"
+            f'export CCACHE_BASEDIR="{args.repo_dir}"'
+        )
+        # reset once before ninja, env cmd is run by every phase, so stats can not be reset there
+        self.compiler_cache_zero_stats_cmd = f"{ccache} --zero-stats"
+        self.compiler_cache_stats_cmd = f"{ccache} --show-stats"
+        config = f" -DCMAKE_C_COMPILER_LAUNCHER={ccache} -DCMAKE_CXX_COMPILER_LAUNCHER={ccache}"
+        if args.cuda_arch:
+            config = config + f" -DCMAKE_CUDA_COMPILER_LAUNCHER={ccache}"
+        return config
+
+    def target_os(self, args):
+        if args.sub_command == "cross_build":
+            return args.cross_build_target_os
+        return f"host-{self.BUILD_ENV}"
+
+    def cmake_version(self):
+        out = subprocess.check_output(["cmake", "--version"], text=True)
+        return tuple(int(i) for i in re.search(r"(\d+)\.(\d+)", out).groups())
+
+    def config_debug_info(self, args):
+        """return the debug info flags of C and CXX, split dwarf and compressed debug info are only for ELF"""
+        debug_info = args.debug_info
+        if debug_info in self.DEBUG_INFO_ELF_ONLY and self.target_os(args) in [
+            "WINDOWS",
+            "IOS",
+            "host-Darwin",
+            "host-Windows",
+        ]:
+            logging.warning(
+                f"--debug_info {debug_info} is only for ELF, use full debug info for {self.target_os(args)}"
+            )
+            debug_info = "full"
+        self.build_settings["debug_info"] = debug_info
+        return self.DEBUG_INFO_FLAGS[debug_info]
+
+    def config_time_trace(self, args, cmake_config):
+        """return the flags of C and CXX to write clang time trace next to each object"""
+        self.build_settings["time_trace"] = False
+        if not args.time_trace:
+            return ""
+        target_os = self.target_os(args)
+        compilers = re.findall(
+            r"-DCMAKE_(?:C|CXX)_COMPILER=\"?([^\s\"]+)", cmake_config
+        )
+        if target_os not in self.TIME_TRACE_TOOLCHAINS or (
+            target_os == "LINUX" and not args.force_clang
+        ):
+            logging.warning(
+                f"--time_trace need clang, but {target_os} is not build by clang, skip it, support: {self.TIME_TRACE_TOOLCHAINS}(LINUX need --force_clang)"
+            )
+            return ""
+        # user may override the compiler by --cmake_options
+        if compilers and "clang" not in os.path.basename(compilers[-1]):
+            logging.warning(
+                f"--time_trace need clang, but compiler is {compilers[-1]}, skip it"
+            )
+            return ""
+        self.build_settings["time_trace"] = True
+        return f" -ftime-trace -ftime-trace-granularity={args.time_trace_granularity}"
+
+    def config_linker(self, args):
+        """return the cmake flags to select linker, empty if not supported by the toolchain"""
+        target_os = self.target_os(args)
+        self.build_settings["linker"] = "default"
+        if args.linker is None:
+            return ""
+        if args.linker not in self.TOOLCHAIN_LINKERS.get(target_os, []):
+            logging.warning(
+                f"--linker {args.linker} is not supported for {target_os}, use the default linker of toolchain, support: {self.TOOLCHAIN_LINKERS}"
+            )
+            return ""
+        # NDK have its own lld
+        if target_os in ["host-Linux", "LINUX"] and not shutil.which(
+            self.LINKER_BINS[args.linker]
+        ):
+            logging.warning(
+                f"can not find {self.LINKER_BINS[args.linker]}, use the default linker of toolchain"
+            )
+            return ""
+        cmake_version = self.cmake_version()
+        assert (
+            cmake_version >= self.LINKER_TYPE_MIN_CMAKE
+        ), f"error config: --linker need CMake >= 3.29 for CMAKE_LINKER_TYPE, now is {cmake_version}, please update cmake"
+        self.build_settings["linker"] = args.linker
+        return f" -DCMAKE_LINKER_TYPE={self.LINKER_TYPES[args.linker]}"
+
+    def config_dist(self, args, local_jobs):
+        """return (the cmake flags to compile by DistCompiler, jobs of available workers)"""
+        token = os.environ.get("CMAKE_ONE_DIST_TOKEN", "")
+        assert (
+            token
+        ), "error config: --dist_workers need export CMAKE_ONE_DIST_TOKEN, the same as the workers"
+        workers = DistCompiler.ping_workers(args.dist_workers.split(), token)
+        remote_jobs = sum(workers.values())
+        if not workers:
+            logging.warning("no dist worker is available, compile locally")
+        logging.info(f"dist workers: {workers}, remote jobs: {remote_jobs}")
+        dist_dir = os.path.join(args.build_dir, DistCompiler.DIST_DIR)
+        # workers are passed by env, so the cmake args not changed when workers are not available
+        self.plan_env["CMAKE_ONE_DIST_WORKERS"] = " ".join(workers)
+        self.plan_env["CMAKE_ONE_DIST_LOCAL_JOBS"] = str(local_jobs)
+        self.plan_env["CMAKE_ONE_DIST_DIR"] = dist_dir
+        self.build_settings["remote_jobs"] = remote_jobs
+        launcher = os.path.join(dist_dir, DistCompiler.LAUNCHER)
+        if args.compiler_cache:
+            # ccache run it to compile when cache miss
+            self.plan_env["CCACHE_PREFIX"] = launcher
+            return "", remote_jobs
+        return (
+            f" -DCMAKE_C_COMPILER_LAUNCHER={launcher} -DCMAKE_CXX_COMPILER_LAUNCHER={launcher}",
+            remote_jobs,
+        )
+
+    def config_link_pool(self, args, compile_jobs, link_jobs):
+        """links use more memory than compiles, limit them by a ninja pool when link jobs are less
+
+        the pool is added to the pools of the project by project include, the depth is not
+        in config fingerprint, so a new depth is used when cmake rerun, but never force it
+        """
+        if link_jobs >= compile_jobs:
+            return ""
+        if "CMAKE_JOB_POOL_LINK" in (args.cmake_options or ""):
+            logging.warning(
+                f"CMAKE_JOB_POOL_LINK is set by --cmake_options, do not limit link jobs to {link_jobs}"
+            )
+            return ""
+        pool = self.LINK_JOB_POOL
+        self.project_include.append(f"""if(NOT CMAKE_JOB_POOL_LINK)
+  set(CMAKE_JOB_POOL_LINK {pool})
+endif()
+# keep the pools of the project, which may be set after project()
+function(cmake_one_link_pool)
+  get_property(pools GLOBAL PROPERTY JOB_POOLS)
+  if(NOT pools AND CMAKE_JOB_POOLS)
+    set(pools ${{CMAKE_JOB_POOLS}})
+  endif()
+  set_property(GLOBAL PROPERTY JOB_POOLS ${{pools}} {pool}=${{{self.LINK_JOBS_VAR}}})
+endfunction()
+if(CMAKE_VERSION VERSION_LESS 3.19)
+  cmake_one_link_pool()
+else()
+  cmake_language(DEFER DIRECTORY "${{CMAKE_SOURCE_DIR}}" CALL cmake_one_link_pool)
+endif()
+""")
+        return f" -D{self.LINK_JOBS_VAR}={link_jobs}"
+
+    def config_unity_build(self, args):
+        """return the cmake flags of unity build, exclude targets by project include"""
+        assert (
+            args.unity_batch_size >= 0
+        ), f"error config --unity_batch_size {args.unity_batch_size}, should >= 0"
+        config = f" -DCMAKE_UNITY_BUILD=ON -DCMAKE_UNITY_BUILD_BATCH_SIZE={args.unity_batch_size}"
+        if args.unity_exclude_targets:
+            # targets are not created when project() is called, so defer to the end of top level CMakeLists.txt
+            targets = " ".join(args.unity_exclude_targets.split())
+            self.project_include.append(f"""if(CMAKE_VERSION VERSION_LESS 3.19)
+  message(FATAL_ERROR "cmake_one: --unity_exclude_targets need CMake >= 3.19")
+endif()
+function(cmake_one_unity_exclude)
+  foreach(target IN ITEMS {targets})
+    if(NOT TARGET ${{target}})
+      message(WARNING "cmake_one: --unity_exclude_targets ${{target}} is not a target")
+      continue()
+    endif()
+    get_target_property(aliased ${{target}} ALIASED_TARGET)
+    if(aliased)
+      set(target ${{aliased}})
+    endif()
+    set_target_properties(${{target}} PROPERTIES UNITY_BUILD OFF)
+  endforeach()
+endfunction()
+cmake_language(DEFER DIRECTORY "${{CMAKE_SOURCE_DIR}}" CALL cmake_one_unity_exclude)
+""")
+        return config
+
+    def config_pch(self, args):
+        """include the generated pch cmake file, return the command to generate it after cmake"""
+        assert (
+            args.pch_max_headers > 0
+        ), f"error config --pch_max_headers {args.pch_max_headers}, should > 0"
+        assert (
+            0 < args.pch_min_ratio <= 1
+        ), f"error config --pch_min_ratio {args.pch_min_ratio}, should in (0, 1]"
+        pch_cmake = os.path.join(args.build_dir, PrecompiledHeader.CMAKE_FILE)
+        # create an empty one at the first time, so CMake rerun by ninja when it is generated
+        self.project_include.append(f"""if(CMAKE_VERSION VERSION_LESS 3.19)
+  message(FATAL_ERROR "cmake_one: --pch need CMake >= 3.19")
+endif()
+if(NOT EXISTS "{pch_cmake}")
+  file(WRITE "{pch_cmake}" "")
+endif()
+function(cmake_one_pch_include)
+  include("{pch_cmake}")
+endfunction()
+cmake_language(DEFER DIRECTORY "${{CMAKE_SOURCE_DIR}}" CALL cmake_one_pch_include)
+""")
+        return f"{sys.executable} {os.path.abspath(__file__)} --repo_dir {args.repo_dir} --build_dir {args.build_dir} --pch_max_headers {args.pch_max_headers} --pch_min_ratio {args.pch_min_ratio} pch"
+
+    def post_build_report(self, report, *report_args):
+        """run a report of a successful build, errors are logged as warning instead of failing the build"""
+        try:
+            report(*report_args)
+        except Exception as e:
+            logging.warning(
+                f"{report.__name__} of {report_args} failed: {type(e).__name__}: {e}, skip it"
+            )
+
+    def unity_build_summary(self, build_dir):
+        """count source files folded into unity sources generated by CMake"""
+        targets = set()
+        units = 0
+        sources = 0
+        # only the unity sources in compile database, stale ones of excluded targets are left in build dir
+        for entry in CompileDatabase().load(build_dir):
+            path = os.path.join(entry["directory"], entry["file"])
+            # CMake write unity sources to CMakeFiles/<target>.dir/Unity/unity_<N>_<lang>.<ext>
+            unity_dir = os.path.dirname(path)
+            if os.path.basename(unity_dir) != "Unity" or not os.path.isfile(path):
+                continue
+            targets.add(os.path.dirname(unity_dir))
+            units += 1
+            with open(path, "r", errors="replace") as f:
+                sources += sum(1 for line in f if line.startswith("#include"))
+        logging.info(
+            f"unity build: {sources} source files folded into {units} translation units of {len(targets)} targets, {sources - units} translation units saved"
+        )
+        return sources, units, len(targets)
+
+    def build_report(self, build_dir, top=10, report_json=None):
+        assert os.path.isdir(build_dir), f"build dir: {build_dir} not exist"
+        report = BuildReport(build_dir, self.NINJA_BASE).generate(top)
+        logging.info(BuildReport.format_text(report))
+        if report_json is None:
+            report_json = os.path.join(build_dir, self.BUILD_REPORT_FILE)
+        with open(report_json, "w") as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"build report json: {report_json}")
+
+    def time_trace_report(self, build_dir, top=10, report_json=None):
+        assert os.path.isdir(build_dir), f"build dir: {build_dir} not exist"
+        report = TimeTrace(build_dir).generate(top)
+        logging.info(TimeTrace.format_text(report))
+        if report_json is None:
+            report_json = os.path.join(build_dir, TimeTrace.REPORT_FILE)
+        with open(report_json, "w") as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"time trace report json: {report_json}")
+
+    def incremental_install(self, build_dir, install_dir, strip, mode="copy"):
+        assert os.path.isfile(
+            os.path.join(build_dir, "cmake_install.cmake")
+        ), f"can not find cmake_install.cmake in {build_dir}, please build it first"
+        IncrementalInstall(build_dir, install_dir, strip, mode=mode).run()
+
+    @staticmethod
+    def relocate(text, path_names):
+        """replace the paths in text by their names"""
+        # the longest first, build dir may be in repo dir
+        for path in sorted(path_names, key=len, reverse=True):
+            text = text.replace(path, path_names[path])
+        return text
+
+    def config_fingerprint(self, config_cmds, plan_env, path_names=None):
+        """hash of all things which need cmake rerun when changed
+
+        path_names: {path: name}, hash the names instead of the paths, the files are still read by path
+        """
+        path_names = path_names or {}
+        env = dict(os.environ, **plan_env)
+        h = hashlib.sha256()
+        for cmd in config_cmds:
+            h.update(f"cmd:{self.relocate(cmd, path_names)}\n".encode())
+        # toolchain file contents, include user specify by --cmake_options
+        for toolchain in re.findall(
+            r"-DCMAKE_TOOLCHAIN_FILE=\"?([^\s\"]+)", " ".join(config_cmds)
+        ):
+            h.update(f"toolchain:{self.relocate(toolchain, path_names)}\n".encode())
+            if os.path.isfile(toolchain):
+                with open(toolchain, "rb") as f:
+                    h.update(f.read())
+        for k in self.CONFIG_FINGERPRINT_ENVS:
+            value = env.get(k)
+            if value is not None:
+                value = self.relocate(value, path_names)
+            h.update(f"env:{k}={value}\n".encode())
+        for k in sorted(env):
+            if k.startswith("CMAKE_ONE_PRFIX_"):
+                h.update(f"env:{k}={self.relocate(env[k], path_names)}\n".encode())
+        # cmake upgrade need rerun cmake
+        cmake = shutil.which("cmake")
+        if cmake:
+            h.update(f"cmake:{cmake}:{os.stat(cmake).st_mtime_ns}\n".encode())
+        return h.hexdigest()
+
+    def artifact_cache_key(self, plan):
+        """hash of source tree, config, compilers and install target
+
+        the paths of repo, build and install dir are not hashed, so other checkouts and CI runners can hit
+        """
+        source = ArtifactCache.source_fingerprint(
+            plan.repo_dir,
+            [os.path.realpath(plan.build_dir), os.path.realpath(plan.install_dir)],
+        )
+        if source is None:
+            logging.warning(
+                f"{plan.repo_dir} is not a git repo, can not use --artifact_cache"
+            )
+            return None
+        path_names = {
+            os.path.abspath(__file__): "<cmake_one>",
+            sys.executable: "<python>",
+        }
+        for path, name in [
+            (plan.repo_dir, "<repo_dir>"),
+            (plan.build_dir, "<build_dir>"),
+            (plan.install_dir, "<install_dir>"),
+        ]:
+            for p in {path, os.path.abspath(path), os.path.realpath(path)}:
+                path_names[p] = name
+        config = self.config_fingerprint(
+            [
+                re.sub(rf"\s-D{self.LINK_JOBS_VAR}=\d+", "", plan.cmake_cmd),
+                self.msvcenv_native_config_cmd,
+                self.qnx_native_config_cmd,
+                plan.project_include,
+                *plan.post_configure_cmds,
+            ],
+            plan.env,
+            path_names,
+        )
+        h = hashlib.sha256(f"source:{source}\nconfig:{config}\n".encode())
+        install_cmd = self.relocate(plan.install_cmd, path_names)
+        h.update(f"ninja:{self.NINJA_INSTALL_STR}\ninstall:{install_cmd}\n".encode())
+        # compilers in toolchain files are covered by the toolchain env in fingerprint
+        compilers = re.findall(
+            r"-DCMAKE_(?:C|CXX)_COMPILER=\"?([^\s\"]+)", plan.cmake_cmd
+        )
+        if not compilers and "CMAKE_TOOLCHAIN_FILE" not in plan.cmake_cmd:
+            env = dict(os.environ, **plan.env)
+            compilers = [env.get("CC", "cc"), env.get("CXX", "c++")]
+        for compiler in compilers:
+            path = shutil.which(compiler)
+            compiler_id = DistCompiler.compiler_id(path) if path else None
+            h.update(
+                f"compiler:{self.relocate(compiler, path_names)}:{compiler_id}\n".encode()
+            )
+        return h.hexdigest()
+
+    def probe_cache_key(self, plan):
+        """config fingerprint without the paths of build dir, which do not change toolchain probes"""
+        cmake_cmd = re.sub(
+            r'\s-(H|B|DCMAKE_INSTALL_PREFIX=|DCMAKE_PROJECT_INCLUDE=)"[^"]*"',
+            "",
+            plan.cmake_cmd,
+        )
+        cmake_cmd = re.sub(rf"\s-D{self.LINK_JOBS_VAR}=\d+", "", cmake_cmd)
+        return self.config_fingerprint(
+            [cmake_cmd, self.msvcenv_native_config_cmd, self.qnx_native_config_cmd],
+            plan.env,
+        )
+
+    def parser(self):
+        """command line options, also the defaults of BuildConfig"""
         parser = argparse.ArgumentParser(description="build tools for cmake project")
         parser.add_argument(
             "--build_type",
@@ -86,7 +3614,7 @@ class Build:
         parser.add_argument(
             "--remove_old_build",
             action="store_true",
-            help="remove old build dir before build, default off",
+            help=f"remove old build dir before build, the old dirs are moved to {Trash.DIR_NAME} in the parent dir and deleted in background, default off",
         )
         parser.add_argument(
             "--not_do_link_build_and_install",
@@ -111,6 +3639,31 @@ class Build:
             ),
             help="repo dir, default is os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_repo'), you can specify it for build other repo",
         )
+        parser.add_argument(
+            "--build_root",
+            type=str,
+            default=os.environ.get("CMAKE_ONE_BUILD_ROOT"),
+            help="parent dir of the default build dirs instead of repo_dir, for example a docker volume or a faster disk, the default install dirs are still repo_dir/build-xxx/install, default is env CMAKE_ONE_BUILD_ROOT or None",
+        )
+        parser.add_argument(
+            "--build_in_memory",
+            action="store_true",
+            help="build in a dir under --memory_dir for slow disks, only install dir and compile_commands.json are in build_dir, default off",
+        )
+        parser.add_argument(
+            "--memory_dir",
+            type=str,
+            default=os.environ.get(
+                "CMAKE_ONE_MEMORY_DIR",
+                "/dev/shm" if os.path.isdir("/dev/shm") else None,
+            ),
+            help="tmpfs or RAM disk for --build_in_memory, its free space is checked against the size of the last build before build, default is env CMAKE_ONE_MEMORY_DIR or /dev/shm, run_in_docker.py mount a tmpfs for it, as /dev/shm of docker is only 64M",
+        )
+        parser.add_argument(
+            "--memory_snapshot",
+            action="store_true",
+            help=f"sync the build dir in memory to build_dir/{MemoryBuildDir.SNAPSHOT_DIR} after build, and restore it when the build dir in memory is lost, for example after reboot, so incremental build still work, the snapshot is only updated by builds with this option, a warning is shown when restore a snapshot older than the last build, default off",
+        )
         parser.add_argument(
             "--build_dir",
             type=str,
@@ -128,7 +3681,31 @@ class Build:
             "--ninja_jobs",
             type=int,
             default=None,
-            help="ninja jobs, default is None, will use system cpu count",
+            help="ninja jobs, default is None, will use the cpu count, limited by --compile_job_memory and cgroup limits of the container",
+        )
+        parser.add_argument(
+            "--compile_job_memory",
+            type=str,
+            default="1G",
+            help="memory of one compile job, ninja jobs are limited to memory / compile_job_memory when --ninja_jobs is not specify, doubled for ASAN, default is 1G",
+        )
+        parser.add_argument(
+            "--link_jobs",
+            type=int,
+            default=None,
+            help="max link jobs at the same time by a ninja pool, default is None, will use memory / link_job_memory",
+        )
+        parser.add_argument(
+            "--link_job_memory",
+            type=str,
+            default="4G",
+            help="memory of one link job, doubled for ASAN, default is 4G",
+        )
+        parser.add_argument(
+            "--ninja_load_average",
+            type=float,
+            default=None,
+            help="ninja do not start new jobs when load average is greater than it(ninja -l), default is None",
         )
 
         parser.add_argument(
@@ -155,7 +3732,12 @@ class Build:
         parser.add_argument(
             "--not_call_rerun_cmake",
             action="store_true",
-            help="do not call rerun cmake, default off, if on, will not call cmake again, just run ninja, this is a fast build mode, do not worry about this option, as ninja will check if need to call cmake again",
+            help="do not call rerun cmake, default off, if on, will not call cmake again, just run ninja, this is a fast build mode, do not worry about this option, as ninja will check if need to call cmake again. Note: even without this option, cmake_one will skip cmake when the config fingerprint(cmake args, toolchain file, toolchain env) is not changed, so this option is only needed to force skip cmake when config changed",
+        )
+        parser.add_argument(
+            "--force_rerun_cmake",
+            action="store_true",
+            help="always rerun cmake even if the config fingerprint is not changed, default off",
         )
 
         parser.add_argument(
@@ -165,6 +3747,200 @@ class Build:
             help='Specify the CUDA architecture, e.g. "61;75" or "native", default is None. Currently supports host_build and cross_build with aarch64-linux.',
         )
 
+        parser.add_argument(
+            "--merge_compile_db_dirs",
+            type=str,
+            default=None,
+            help='other build dirs to merge into repo_dir/compile_commands.json, files already in this build are skipped, dirs without compile_commands.json are skipped with a warning, for example: merge host build for files only build for host, split by space if more than one, for example: "build-host-Release build-LINUX-aarch64-Release"',
+        )
+
+        parser.add_argument(
+            "--build_report",
+            action="store_true",
+            help=f"show build profile after build and write it to build_dir/{self.BUILD_REPORT_FILE}, default off, also can run with sub command: report",
+        )
+
+        parser.add_argument(
+            "--compiler_cache",
+            action="store_true",
+            help="use ccache as compiler launcher for all toolchains, default off, each toolchain and ASAN type use its own cache dir, so they never collide",
+        )
+        parser.add_argument(
+            "--compiler_cache_dir",
+            type=str,
+            default=None,
+            help=f"compiler cache root dir, if not specify, will use env CMAKE_ONE_COMPILER_CACHE_DIR or {self.DEFAULT_COMPILER_CACHE_DIR}",
+        )
+        parser.add_argument(
+            "--compiler_cache_max_size",
+            type=str,
+            default="20G",
+            help="max size of each compiler cache namespace dir (one for each toolchain and ASAN type) in the cache root dir, not of the whole root dir, so the disk use is up to this size times the number of namespaces, least recently used objects will be evicted when exceed, default is 20G",
+        )
+
+        parser.add_argument(
+            "--dist_workers",
+            type=str,
+            default=None,
+            help='compile on dist workers(run by sub command: worker), split by space, for example: "192.168.1.10:3633 192.168.1.11:3633", ninja jobs are increased by the jobs of available workers, compiles fall back to local when workers are not available or the flags are not in the allowlist of code generation flags, workers and client must export the same CMAKE_ONE_DIST_TOKEN to auth, default is None',
+        )
+
+        parser.add_argument(
+            "--events_file",
+            type=str,
+            default=None,
+            help="append build events as JSON lines to this file: build_start, phase_start, edge(with duration), progress, error, phase_end, build_end, all events have time, target and event, default is None",
+        )
+
+        parser.add_argument(
+            "--progress_interval",
+            type=int,
+            default=10,
+            help="show ninja progress and ETA every these seconds, default is 10",
+        )
+
+        parser.add_argument(
+            "--trash_max_size",
+            type=str,
+            default="20G",
+            help="--remove_old_build move old dirs to a trash dir and delete them in background, the oldest ones are deleted at once when trash is larger than this, default is 20G",
+        )
+
+        parser.add_argument(
+            "--probe_cache",
+            action="store_true",
+            help="cache the toolchain probes(compiler identification, ABI detection, check results) of cmake by toolchain file, compilers and flags, and seed new build dirs with them, cache is invalid when compilers changed, default off",
+        )
+
+        parser.add_argument(
+            "--probe_cache_dir",
+            type=str,
+            default=os.environ.get(
+                "CMAKE_ONE_PROBE_CACHE_DIR",
+                os.path.join(os.path.expanduser("~"), ".cache", "cmake_one", "probes"),
+            ),
+            help="dir of --probe_cache, default is env CMAKE_ONE_PROBE_CACHE_DIR or ~/.cache/cmake_one/probes",
+        )
+
+        parser.add_argument(
+            "--watch",
+            action="store_true",
+            help="keep running after build, rebuild when files in repo dir are changed, only run ninja for source changes, rerun cmake when CMakeLists.txt, *.cmake or toolchain files are changed, only for host_build and cross_build, default off",
+        )
+
+        parser.add_argument(
+            "--watch_debounce",
+            type=int,
+            default=200,
+            help="--watch wait for no more changes in these milliseconds before rebuild, default is 200",
+        )
+
+        parser.add_argument(
+            "--artifact_cache",
+            action="store_true",
+            help="restore install dir from artifact cache when source(git tree and dirty files), config and compilers are not changed, instead of build, store install dir to cache after build, only for git repo, default off",
+        )
+
+        parser.add_argument(
+            "--artifact_cache_dir",
+            type=str,
+            default=os.environ.get(
+                "CMAKE_ONE_ARTIFACT_CACHE_DIR",
+                os.path.join(
+                    os.path.expanduser("~"), ".cache", "cmake_one", "artifacts"
+                ),
+            ),
+            help="dir of --artifact_cache, default is env CMAKE_ONE_ARTIFACT_CACHE_DIR or ~/.cache/cmake_one/artifacts",
+        )
+
+        parser.add_argument(
+            "--artifact_cache_max_size",
+            type=str,
+            default="50G",
+            help="evict least recently used artifacts when cache is larger than this, default is 50G",
+        )
+
+        parser.add_argument(
+            "--artifact_cache_max_age",
+            type=int,
+            default=30,
+            help="evict artifacts not used for these days, default is 30",
+        )
+
+        parser.add_argument(
+            "--debug_info",
+            type=str,
+            choices=list(self.DEBUG_INFO_FLAGS.keys()),
+            default="full",
+            help="debug info of all build types, line-tables is enough for backtrace and profile with much smaller objects and faster link, split-dwarf(.dwo files in build dir) and compressed are only for ELF, default is full",
+        )
+        parser.add_argument(
+            "--incremental_install",
+            action="store_true",
+            help=f"replace ninja install/strip by: ninja, then only copy and strip the artifacts changed since the last install, strip in parallel and log each installed file, the last install is recorded in build_dir/{IncrementalInstall.MANIFEST_FILE}, default off",
+        )
+        parser.add_argument(
+            "--install_mode",
+            type=str,
+            choices=IncrementalInstall.MODES,
+            default="copy",
+            help="how to install files, link: reflink(copy on write) if the filesystem support, else hardlink, stripped files are reflinked or copied, then stripped, link enable --incremental_install, default is copy",
+        )
+        parser.add_argument(
+            "--time_trace",
+            action="store_true",
+            help=f"compile with clang -ftime-trace, then show the most expensive headers, template instantiations and compile phases of the whole build and write it to build_dir/{TimeTrace.REPORT_FILE}, only for clang toolchains: {self.TIME_TRACE_TOOLCHAINS}(LINUX need --force_clang), default off, also can run with sub command: time_trace",
+        )
+        parser.add_argument(
+            "--time_trace_granularity",
+            type=int,
+            default=500,
+            help="minimum time in microseconds of the events in time trace, smaller value give more details but bigger traces, default is 500",
+        )
+        parser.add_argument(
+            "--linker",
+            type=str,
+            choices=list(self.LINKER_TYPES.keys()),
+            default=None,
+            help=f"linker used by the toolchain, need CMake >= 3.29, only support: {self.TOOLCHAIN_LINKERS}, others use the default linker of toolchain, default is None",
+        )
+
+        parser.add_argument(
+            "--unity_build",
+            action="store_true",
+            help="enable CMake unity(jumbo) build for all targets, default off, reduce clean build time for template heavy sources",
+        )
+        parser.add_argument(
+            "--unity_batch_size",
+            type=int,
+            default=8,
+            help="max source files folded into one unity translation unit, 0 means all sources of one target, default is 8",
+        )
+        parser.add_argument(
+            "--unity_exclude_targets",
+            type=str,
+            default=None,
+            help='targets not use unity build, for example targets whose sources have conflict static symbols, split by space if more than one, for example: "api_module api_module_obj", need CMake >= 3.19',
+        )
+
+        parser.add_argument(
+            "--pch",
+            action="store_true",
+            help="precompile the hot system and third party headers of each target, default off, headers are analysed from compile_commands.json after cmake, and check the pch is reused after build, need CMake >= 3.19, Note: the headers are only analysed again when cmake_one rerun cmake(config fingerprint changed or --force_rerun_cmake), not when ninja rerun cmake, so use --force_rerun_cmake to update the pch after the includes of sources changed",
+        )
+        parser.add_argument(
+            "--pch_max_headers",
+            type=int,
+            default=32,
+            help="max headers in the pch of one target, default is 32",
+        )
+        parser.add_argument(
+            "--pch_min_ratio",
+            type=float,
+            default=0.5,
+            help="only headers included by at least this ratio of the translation units of one target are precompiled, default is 0.5",
+        )
+
         sub_parser = parser.add_subparsers(
             dest="sub_command", help="sub command for build", required=True
         )
@@ -198,10 +3974,325 @@ class Build:
             action="store_true",
             help="build for 32bit, default off, only support for host build",
         )
-        args = parser.parse_args()
 
-        if args.ninja_jobs:
-            self.NINJA_JOBS = f"-j{args.ninja_jobs}"
+        matrix_p = sub_parser.add_parser(
+            "matrix",
+            help="build many targets in one invocation, all global options before 'matrix' are passed to every target",
+        )
+        matrix_p.add_argument(
+            "--targets",
+            type=str,
+            nargs="+",
+            required=True,
+            help=f"targets to build, format: OS-ARCH (like ANDROID-aarch64, LINUX-armv7-a), 'host', 'host-32bit' or 'all' for all cross targets, now support: {self.cross_build_configs}",
+        )
+        matrix_p.add_argument(
+            "--max_parallel",
+            type=int,
+            default=None,
+            help="max targets build at the same time, default is None, will build all targets at the same time",
+        )
+        matrix_p.add_argument(
+            "--jobs_budget",
+            type=int,
+            default=None,
+            help="total ninja jobs shared by all running targets, default is None, will use the cpu count limited by memory as --ninja_jobs, link jobs are shared too",
+        )
+        matrix_p.add_argument(
+            "--fail_fast",
+            action="store_true",
+            help="stop the whole matrix when any target failed, default off",
+        )
+        matrix_p.add_argument(
+            "--log_dir",
+            type=str,
+            default=None,
+            help="dir to save per target build log, if not specify, will use repo_dir/build-matrix-logs",
+        )
+        report_p = sub_parser.add_parser(
+            "report",
+            help="show build profile of the last build from .ninja_log: slowest compile and link steps, parallelism over time and critical path",
+        )
+        report_p.add_argument(
+            "--top",
+            type=int,
+            default=10,
+            help="show top N slowest steps, default is 10",
+        )
+        report_p.add_argument(
+            "--report_json",
+            type=str,
+            default=None,
+            help=f"write report as json to this file, if not specify, will use build_dir/{self.BUILD_REPORT_FILE}",
+        )
+        install_p = sub_parser.add_parser(
+            "install",
+            help="install the changed artifacts of --build_dir to --install_dir, and strip them in parallel, run after build by --incremental_install",
+        )
+        install_p.add_argument(
+            "--strip",
+            action="store_true",
+            help="strip the installed targets, the same as ninja install/strip, default off",
+        )
+        time_trace_p = sub_parser.add_parser(
+            "time_trace",
+            help="show the most expensive headers, template instantiations and compile phases from the clang time traces of the last build with --time_trace",
+        )
+        time_trace_p.add_argument(
+            "--top",
+            type=int,
+            default=10,
+            help="show top N headers, templates and units, default is 10",
+        )
+        time_trace_p.add_argument(
+            "--report_json",
+            type=str,
+            default=None,
+            help=f"write report as json to this file, if not specify, will use build_dir/{TimeTrace.REPORT_FILE}",
+        )
+        worker_p = sub_parser.add_parser(
+            "worker",
+            help="run a dist worker daemon to compile for --dist_workers, need the same compilers(path and version) as the client, for example run in the same docker image",
+        )
+        worker_p.add_argument(
+            "--listen",
+            type=str,
+            default="127.0.0.1:3633",
+            help="address to listen, default is 127.0.0.1:3633, always need export CMAKE_ONE_DIST_TOKEN, the same as the clients",
+        )
+        worker_p.add_argument(
+            "--worker_compilers",
+            type=str,
+            required=True,
+            help='absolute paths of the compilers this worker can run, the same paths as the compilers of the clients, split by space, for example: "/usr/bin/clang /usr/bin/clang++", requests of other compilers are refused',
+        )
+        worker_p.add_argument(
+            "--worker_jobs",
+            type=int,
+            default=None,
+            help="max compile jobs of this worker, default is None, will use the cpu count",
+        )
+        sub_parser.add_parser(
+            "dist_cc",
+            help="compiler launcher of --dist_workers, usage: dist_cc compiler args...",
+        )
+        sub_parser.add_parser(
+            "pch",
+            help=f"generate build_dir/{PrecompiledHeader.CMAKE_FILE} from compile_commands.json, run by --pch after cmake",
+        )
+        clean_trash_p = sub_parser.add_parser(
+            "clean_trash",
+            help="delete the old build dirs moved to trash by --remove_old_build, run in background by cmake_one",
+        )
+        clean_trash_p.add_argument(
+            "--trash_dir",
+            type=str,
+            required=True,
+            help=f"the trash dir, like {{repo_dir}}/{Trash.DIR_NAME}",
+        )
+        compile_db_p = sub_parser.add_parser(
+            "compile_db",
+            help="merge compile_commands.json of build dirs to one file, with path remaps, only write when content changed",
+        )
+        compile_db_p.add_argument(
+            "--compile_db_dirs",
+            type=str,
+            nargs="+",
+            required=True,
+            help="build dirs or compile_commands.json files, for the same file, the former one is used, missing ones are skipped with a warning",
+        )
+        compile_db_p.add_argument(
+            "--output",
+            type=str,
+            default=None,
+            help=f"output file, if not specify, will use repo_dir/{CompileDatabase.FILE_NAME}",
+        )
+        compile_db_p.add_argument(
+            "--remap",
+            type=str,
+            action="append",
+            default=[],
+            help="path remap in format OLD=NEW, can specify many times",
+        )
+        return parser
+
+    def build(self, argv=None):
+        """command line entry, argv is sys.argv[1:] if not specify"""
+        if argv is None:
+            argv = sys.argv[1:]
+        # compiler launcher, do not parse the compile args, they may look like options
+        if argv[:1] == ["dist_cc"]:
+            logging.getLogger().setLevel(logging.WARNING)
+            sys.exit(DistCompiler().run(argv[1:]))
+        self.detect_build_env()
+        args = self.parser().parse_args(argv)
+
+        if args.sub_command == "compile_db":
+            remaps = {}
+            for remap in args.remap:
+                assert "=" in remap, f"error config --remap {remap}, format: OLD=NEW"
+                k, v = remap.split("=", 1)
+                remaps[k] = v
+            output = args.output
+            if output is None:
+                output = os.path.join(
+                    os.path.abspath(args.repo_dir), CompileDatabase.FILE_NAME
+                )
+            CompileDatabase(remaps).write(args.compile_db_dirs, output)
+            return
+        if args.sub_command == "matrix":
+            self.build_matrix(args)
+            return
+        if args.sub_command == "worker":
+            DistWorker(
+                args.worker_jobs or self.available_cpus(),
+                os.environ.get("CMAKE_ONE_DIST_TOKEN", ""),
+                args.worker_compilers.split(),
+            ).serve(args.listen)
+            return
+        if args.sub_command == "clean_trash":
+            Trash(self.parse_size(args.trash_max_size)).clean(args.trash_dir)
+            return
+        if args.sub_command == "pch":
+            assert args.build_dir, "error config: pch need --build_dir"
+            PrecompiledHeader(
+                args.build_dir, args.repo_dir, args.pch_max_headers, args.pch_min_ratio
+            ).generate()
+            return
+        if args.sub_command == "report":
+            build_dir = args.build_dir
+            if build_dir is None:
+                # the link created by last build
+                build_dir = os.path.join(os.path.abspath(args.repo_dir), "build")
+            self.build_report(os.path.realpath(build_dir), args.top, args.report_json)
+            return
+        if args.sub_command == "install":
+            assert (
+                args.build_dir and args.install_dir
+            ), "error config: install need --build_dir and --install_dir"
+            self.incremental_install(
+                os.path.abspath(args.build_dir),
+                os.path.abspath(args.install_dir),
+                args.strip,
+                args.install_mode,
+            )
+            return
+        if args.sub_command == "time_trace":
+            build_dir = args.build_dir
+            if build_dir is None:
+                build_dir = os.path.join(os.path.abspath(args.repo_dir), "build")
+            self.time_trace_report(
+                os.path.realpath(build_dir), args.top, args.report_json
+            )
+            return
+
+        if args.watch:
+            self.watch(args)
+            return
+        self.execute(self.plan(args))
+
+    def watch(self, config):
+        """build, then rebuild when files in repo dir changed until ctrl-c
+
+        only run ninja for source changes, plan and execute again if cmake or toolchain files changed
+        """
+        config = copy.copy(config)
+        plan = self.plan(config)
+        plan, _ = self.watch_build(plan, True)
+        # do not remove the build dir when reconfigure
+        config.remove_old_build = False
+        watcher = FileWatcher(
+            plan.repo_dir,
+            [plan.build_dir, plan.install_dir],
+            config.watch_debounce / 1000,
+        )
+        logging.info(f"watch: {plan.repo_dir}, press ctrl-c to stop")
+        repo_dir = os.path.realpath(plan.repo_dir)
+        # plan again for the next change if failed to reconfigure
+        retry = False
+        try:
+            while True:
+                changed = watcher.wait()
+                toolchains = {
+                    os.path.realpath(t)
+                    for t in re.findall(
+                        r"-DCMAKE_TOOLCHAIN_FILE=\"?([^\s\"]+)", plan.cmake_cmd
+                    )
+                }
+                reconfigure = retry or any(
+                    os.path.basename(p) == "CMakeLists.txt"
+                    or p.endswith(".cmake")
+                    or p in toolchains
+                    or os.path.realpath(p) == repo_dir
+                    for p in changed
+                )
+                logging.info(
+                    f"watch: {len(changed)} changed: {' '.join(sorted(changed)[:3])}{' ...' if len(changed) > 3 else ''}"
+                )
+                plan, ok = self.watch_build(
+                    plan, reconfigure, config if reconfigure else None
+                )
+                retry = reconfigure and not ok
+        except KeyboardInterrupt:
+            logging.info("watch: stopped")
+        finally:
+            watcher.close()
+
+    def watch_build(self, plan, full, config=None):
+        """build once in watch, plan config again if given, only run ninja if not full
+
+        errors are logged to keep watching, return (plan, ok), the previous plan if failed to plan again
+        """
+        time_s = time.time()
+        try:
+            if config is not None:
+                plan = self.plan(config)
+            if full:
+                self.execute(plan)
+            else:
+                ninja_sh = os.path.join(plan.build_dir, "watch.sh")
+                with open(ninja_sh, "w") as f:
+                    f.write(plan.ninja_sh())
+                subprocess.check_call(
+                    ["bash", ninja_sh],
+                    cwd=plan.build_dir,
+                    env=dict(os.environ, **plan.env),
+                )
+        except subprocess.CalledProcessError as e:
+            logging.error(f"watch: build failed with code: {e.returncode}")
+            return plan, False
+        except Exception as e:
+            logging.error(f"watch: build failed: {e!r}")
+            logging.debug("watch: build failed", exc_info=True)
+            return plan, False
+        logging.info(f"watch: build done, cost: {time.time() - time_s:.2f}s")
+        return plan, True
+
+    def reset(self):
+        """reset the state of last plan, so one Build can make many plans"""
+        for attr in self.PLAN_STATE:
+            setattr(self, attr, copy.copy(getattr(Build, attr)))
+
+    def plan(self, config):
+        """resolve toolchain and commands of one build to BuildPlan, config is BuildConfig or parsed command line args
+
+        the state of the plan being made is kept in self, so plan() calls of all threads
+        are run one by one, the returned plans own their state, execute() of them can run
+        at the same time
+        """
+        with self.plan_lock:
+            return self.resolve_plan(config)
+
+    def resolve_plan(self, config):
+        """plan() without lock, only call it by plan()"""
+        self.reset()
+        self.detect_build_env()
+        # do not change config of caller
+        args = copy.copy(config)
+
+        compile_jobs, link_jobs = self.job_limits(args)
+        self.build_settings["compile_jobs"] = compile_jobs
+        self.build_settings["link_jobs"] = link_jobs
 
         if args.ninja_target:
             self.NINJA_TARGET = args.ninja_target
@@ -218,30 +4309,36 @@ class Build:
         ), f"error config --repo_dir {args.repo_dir} is not a valid dir: can not find CMakeLists.txt"
 
         # config build_dir and convert to abs path
+        default_install_dir = None
         if args.build_dir is None:
             if args.sub_command == "cross_build":
-                args.build_dir = os.path.join(
-                    args.repo_dir,
-                    f"build-{args.cross_build_target_os}-{args.cross_build_target_arch}-{args.build_type}",
-                )
+                build_name = f"build-{args.cross_build_target_os}-{args.cross_build_target_arch}-{args.build_type}"
             elif args.sub_command == "host_build":
-                args.build_dir = os.path.join(
-                    args.repo_dir, f"build-host-{args.build_type}"
-                )
+                build_name = f"build-host-{args.build_type}"
                 if args.build_for_32bit:
-                    args.build_dir = os.path.join(
-                        args.repo_dir, f"build-host-{args.build_type}-32bit"
-                    )
+                    build_name = f"build-host-{args.build_type}-32bit"
             else:
                 logging.error(
                     f"code issue happened for: {args.sub_command} please FIXME!!!"
                 )
                 code_not_imp()
+            args.build_dir = os.path.join(args.build_root or args.repo_dir, build_name)
+            # install dir is still in repo dir, build root may be a place can not see from repo dir
+            default_install_dir = os.path.join(args.repo_dir, build_name, "install")
         args.build_dir = os.path.abspath(args.build_dir)
 
         if args.install_dir is None:
             args.install_dir = os.path.join(args.build_dir, "install")
+            if args.build_root and default_install_dir:
+                args.install_dir = default_install_dir
         args.install_dir = os.path.abspath(args.install_dir)
+        # install dir is still in the persistent build dir
+        persistent_build_dir = None
+        if args.build_in_memory:
+            persistent_build_dir = args.build_dir
+            args.build_dir = MemoryBuildDir.memory_build_dir(
+                persistent_build_dir, args.memory_dir
+            )
 
         if args.sub_command == "cross_build":
             # check cross_build_target_arch
@@ -510,22 +4607,15 @@ class Build:
                         f"code issue happened for: {args.cross_build_target_os} please FIXME!!!"
                     )
                     code_not_imp()
-                license_source = os.path.join(QNX_SDP_LICENSE)
-                license_dst = os.path.join(os.path.expanduser("~"), ".qnx")
-                # remove old license
-                if os.path.exists(license_dst):
-                    logging.debug(f"remove old license: {license_dst}")
-                    shutil.rmtree(license_dst)
-                # copy license to home dir
-                logging.debug(f"copy license from {license_source} to {license_dst}")
-                shutil.copytree(license_source, license_dst)
+                # license is installed to home dir when execute the plan
+                self.qnx_license = os.path.join(QNX_SDP_LICENSE)
 
                 qnxsdp_env = os.path.join(QNX_SDP_ROOT, "qnxsdp-env.sh")
                 assert os.path.isfile(
                     qnxsdp_env
                 ), f"error config env: QNX_SDP_ROOT: {QNX_SDP_ROOT}, can not find qnxsdp-env.sh: {qnxsdp_env}"
                 # now export QNX_SDP_ROOT to env to toolchain config
-                os.environ["QNX_SDP_ROOT"] = QNX_SDP_ROOT
+                self.plan_env["QNX_SDP_ROOT"] = QNX_SDP_ROOT
                 logging.debug(f"export QNX_SDP_ROOT: {QNX_SDP_ROOT} to env")
 
                 x86_64_qnx = os.path.join(
@@ -660,12 +4750,20 @@ class Build:
                 self.CMAKE_CXX_FLAGS_CONFIG + f"{host_32bit_args[self.BUILD_ENV]}"
             )
 
-        # add -g for debug build by default
+        # debug info for all build types, Debug build type always have -g of CMake
+        debug_info_flags = self.config_debug_info(args)
+        time_trace_flags = self.config_time_trace(args, cmake_config)
         self.CMAKE_C_FLAGS_CONFIG = (
-            self.CMAKE_C_FLAGS_CONFIG + " -g " + self.ASAN_CMAKE_CONFIG[args.ASAN]
+            self.CMAKE_C_FLAGS_CONFIG
+            + f" {debug_info_flags} "
+            + self.ASAN_CMAKE_CONFIG[args.ASAN]
+            + time_trace_flags
         )
         self.CMAKE_CXX_FLAGS_CONFIG = (
-            self.CMAKE_CXX_FLAGS_CONFIG + " -g " + self.ASAN_CMAKE_CONFIG[args.ASAN]
+            self.CMAKE_CXX_FLAGS_CONFIG
+            + f" {debug_info_flags} "
+            + self.ASAN_CMAKE_CONFIG[args.ASAN]
+            + time_trace_flags
         )
 
         # now freeze CMAKE_C_FLAGS_CONFIG and CMAKE_CXX_FLAGS_CONFIG
@@ -690,6 +4788,44 @@ class Build:
 
             logging.debug(f"asan link_flags: {asan_link_asan_flag}")
             cmake_config = cmake_config + asan_link_asan_flag
+
+        cmake_config = cmake_config + self.config_linker(args)
+        cmake_config = cmake_config + self.config_link_pool(
+            args, compile_jobs, link_jobs
+        )
+
+        if args.unity_build:
+            cmake_config = cmake_config + self.config_unity_build(args)
+        elif "CMAKE_UNITY_BUILD" not in cmake_config:
+            # CMAKE_UNITY_BUILD is kept in CMakeCache.txt, turn it off when unity build is not enabled again
+            cmake_config = cmake_config + " -DCMAKE_UNITY_BUILD=OFF"
+
+        if args.compiler_cache:
+            cmake_config = cmake_config + self.config_compiler_cache(args)
+        remote_jobs = 0
+        if args.dist_workers:
+            flags, remote_jobs = self.config_dist(args, compile_jobs)
+            cmake_config = cmake_config + flags
+        # remote compile jobs do not use local cpu
+        self.NINJA_JOBS = f"-j{compile_jobs + remote_jobs}"
+        if args.ninja_load_average:
+            self.NINJA_JOBS = f"{self.NINJA_JOBS} -l{args.ninja_load_average}"
+        plan = BuildPlan(args)
+        plan.persistent_build_dir = persistent_build_dir
+        if args.dist_workers:
+            plan.dist_launcher = os.path.join(
+                args.build_dir, DistCompiler.DIST_DIR, DistCompiler.LAUNCHER
+            )
+        if args.pch:
+            plan.post_configure_cmds.append(self.config_pch(args))
+        if self.project_include:
+            assert (
+                "CMAKE_PROJECT_INCLUDE" not in cmake_config
+            ), "error config: CMAKE_PROJECT_INCLUDE is used by cmake_one, can not config by --cmake_options now"
+            plan.project_include = "\n".join(self.project_include)
+            cmake_config = (
+                cmake_config + f' -DCMAKE_PROJECT_INCLUDE="{plan.project_include_file}"'
+            )
         logging.debug(f"python3 args: {args}")
         config_cmd = f"{cmake_config}"
         if args.ninja_target:
@@ -698,34 +4834,50 @@ class Build:
                 f"only build specify target: {args.ninja_target} , need config self.NINJA_INSTALL_STR to null, caused by ninja install/strip will trigger all target build"
             )
 
-        # remove old build dir if need
-        if args.remove_old_build:
-            logging.debug(f"remove old build dir: {args.build_dir}")
-            if os.path.exists(args.build_dir):
-                shutil.rmtree(args.build_dir)
-            logging.debug(f"remove old install dir: {args.install_dir} done")
-            if os.path.exists(args.install_dir):
-                shutil.rmtree(args.install_dir)
-        logging.debug(f"create new build dir: {args.build_dir}")
-        os.makedirs(args.build_dir, exist_ok=True)
-        logging.debug(f"create new install dir: {args.install_dir}")
-        os.makedirs(args.install_dir, exist_ok=True)
-
         logging.debug(
             f"build dir info: repo_dir: {args.repo_dir} build_dir: {args.build_dir} install_dir: {args.install_dir}"
         )
 
-        build_cmd = f"{self.NINJA_BASE} {self.NINJA_INSTALL_STR} {self.NINJA_VERBOSE} {self.NINJA_JOBS} {self.NINJA_TARGET}"
-        copy_cmd = ""
-        link_install_cmd = ""
-        link_build_cmd = ""
-        fix_compile_commands_cmd = ""
-        fix_hexagon_compile_commands_cmd = ""
+        if args.install_mode != "copy" and not args.incremental_install:
+            logging.debug(
+                f"--install_mode {args.install_mode} need --incremental_install, enable it"
+            )
+            args.incremental_install = True
+        if args.incremental_install and self.NINJA_INSTALL_STR:
+            strip = " --strip" if self.NINJA_INSTALL_STR == "install/strip" else ""
+            # build the default target by ninja, then install by cmake_one
+            self.NINJA_INSTALL_STR = ""
+            plan.install_cmd = f"{sys.executable} {os.path.abspath(__file__)} --build_dir {args.build_dir} --install_dir {args.install_dir} --install_mode {args.install_mode} install{strip}"
+        self.build_settings["incremental_install"] = bool(plan.install_cmd)
+        self.build_settings["install_mode"] = args.install_mode
+
+        plan.ninja = self.NINJA_BASE
+        plan.ninja_cmd = f"{self.NINJA_BASE} {self.NINJA_INSTALL_STR} {self.NINJA_VERBOSE} {self.NINJA_JOBS} {self.NINJA_TARGET}"
+        plan.env = dict(self.plan_env)
+        plan.settings = dict(self.build_settings)
+        plan.qnx_license = self.qnx_license
+        for cmd in [
+            self.msvcenv_native_config_cmd,
+            self.qnx_native_config_cmd,
+            self.compiler_cache_env_cmd,
+        ]:
+            if cmd:
+                plan.env_cmds.append(cmd)
+        if self.compiler_cache_stats_cmd:
+            # hit/miss summary of ninja, before install which may fail
+            plan.pre_build_cmds.append(self.compiler_cache_zero_stats_cmd)
+            plan.post_ninja_cmds.append(self.compiler_cache_stats_cmd)
+        # path remaps for compile_commands.json, from path in docker to path on host
+        compile_db_remaps = {}
         if not args.not_do_link_build_and_install:
-            link_install_cmd = f"ln -snf {args.install_dir} {args.repo_dir}/install"
-            link_build_cmd = f"ln -snf {args.build_dir} {args.repo_dir}/build"
+            plan.post_build_cmds.append(
+                f"ln -snf {args.install_dir} {args.repo_dir}/install"
+            )
+            plan.post_build_cmds.append(
+                f"ln -snf {args.build_dir} {args.repo_dir}/build"
+            )
 
-        # now try to fix compile_commands.json for sysroot before do copy
+        # now try to fix compile_commands.json for sysroot when write it to repo dir
         # case one: cross build for Android
         envs = os.environ
         if (
@@ -755,7 +4907,7 @@ class Build:
             logging.debug(f"change {android_sysroot} to {host_android_sysroot}")
             logging.debug(f"fix compile_commands.json for Android sysroot")
             # replace android_sysroot to host_android_sysroot
-            fix_compile_commands_cmd = f"sed -i 's|{android_sysroot}|{host_android_sysroot}|g' compile_commands.json"
+            compile_db_remaps[android_sysroot] = host_android_sysroot
         # case two: cross build for OHOS, change $OHOS_NDK_ROOT/sysroot to $CMAKE_ONE_PRFIX_OHOS_NDK_ROOT/sysroot
         if (
             args.sub_command == "cross_build"
@@ -777,9 +4929,7 @@ class Build:
             logging.debug(f"change {ohos_sysroot} to {host_ohos_sysroot}")
             logging.debug(f"fix compile_commands.json for OHOS sysroot")
             # replace ohos_sysroot to host_ohos_sysroot
-            fix_compile_commands_cmd = (
-                f"sed -i 's|{ohos_sysroot}|{host_ohos_sysroot}|g' compile_commands.json"
-            )
+            compile_db_remaps[ohos_sysroot] = host_ohos_sysroot
         # case three: build skel lib for hexagon, change $HEXAGON_SDK_ROOT_PATH to $CMAKE_ONE_PRFIX_HEXAGON_SDK_ROOT_PATH
         if (
             args.sub_command == "cross_build"
@@ -797,51 +4947,303 @@ class Build:
             logging.debug(f"change {hexagon_sdk_path} to {host_hexagon_sdk_path}")
             logging.debug(f"fix compile_commands.json for Hexagon skel lib")
             # replace hexagon_sdk_path to host_hexagon_sdk_path
-            fix_hexagon_compile_commands_cmd = f"sed -i 's|{hexagon_sdk_path}|{host_hexagon_sdk_path}|g' {args.repo_dir}/compile_commands.json"
+            compile_db_remaps[hexagon_sdk_path] = host_hexagon_sdk_path
 
-        copy_cmd = f"mv compile_commands.json {args.repo_dir}"
+        # keep compile_commands.json in build dir, write the fixed and merged one to repo dir
+        compile_db_dirs = [args.build_dir]
+        if args.merge_compile_db_dirs:
+            compile_db_dirs += [
+                os.path.abspath(d) for d in args.merge_compile_db_dirs.split()
+            ]
+        compile_db_cmd = f'{sys.executable} {os.path.abspath(__file__)} compile_db --compile_db_dirs {" ".join(compile_db_dirs)} --output {os.path.join(args.repo_dir, CompileDatabase.FILE_NAME)}'
+        for k, v in compile_db_remaps.items():
+            compile_db_cmd += f' --remap "{k}={v}"'
 
-        if args.not_call_rerun_cmake:
-            if not os.path.exists(os.path.join(args.build_dir, "CMakeCache.txt")):
-                args.not_call_rerun_cmake = False
-                logging.debug(
-                    f"need call rerun cmake, but CMakeCache.txt not exist, so call cmake again"
+        plan.cmake_cmd = config_cmd
+        plan.compile_db_cmd = compile_db_cmd
+        # ninja may rerun cmake when CMakeLists.txt changed, it only write when changed
+        plan.post_build_cmds.append(compile_db_cmd)
+        # only rerun cmake when config fingerprint changed, CMake will rerun by ninja if CMakeLists.txt changed
+        plan.fingerprint = self.config_fingerprint(
+            [
+                # link jobs change with the number of targets built together, do not rerun cmake for it
+                re.sub(rf"\s-D{self.LINK_JOBS_VAR}=\d+", "", config_cmd),
+                self.msvcenv_native_config_cmd,
+                self.qnx_native_config_cmd,
+                plan.project_include,
+                *plan.post_configure_cmds,
+            ],
+            plan.env,
+        )
+        if args.probe_cache:
+            plan.probe_cache_key = self.probe_cache_key(plan)
+        if args.artifact_cache:
+            if args.ninja_target:
+                logging.warning(
+                    "--artifact_cache only cache full install, disable it as --ninja_target is set"
                 )
-            if not os.path.exists(os.path.join(args.build_dir, "build.ninja")):
-                args.not_call_rerun_cmake = False
-                logging.debug(
-                    f"need call rerun cmake, but build.ninja not exist, so call cmake again"
+            else:
+                plan.artifact_cache_key = self.artifact_cache_key(plan)
+        return plan
+
+    def install_qnx_license(self, license_source):
+        """sync license to home dir, only replace the changed files and remove the ones not in source
+
+        files are replaced atomically with a lock, so QNX builds can run at the same time
+        """
+        license_dst = os.path.join(os.path.expanduser("~"), ".qnx")
+        os.makedirs(license_dst, exist_ok=True)
+        with open(f"{license_dst}.lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            updated = []
+            for root, _, files in os.walk(license_source):
+                dst_root = os.path.normpath(
+                    os.path.join(license_dst, os.path.relpath(root, license_source))
+                )
+                os.makedirs(dst_root, exist_ok=True)
+                for name in files:
+                    src = os.path.join(root, name)
+                    dst = os.path.join(dst_root, name)
+                    if os.path.isfile(dst) and filecmp.cmp(src, dst, shallow=False):
+                        continue
+                    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    shutil.copy2(src, tmp)
+                    os.replace(tmp, dst)
+                    updated.append(dst)
+            # licenses of other QNX versions, or removed and renamed ones
+            removed = []
+            for root, dirs, files in os.walk(license_dst, topdown=False):
+                src_root = os.path.normpath(
+                    os.path.join(license_source, os.path.relpath(root, license_dst))
                 )
+                links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+                for name in files + links:
+                    if not os.path.lexists(os.path.join(src_root, name)):
+                        os.remove(os.path.join(root, name))
+                        removed.append(os.path.join(root, name))
+                if root != license_dst and not os.path.isdir(src_root):
+                    os.rmdir(root)
+        logging.debug(
+            f"sync license from {license_source} to {license_dst}, updated: {updated}, removed: {removed}"
+        )
+
+    def execute(self, plan, log_file=None, on_start=None):
+        """run the plan, raise subprocess.CalledProcessError if failed
+
+        log_file: write the output of config.sh to it instead of stdout
+        on_start: called with the subprocess.Popen of config.sh, used to stop the build
+        """
+        args = plan.config
+        memory = None
+        if plan.persistent_build_dir:
+            memory = MemoryBuildDir(plan.persistent_build_dir, plan.build_dir)
+        # remove old build dir if need, they are moved to trash and deleted in background
+        trash = Trash(self.parse_size(args.trash_max_size))
+        if args.remove_old_build:
+            logging.debug(f"remove old build dir: {plan.build_dir}")
+            trash.remove(plan.build_dir)
+            logging.debug(f"remove old install dir: {plan.install_dir}")
+            trash.remove(plan.install_dir)
+            if memory:
+                memory.remove_snapshot(trash)
+        # also the entries left by killed runs
+        for trash_dir in {
+            Trash.trash_dir_of(plan.build_dir),
+            Trash.trash_dir_of(plan.install_dir),
+        }:
+            trash.clean_in_background(trash_dir)
+        logging.debug(f"create new build dir: {plan.build_dir}")
+        os.makedirs(plan.build_dir, exist_ok=True)
+        logging.debug(f"create new install dir: {plan.install_dir}")
+        os.makedirs(plan.install_dir, exist_ok=True)
+        if memory:
+            memory.check_space(plan.install_dir)
+            memory.restore()
+            memory.mark_build()
+
+        artifact_cache = None
+        if plan.artifact_cache_key:
+            artifact_cache = ArtifactCache(
+                args.artifact_cache_dir,
+                self.parse_size(args.artifact_cache_max_size),
+                args.artifact_cache_max_age,
+            )
+            if artifact_cache.restore(plan.artifact_cache_key, plan.install_dir):
+                # nothing is built, the build dir may not exist
+                if not args.not_do_link_build_and_install:
+                    link = os.path.join(plan.repo_dir, "install")
+                    if os.path.islink(link):
+                        os.remove(link)
+                    os.symlink(plan.install_dir, link)
+                return 0.0
+            logging.info(f"artifact cache miss: {plan.artifact_cache_key}")
+
+        probe_cache = None
+        if plan.probe_cache_key:
+            probe_cache = ProbeCache(args.probe_cache_dir)
+            if not os.path.exists(os.path.join(plan.build_dir, "CMakeCache.txt")):
+                probe_cache.restore(plan.probe_cache_key, plan.build_dir, plan.repo_dir)
 
-        with open(os.path.join(args.build_dir, "config.sh"), "w") as f:
-            f.write("#!/bin/bash\n")
-            f.write("set -ex\n")
-            if self.msvcenv_native_config_cmd:
-                f.write(f"{self.msvcenv_native_config_cmd}\n")
-            if self.qnx_native_config_cmd:
-                f.write(f"{self.qnx_native_config_cmd}\n")
-            if not args.not_call_rerun_cmake:
-                f.write(f"{config_cmd}\n")
-                f.write(f"{fix_compile_commands_cmd}\n")
-                f.write(f"{copy_cmd}\n")
-            f.write(f"{build_cmd}\n")
-            f.write(f"{link_install_cmd}\n")
-            f.write(f"{link_build_cmd}\n")
-            f.write(f"{fix_hexagon_compile_commands_cmd}\n")
+        if plan.qnx_license:
+            self.install_qnx_license(plan.qnx_license)
+        plan.write_project_include()
+        plan.write_settings()
+        plan.write_dist_launcher()
+
+        configure = plan.need_configure()
+        config_sh = os.path.join(plan.build_dir, "config.sh")
+        with open(config_sh, "w") as f:
+            f.write(plan.config_sh(configure))
 
         # show config.sh
         logging.debug("show config.sh")
-        with open(os.path.join(args.build_dir, "config.sh"), "r") as f:
+        with open(config_sh, "r") as f:
             logging.debug(f.read())
 
-        # run config.sh
-        os.chdir(args.build_dir)
+        # run the phases of config.sh
         time_s = time.time()
         logging.debug(f"run config.sh")
-        subprocess.check_call(f"bash {args.build_dir}/config.sh", shell=True)
+        env = dict(os.environ, **plan.env)
+        with (
+            open(log_file, "wb")
+            if log_file
+            else contextlib.nullcontext(sys.stdout.buffer)
+        ) as f:
+            monitor = BuildMonitor(
+                plan.name,
+                plan.build_dir,
+                f,
+                args.events_file,
+                args.progress_interval,
+                merge_stderr=log_file is not None,
+            )
+            monitor.event("build_start", build_dir=plan.build_dir)
+            for phase, cmds in plan.phases(configure):
+                ret = monitor.run_phase(phase, plan.phase_sh(cmds), env, on_start)
+                if ret != 0:
+                    break
         time_e = time.time()
+        monitor.event("build_end", returncode=ret, cost=round(time_e - time_s, 3))
+        if ret != 0:
+            raise subprocess.CalledProcessError(
+                ret, f"bash {config_sh}, phase: {phase}"
+            )
         logging.debug(f"build done, cost: {time_e - time_s:.2f}s")
 
+        if args.unity_build:
+            self.post_build_report(self.unity_build_summary, plan.build_dir)
+        if args.pch:
+            PrecompiledHeader(plan.build_dir, plan.repo_dir).validate(plan.ninja)
+        if args.build_report:
+            self.post_build_report(self.build_report, plan.build_dir)
+        if plan.settings.get("time_trace"):
+            self.post_build_report(self.time_trace_report, plan.build_dir)
+        if memory:
+            memory.write_back()
+            if args.memory_snapshot:
+                memory.snapshot()
+        if probe_cache:
+            probe_cache.store(plan.probe_cache_key, plan.build_dir, plan.repo_dir)
+        if artifact_cache:
+            artifact_cache.store(plan.artifact_cache_key, plan.install_dir, plan.name)
+        return time_e - time_s
+
+    def execute_plans(self, plans, max_workers=None, fail_fast=False, log_dir=None):
+        """run many plans with a shared thread pool, return {plan.name: (status, cost, log_file)}
+
+        status is one of: success, failed, stopped(by fail_fast), skipped(not start as fail_fast)
+
+        never raise for a failed plan: build errors and any exception of Build.execute are
+        logged(and appended to the log file) and reported as failed, so the result always
+        have all plans, only invalid arguments like duplicate plan names raise
+        """
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        stop_event = threading.Event()
+        running = {}
+        running_lock = threading.Lock()
+        results = {}
+        stopped = set()
+
+        def on_start(name, p):
+            with running_lock:
+                running[name] = p
+                # fail_fast after the target started but before it is registered
+                if stop_event.is_set():
+                    stopped.add(name)
+                # stopped between two phases
+                if name in stopped:
+                    try:
+                        os.killpg(p.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+
+        def run_plan(plan):
+            name = plan.name
+            if stop_event.is_set():
+                results[name] = ("skipped", 0.0, "")
+                return
+            log_file = os.path.join(log_dir, f"{name}.log") if log_dir else None
+            logging.info(f"start target: {name}, log: {log_file}")
+            time_s = time.time()
+            error = None
+            try:
+                self.execute(plan, log_file, lambda p: on_start(name, p))
+                ret = 0
+            except subprocess.CalledProcessError as e:
+                ret = e.returncode
+            except Exception as e:
+                # like config check or trash and cache errors, should not stop other targets
+                ret = None
+                error = f"{type(e).__name__}: {e}"
+                if log_file:
+                    with open(log_file, "a") as f:
+                        f.write(f"cmake_one error: {error}\n")
+            with running_lock:
+                running.pop(name, None)
+            cost = time.time() - time_s
+            if ret == 0:
+                results[name] = ("success", cost, log_file)
+                logging.info(f"target: {name} done, cost: {cost:.2f}s")
+                return
+            if name in stopped:
+                results[name] = ("stopped", cost, log_file)
+                logging.info(f"target: {name} stopped, cost: {cost:.2f}s")
+                return
+            results[name] = ("failed", cost, log_file)
+            reason = f"error: {error}" if error else f"code: {ret}"
+            logging.error(
+                f"target: {name} failed with {reason}, cost: {cost:.2f}s, log: {log_file}"
+            )
+            if fail_fast and not stop_event.is_set():
+                logging.error("fail_fast: stop all targets now")
+                stop_event.set()
+                with running_lock:
+                    for other, other_p in running.items():
+                        logging.debug(f"stop target: {other}")
+                        stopped.add(other)
+                        try:
+                            os.killpg(other_p.pid, signal.SIGTERM)
+                        except ProcessLookupError:
+                            pass
+
+        names = [plan.name for plan in plans]
+        assert len(names) == len(
+            set(names)
+        ), f"error config plans: duplicate plan name in {names}"
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or len(plans) or 1
+        ) as pool:
+            futures = {plan.name: pool.submit(run_plan, plan) for plan in plans}
+            for name, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"target: {name} failed with error: {e}")
+                    results.setdefault(name, ("failed", 0.0, ""))
+        return results
+
 
 if __name__ == "__main__":
     LOG_FORMAT = "[cmake_one] - %(asctime)s - %(levelname)s - %(message)s"
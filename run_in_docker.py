@@ -1,9 +1,12 @@
 import getpass
+import hashlib
 import logging
 import os
 import platform
+import re
 import subprocess
 import sys
+import time
 
 
 def is_tty_supported():
@@ -32,7 +35,231 @@ def get_docker_tag_and_dockerfile() -> dict:
     return tag, dockerfile
 
 
-def run_in_docker(cmd: str):
+DOCKER_FINGERPRINT_LABEL = "cmake_one.context_fingerprint"
+
+
+def docker_context_fingerprint(dockerfile: str, context: str) -> str:
+    # hash Dockerfile and all files in build context, file path is part of the hash
+    h = hashlib.sha256()
+    with open(dockerfile, "rb") as f:
+        h.update(f.read())
+    for root, dirs, files in os.walk(context):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            h.update(os.path.relpath(path, context).encode())
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def docker_image_fingerprint(tag: str) -> str:
+    # return empty string if image not exist or do not have fingerprint label
+    try:
+        out = subprocess.check_output(
+            f"docker image inspect --format '{{{{ index .Config.Labels \"{DOCKER_FINGERPRINT_LABEL}\" }}}}' {tag}",
+            shell=True,
+            stderr=subprocess.DEVNULL,
+        )
+    except subprocess.CalledProcessError:
+        return ""
+    return out.decode().strip()
+
+
+# run in the warm container as pid 1: exit when no docker exec is running and the last one finished more than idle timeout ago
+# docker exec leave a file named by its pid in CONTAINER_EXEC_DIR when running, stale files of killed exec will be removed
+CONTAINER_EXEC_DIR = "/root/.cmake_one_exec"
+CONTAINER_LAST_EXEC = "/root/.cmake_one_last_exec"
+CONTAINER_IMAGE_LABEL = "cmake_one.container_image"
+CONTAINER_WATCHDOG = (
+    f"mkdir -p {CONTAINER_EXEC_DIR}; touch {CONTAINER_LAST_EXEC}; "
+    "while true; do sleep 10; "
+    f'for f in {CONTAINER_EXEC_DIR}/*; do [ -e "$f" ] || continue; kill -0 $(basename $f) 2>/dev/null || rm -f "$f"; done; '
+    f'if [ -z "$(ls -A {CONTAINER_EXEC_DIR})" ] && [ $(( $(date +%s) - $(stat -c %Y {CONTAINER_LAST_EXEC}) )) -gt IDLE_TIMEOUT ]; then exit 0; fi; '
+    "done"
+)
+
+
+def docker_image_id(tag: str) -> str:
+    out = subprocess.check_output(
+        f"docker image inspect --format '{{{{ .Id }}}}' {tag}", shell=True
+    )
+    return out.decode().strip()
+
+
+def prepare_warm_container(tag: str, mount_opts: str, idle_timeout: int) -> str:
+    # one container for each (image, mount set), recreate it when image changed
+    key = hashlib.sha256(f"{tag} {mount_opts}".encode()).hexdigest()[:12]
+    name = f"cmake_one_{tag}_{key}"
+    image_id = docker_image_id(tag)
+    try:
+        out = subprocess.check_output(
+            f"docker inspect --format '{{{{ .State.Running }}}} {{{{ index .Config.Labels \"{CONTAINER_IMAGE_LABEL}\" }}}}' {name}",
+            shell=True,
+            stderr=subprocess.DEVNULL,
+        )
+        running, container_image_id = out.decode().strip().split(" ", 1)
+    except subprocess.CalledProcessError:
+        running, container_image_id = "", ""
+    if running == "true" and container_image_id == image_id:
+        # reset the idle time now, or the watchdog may stop it before the docker exec of caller
+        touch_cmd = f"docker exec {name} touch {CONTAINER_LAST_EXEC}"
+        if subprocess.call(touch_cmd, shell=True, stderr=subprocess.DEVNULL) == 0:
+            logging.debug(f"reuse warm container: {name}")
+            return name
+        logging.debug(f"warm container {name} is stopped by idle timeout")
+        # --rm may be still removing it
+        subprocess.call(
+            f"docker rm -f {name}",
+            shell=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        running = ""
+    if running:
+        logging.debug(
+            f"remove container: {name}, running: {running}, image: {container_image_id} -> {image_id}"
+        )
+        subprocess.check_call(f"docker rm -f {name}", shell=True)
+    watchdog = CONTAINER_WATCHDOG.replace("IDLE_TIMEOUT", str(idle_timeout))
+    run_cmd = f"docker run -d --rm --name {name} --label {CONTAINER_IMAGE_LABEL}={image_id}{mount_opts} {tag} /bin/bash -c '{watchdog}'"
+    logging.debug(f"start warm container: {run_cmd}")
+    subprocess.check_call(run_cmd, shell=True, stdout=subprocess.DEVNULL)
+    return name
+
+
+# named volumes keep caches and build trees across docker run --rm, and faster than bind mounts on rootless docker
+# one volume for each image as the toolchains in images are different, build volume is also for each repo
+VOLUME_LABEL = "cmake_one.volume"
+VOLUME_REPO_LABEL = "cmake_one.repo_dir"
+CACHE_VOLUMES = {
+    "compiler_cache": "/root/.cache/cmake_one/compiler_cache",
+    "probe_cache": "/root/.cache/cmake_one/probes",
+    "artifact_cache": "/root/.cache/cmake_one/artifacts",
+}
+# cmake_one option to use a host dir instead of the volume
+CACHE_VOLUME_DIR_ARGS = {
+    "compiler_cache": "--compiler_cache_dir",
+    "probe_cache": "--probe_cache_dir",
+    "artifact_cache": "--artifact_cache_dir",
+}
+DOCKER_BUILD_ROOT = "/root/cmake_one_build"
+# tmpfs of --build_in_memory, /dev/shm of docker is only 64M by default
+DOCKER_MEMORY_DIR = "/root/cmake_one_memory"
+VOLUME_LAST_USED = ".cmake_one_last_used"
+
+
+def volume_name(tag: str, kind: str, repo_dir: str = None) -> str:
+    if repo_dir is None:
+        return f"cmake_one_{tag}_{kind}"
+    repo_name = re.sub(r"[^a-zA-Z0-9_.-]", "_", os.path.basename(repo_dir))
+    key = hashlib.sha256(repo_dir.encode()).hexdigest()[:8]
+    return f"cmake_one_{tag}_{kind}_{repo_name}_{key}"
+
+
+def prepare_volume(name: str, kind: str, repo_dir: str = None):
+    # create with labels, so they can be found by: run_in_docker.py volumes
+    ret = subprocess.call(
+        f"docker volume inspect {name}",
+        shell=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if ret == 0:
+        return
+    labels = f" --label {VOLUME_LABEL}={kind}"
+    if repo_dir:
+        labels += f" --label {VOLUME_REPO_LABEL}={repo_dir}"
+    logging.debug(f"create docker volume: {name}")
+    subprocess.check_call(
+        f"docker volume create{labels} {name}", shell=True, stdout=subprocess.DEVNULL
+    )
+
+
+def list_volumes(tag: str) -> list:
+    # [(name, kind, repo_dir, size in bytes, last used time)] of all cmake_one volumes
+    out = subprocess.check_output(
+        f"docker volume ls --filter label={VOLUME_LABEL} --format '{{{{ .Name }}}}'",
+        shell=True,
+    )
+    names = out.decode().split()
+    if not names:
+        return []
+    labels = {}
+    label_format = f'{{{{ index .Labels "{VOLUME_LABEL}" }}}} {{{{ index .Labels "{VOLUME_REPO_LABEL}" }}}}'
+    for name in names:
+        out = subprocess.check_output(
+            f"docker volume inspect --format '{label_format}' {name}",
+            shell=True,
+        )
+        kind, _, repo_dir = out.decode().strip().partition(" ")
+        labels[name] = (kind, repo_dir)
+    # size and last used time can only be read in a container
+    mounts = "".join(f" -v {name}:/volumes/{name}:ro" for name in names)
+    script = f'for d in /volumes/*; do echo "$(basename $d) $(du -sb $d | cut -f1) $(stat -c %Y $d/{VOLUME_LAST_USED} 2>/dev/null || echo 0)"; done'
+    out = subprocess.check_output(
+        f"docker run --rm{mounts} {tag} /bin/bash -c '{script}'", shell=True
+    )
+    volumes = []
+    for line in out.decode().splitlines():
+        name, size, last_used = line.split()
+        volumes.append((name, *labels[name], int(size), int(last_used)))
+    return volumes
+
+
+VOLUME_KINDS = ["build", *CACHE_VOLUMES]
+VOLUMES_USAGE = f"usage: run_in_docker.py volumes [--prune] [--older_than DAYS] [--kind {{{','.join(VOLUME_KINDS)}}}]"
+
+
+def option_value(argv: list, option: str, convert, usage: str):
+    # the value after option, exit with usage if it is missing or bad
+    i = argv.index(option)
+    if i + 1 >= len(argv) or argv[i + 1].startswith("--"):
+        sys.exit(f"{usage}\nerror: {option} need a value")
+    try:
+        return convert(argv[i + 1])
+    except ValueError:
+        sys.exit(f"{usage}\nerror: bad value of {option}: {argv[i + 1]}")
+
+
+def volume_kind(kind: str) -> str:
+    if kind not in VOLUME_KINDS:
+        raise ValueError(kind)
+    return kind
+
+
+def volumes_cmd(argv: list):
+    # run_in_docker.py volumes [--prune] [--older_than DAYS] [--kind KIND]
+    prune = "--prune" in argv
+    older_than = 0
+    if "--older_than" in argv:
+        older_than = option_value(argv, "--older_than", float, VOLUMES_USAGE)
+    kind_filter = None
+    if "--kind" in argv:
+        kind_filter = option_value(argv, "--kind", volume_kind, VOLUMES_USAGE)
+    tag, _ = get_docker_tag_and_dockerfile()
+    now = time.time()
+    for name, kind, repo_dir, size, last_used in list_volumes(tag):
+        if kind_filter and kind != kind_filter:
+            continue
+        days = (now - last_used) / 86400
+        logging.info(
+            f"volume: {name} kind: {kind} repo: {repo_dir or None} size: {size / (1 << 20):.1f}M last used: {days:.1f} days ago"
+        )
+        if not prune or days < older_than:
+            continue
+        # fail if used by a warm container, remove it by docker rm -f first
+        if subprocess.call(f"docker volume rm {name}", shell=True) != 0:
+            logging.warning(f"can not remove volume: {name}, maybe it is in use")
+
+
+def run_in_docker(
+    cmd: str,
+    force_build_image: bool = False,
+    keep_container: bool = False,
+    container_idle_timeout: int = 1800,
+    build_volume: bool = False,
+):
     # check docker is installed and docker run in rootless mode
     # why need rootless, because the docker run in root mode will cause the permission issue, if you want to run in root mode, you can remove the following code
     docker_info = subprocess.check_output("docker info", shell=True)
@@ -44,9 +271,19 @@ def run_in_docker(cmd: str):
     # build the docker image
     tag, dockerfile = get_docker_tag_and_dockerfile()
     path_of_dockerfile = os.path.dirname(os.path.abspath(dockerfile))
-    build_cmd = f"docker build -t {tag} -f {dockerfile} {path_of_dockerfile}"
-    logging.debug(f"Running: {build_cmd}")
-    subprocess.check_call(build_cmd, shell=True)
+    fingerprint = docker_context_fingerprint(dockerfile, path_of_dockerfile)
+    image_fingerprint = docker_image_fingerprint(tag)
+    if not force_build_image and fingerprint == image_fingerprint:
+        logging.debug(
+            f"docker image {tag} is up to date with fingerprint: {fingerprint}, skip docker build"
+        )
+    else:
+        logging.debug(
+            f"docker image {tag} fingerprint: {image_fingerprint or None} -> {fingerprint}, force build: {force_build_image}"
+        )
+        build_cmd = f"docker build -t {tag} --label {DOCKER_FINGERPRINT_LABEL}={fingerprint} -f {dockerfile} {path_of_dockerfile}"
+        logging.debug(f"Running: {build_cmd}")
+        subprocess.check_call(build_cmd, shell=True)
 
     logging.debug(f"Running: {cmd} in docker")
 
@@ -62,12 +299,13 @@ def run_in_docker(cmd: str):
         logging.debug("tty is not supported, set docker_args to -i")
         docker_args = "-i"
 
-    docker_cmd = f"docker run --rm {docker_args}"
+    env_opts = ""
+    mount_opts = ""
     map_to_envs = ["Commit_Id", "MODELOPR_VER"]
     for env in map_to_envs:
         if env in envs:
             value = envs[env]
-            docker_cmd += f" -e {env}={env}"
+            env_opts += f" -e {env}={env}"
     # this map is used to correct compile_commands.json for sysroot
     map_to_envs_with_org_prefix = [
         "TEST_NOT_EXIT",
@@ -78,45 +316,45 @@ def run_in_docker(cmd: str):
     for env in map_to_envs_with_org_prefix:
         if env in envs:
             value = envs[env]
-            docker_cmd += f" -e CMAKE_ONE_PRFIX_{env}={value}"
+            env_opts += f" -e CMAKE_ONE_PRFIX_{env}={value}"
+    # dist worker token, pass by name so it is not shown in docker command
+    if "CMAKE_ONE_DIST_TOKEN" in envs:
+        env_opts += " -e CMAKE_ONE_DIST_TOKEN"
+    # dist worker listen on host network, so other build boxes can connect to it
+    if "worker" in cmd.split():
+        mount_opts += " --network host"
     # map user .ssh to docker
     host_ssh_dir = os.path.join(os.path.expanduser("~"), ".ssh")
     docker_ssh_dir = f"/root/.ssh"
-    docker_cmd += f" -v {host_ssh_dir}:{docker_ssh_dir}"
+    mount_opts += f" -v {host_ssh_dir}:{docker_ssh_dir}"
     # map tmp to docker tmp
-    docker_cmd += " -v /tmp:/tmp:rw"
+    mount_opts += " -v /tmp:/tmp:rw"
     # map the current directory to docker
-    docker_cmd += f" -v {os.getcwd()}:{os.getcwd()}:rw"
+    mount_opts += f" -v {os.getcwd()}:{os.getcwd()}:rw"
     # map cmake_one to docker
     cmake_one_path = os.path.dirname(os.path.abspath(__file__))
-    docker_cmd += f" -v {cmake_one_path}:{cmake_one_path}:rw"
+    mount_opts += f" -v {cmake_one_path}:{cmake_one_path}:rw"
 
-    # split the cmd by space, then find --repo_dir xxx, --build_dir xxx, --install_dir xxx
+    # split the cmd by space, then find --repo_dir xxx, --build_dir xxx, --install_dir xxx, --compiler_cache_dir xxx
     # then map the directory to docker
+    map_dir_args = [
+        "--repo_dir",
+        "--build_dir",
+        "--install_dir",
+        "--compiler_cache_dir",
+        "--probe_cache_dir",
+        "--artifact_cache_dir",
+    ]
     cmd_parts = cmd.split()
     logging.debug(f"cmd_parts: {cmd_parts}")
     new_cmd = []
     skip = False
     for i, part in enumerate(cmd_parts):
-        if part == "--repo_dir":
+        if part in map_dir_args:
             d = cmd_parts[i + 1]
             d = os.path.abspath(d)
             os.makedirs(d, exist_ok=True)
-            docker_cmd += f" -v {d}:{d}:rw"
-            new_cmd += [part, d]
-            skip = True
-        elif part == "--build_dir":
-            d = cmd_parts[i + 1]
-            d = os.path.abspath(d)
-            os.makedirs(d, exist_ok=True)
-            docker_cmd += f" -v {d}:{d}:rw"
-            new_cmd += [part, d]
-            skip = True
-        elif part == "--install_dir":
-            d = cmd_parts[i + 1]
-            d = os.path.abspath(d)
-            os.makedirs(d, exist_ok=True)
-            docker_cmd += f" -v {d}:{d}:rw"
+            mount_opts += f" -v {d}:{d}:rw"
             new_cmd += [part, d]
             skip = True
         else:
@@ -124,9 +362,42 @@ def run_in_docker(cmd: str):
                 skip = False
             else:
                 new_cmd.append(part)
+    # keep caches in named volumes, or they will be lost with docker run --rm
+    volume_dirs = []
+    for kind, docker_dir in CACHE_VOLUMES.items():
+        if CACHE_VOLUME_DIR_ARGS[kind] in cmd_parts:
+            continue
+        name = volume_name(tag, kind)
+        prepare_volume(name, kind)
+        mount_opts += f" -v {name}:{docker_dir}:rw"
+        volume_dirs.append(docker_dir)
+    # default build dirs of cmake_one in a volume of the repo, install dirs are still in repo dir
+    if build_volume:
+        repo_dir = os.path.join(cmake_one_path, "test_repo")
+        if "--repo_dir" in cmd_parts:
+            repo_dir = os.path.abspath(cmd_parts[cmd_parts.index("--repo_dir") + 1])
+        name = volume_name(tag, "build", repo_dir)
+        prepare_volume(name, "build", repo_dir)
+        mount_opts += f" -v {name}:{DOCKER_BUILD_ROOT}:rw"
+        env_opts += f" -e CMAKE_ONE_BUILD_ROOT={DOCKER_BUILD_ROOT}"
+        volume_dirs.append(DOCKER_BUILD_ROOT)
+    # size of tmpfs is half of the memory by default, exec for the test programs run by cmake
+    if "--build_in_memory" in cmd_parts and "--memory_dir" not in cmd_parts:
+        mount_opts += f" --tmpfs {DOCKER_MEMORY_DIR}:rw,exec"
+        env_opts += f" -e CMAKE_ONE_MEMORY_DIR={DOCKER_MEMORY_DIR}"
     new_cmd_str = " ".join(new_cmd)
+    # for run_in_docker.py volumes --prune --older_than DAYS
+    touch_volumes = " ".join(os.path.join(d, VOLUME_LAST_USED) for d in volume_dirs)
+    new_cmd_str = f"touch {touch_volumes}; {new_cmd_str}"
+    if keep_container:
+        name = prepare_warm_container(tag, mount_opts, container_idle_timeout)
+        # mark exec running, then the watchdog in container will not stop it
+        new_cmd_str = f'touch {CONTAINER_EXEC_DIR}/$$; trap "rm -f {CONTAINER_EXEC_DIR}/$$; touch {CONTAINER_LAST_EXEC}" EXIT; {new_cmd_str}'
+        docker_cmd = f"docker exec {docker_args}{env_opts} {name}"
+    else:
+        docker_cmd = f"docker run --rm {docker_args}{env_opts}{mount_opts} {tag}"
     # add last build cmd
-    docker_cmd += f" {tag} /bin/bash -c '{new_cmd_str}'"
+    docker_cmd += f" /bin/bash -c '{new_cmd_str}'"
     logging.debug(f"Running: {docker_cmd}")
     subprocess.check_call(docker_cmd, shell=True)
 
@@ -138,14 +409,40 @@ if __name__ == "__main__":
     cmake_one_py = os.path.join(
         os.path.dirname(os.path.abspath(__file__)), "cmake_one.py"
     )
+    # options only for run_in_docker.py, do not pass to cmake_one.py
+    # --force_build_image: always run docker build, for example remote files used by Dockerfile changed
+    # --keep_container: run in a warm container by docker exec, the container is kept for the same image and mounts
+    # --container_idle_timeout N: warm container exit after N seconds without docker exec, default is 1800
+    # --build_volume: default build dirs in a named volume of the repo, install dirs are still in the repo dir
+    # volumes [--prune] [--older_than DAYS] [--kind KIND]: show or remove the named volumes of caches and build dirs
+    argv = sys.argv[1:]
+    if argv and argv[0] == "volumes":
+        volumes_cmd(argv[1:])
+        sys.exit(0)
+    force_build_image = "--force_build_image" in argv
+    keep_container = "--keep_container" in argv
+    build_volume = "--build_volume" in argv
+    container_idle_timeout = 1800
+    if "--container_idle_timeout" in argv:
+        i = argv.index("--container_idle_timeout")
+        container_idle_timeout = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2 :]
+    argv = [
+        arg
+        for arg in argv
+        if arg not in ["--force_build_image", "--keep_container", "--build_volume"]
+    ]
+
     # pass all arguments to the cmake_one.py
     def needs_quotes(arg):
         return ' ' in arg
 
     processed_args = [  
         f'"{arg}"' if needs_quotes(arg) else arg
-        for arg in sys.argv[1:]
+        for arg in argv
     ]
     # pass all arguments to the cmake_one.py
     cmd = f"python3 {cmake_one_py} {' '.join(processed_args)}"
-    run_in_docker(cmd)
+    run_in_docker(
+        cmd, force_build_image, keep_container, container_idle_timeout, build_volume
+    )
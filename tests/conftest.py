@@ -0,0 +1,24 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# the host toolchain of cmake_one is clang, use the compilers found here
+HOST_COMPILERS = "CMAKE_C_COMPILER=gcc CMAKE_CXX_COMPILER=g++"
+
+need_host_build = pytest.mark.skipif(
+    not all(shutil.which(t) for t in ["cmake", "ninja", "gcc", "g++"]),
+    reason="need cmake, ninja, gcc and g++",
+)
+
+
+@pytest.fixture
+def repo_dir(tmp_path):
+    """a copy of test_repo, builds write compile_commands.json and links to the repo dir"""
+    path = tmp_path / "repo"
+    shutil.copytree(os.path.join(ROOT, "test_repo"), path)
+    return str(path)
@@ -0,0 +1,128 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+from conftest import HOST_COMPILERS, ROOT
+
+from cmake_one import ArtifactCache, Build, BuildConfig
+
+
+def git(repo, *args):
+    subprocess.check_call(
+        ["git", "-C", str(repo), "-c", "user.name=test", "-c", "user.email=t@t", *args],
+        stdout=subprocess.DEVNULL,
+    )
+
+
+@pytest.fixture
+def work_tree(tmp_path):
+    """a git work tree, the cmake project is the sub dir: project"""
+    top = tmp_path / "work_tree"
+    project = top / "project"
+    project.mkdir(parents=True)
+    (project / "CMakeLists.txt").write_text("project(test)\n")
+    (project / "a.cpp").write_text("int a() { return 1; }\n")
+    (top / "README.md").write_text("readme\n")
+    git(top, "init", "-q")
+    git(top, "add", "-A")
+    git(top, "commit", "-q", "-m", "init")
+    return top
+
+
+def test_not_git_repo(tmp_path):
+    assert ArtifactCache.source_fingerprint(str(tmp_path)) is None
+
+
+@pytest.mark.parametrize("sub_dir", [False, True])
+def test_dirty_file_content(work_tree, sub_dir):
+    repo_dir = str(work_tree / "project") if sub_dir else str(work_tree)
+    clean = ArtifactCache.source_fingerprint(repo_dir)
+    assert clean == ArtifactCache.source_fingerprint(repo_dir)
+
+    source = work_tree / "project" / "a.cpp"
+    source.write_text("int a() { return 2; }\n")
+    dirty = ArtifactCache.source_fingerprint(repo_dir)
+    assert dirty != clean
+    # edit a dirty file again
+    source.write_text("int a() { return 3; }\n")
+    assert ArtifactCache.source_fingerprint(repo_dir) not in [clean, dirty]
+
+    source.write_text("int a() { return 1; }\n")
+    assert ArtifactCache.source_fingerprint(repo_dir) == clean
+    (work_tree / "project" / "b.cpp").write_text("int b() { return 1; }\n")
+    assert ArtifactCache.source_fingerprint(repo_dir) != clean
+
+
+def test_skip_generated_of_sub_dir(work_tree):
+    repo_dir = str(work_tree / "project")
+    clean = ArtifactCache.source_fingerprint(repo_dir)
+    build_dir = work_tree / "project" / "build-host-Release"
+    build_dir.mkdir()
+    (build_dir / "a.o").write_text("object")
+    (work_tree / "project" / "compile_commands.json").write_text("[]")
+    os.symlink(build_dir, work_tree / "project" / "build")
+    assert ArtifactCache.source_fingerprint(repo_dir) == clean
+    # the generated names are only for the top level of repo_dir
+    nested = work_tree / "project" / "src" / "build"
+    nested.mkdir(parents=True)
+    (nested / "gen.cpp").write_text("int gen() { return 1; }\n")
+    assert ArtifactCache.source_fingerprint(repo_dir) != clean
+
+
+def test_skip_dirs(work_tree):
+    repo_dir = str(work_tree / "project")
+    clean = ArtifactCache.source_fingerprint(repo_dir)
+    out = work_tree / "project" / "out"
+    out.mkdir()
+    (out / "a.o").write_text("object")
+    assert ArtifactCache.source_fingerprint(repo_dir, [str(out)]) == clean
+    assert ArtifactCache.source_fingerprint(repo_dir) != clean
+
+
+def test_key_of_other_checkout(tmp_path):
+    keys = []
+    for name in ["checkout_a", "checkout_b"]:
+        repo = tmp_path / name
+        shutil.copytree(os.path.join(ROOT, "test_repo"), repo)
+        git(repo, "init", "-q")
+        git(repo, "add", "-A")
+        git(repo, "commit", "-q", "-m", "init")
+        config = BuildConfig(
+            repo_dir=str(repo),
+            build_dir=str(tmp_path / f"build_{name}"),
+            artifact_cache=True,
+            cmake_options=HOST_COMPILERS,
+        )
+        plan = Build().plan(config)
+        assert str(repo) in plan.cmake_cmd
+        keys.append(plan.artifact_cache_key)
+    assert keys[0] and keys[0] == keys[1]
+
+
+def test_store_restore_and_evict(tmp_path):
+    install = tmp_path / "install"
+    (install / "bin").mkdir(parents=True)
+    (install / "bin" / "app").write_text("app")
+    os.symlink("app", install / "bin" / "app_link")
+    cache = ArtifactCache(str(tmp_path / "cache"), 1 << 20, 30)
+    assert not cache.restore("key", str(tmp_path / "restored"))
+    cache.store("key", str(install), "host-Release")
+    restored = tmp_path / "restored"
+    assert cache.restore("key", str(restored))
+    assert (restored / "bin" / "app").read_text() == "app"
+    assert os.readlink(restored / "bin" / "app_link") == "app"
+    # replace the old install dir as a whole
+    (restored / "stale").write_text("stale")
+    assert cache.restore("key", str(restored))
+    assert sorted(os.listdir(restored)) == ["bin"]
+    assert sorted(os.listdir(tmp_path)) == ["cache", "install", "restored"]
+
+    # larger than max size, the least recently used one is evicted
+    with open(os.path.join(cache.entry_dir("key"), ArtifactCache.META_FILE)) as f:
+        size = json.load(f)["size"]
+    small = ArtifactCache(str(tmp_path / "cache"), size, 30)
+    small.store("key2", str(install), "host-Debug")
+    assert not os.path.exists(small.entry_dir("key"))
+    assert os.path.exists(small.entry_dir("key2"))
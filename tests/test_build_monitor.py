@@ -0,0 +1,45 @@
+import io
+import os
+import pty
+
+from cmake_one import BuildMonitor
+
+
+def test_ninja_restart_reset_done_work(tmp_path):
+    monitor = BuildMonitor("test", str(tmp_path), io.BytesIO())
+    monitor.history, monitor.mean = {"a.o": 4, "b.o": 6}, 5
+    monitor.finished = monitor.total = monitor.done_work = 0
+    monitor.failed = None
+    monitor.ninja_line("[1/10] Building CXX object a.o")
+    # the status of a started edge in smart terminal
+    monitor.ninja_line("[1/10] Building CXX object b.o")
+    assert monitor.done_work == 4
+    # ninja rerun cmake and restart the count
+    monitor.ninja_line("[1/3] Building CXX object b.o")
+    assert (monitor.finished, monitor.total, monitor.done_work) == (1, 3, 6)
+
+
+def test_run_phase_stderr_separate(tmp_path, capfd):
+    out = io.BytesIO()
+    monitor = BuildMonitor("test", str(tmp_path), out, merge_stderr=False)
+    script = "echo '[1/2] a.o'; echo '[2/2] b.o'; echo error >&2"
+    assert monitor.run_phase("build", script, dict(os.environ)) == 0
+    assert out.getvalue() == b"[1/2] a.o\n[2/2] b.o\n"
+    assert "error" in capfd.readouterr().err
+    assert (monitor.finished, monitor.total) == (2, 2)
+
+
+def test_run_phase_terminal(tmp_path):
+    master, slave = pty.openpty()
+    with os.fdopen(slave, "wb") as out:
+        monitor = BuildMonitor("test", str(tmp_path), out, merge_stderr=False)
+        script = (
+            '[ -t 1 ] && printf "\\r[1/2] a.o\\033[K\\r[2/2] b.o\\033[K"; echo; exit 3'
+        )
+        assert monitor.run_phase("build", script, dict(os.environ)) == 3
+    assert (monitor.finished, monitor.total) == (2, 2)
+    output = b""
+    while b"\n" not in output:
+        output += os.read(master, 1024)
+    os.close(master)
+    assert b"[2/2] b.o\x1b[K" in output
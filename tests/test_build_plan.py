@@ -0,0 +1,297 @@
+import concurrent.futures
+import json
+import os
+
+import pytest
+from conftest import HOST_COMPILERS, need_host_build
+
+from cmake_one import Build, BuildConfig, BuildPlan, IncrementalInstall, ProbeCache
+
+
+def test_build_config():
+    config = BuildConfig("cross_build", cross_build_target_os="LINUX")
+    assert config.cross_build_target_os == "LINUX"
+    assert config.build_type == "Release"
+    with pytest.raises(AssertionError):
+        BuildConfig("host_build", not_an_option=1)
+    with pytest.raises(AssertionError):
+        BuildConfig("matrix")
+
+
+def test_plan_not_change_config(repo_dir):
+    config = BuildConfig(repo_dir=repo_dir)
+    plan = Build().plan(config)
+    assert config.build_dir is None
+    assert plan.name == "host-Release"
+    assert plan.build_dir == os.path.join(repo_dir, "build-host-Release")
+    assert plan.install_dir == os.path.join(plan.build_dir, "install")
+
+
+def test_fingerprint(repo_dir):
+    build = Build()
+    fingerprint = build.plan(BuildConfig(repo_dir=repo_dir)).fingerprint
+    assert fingerprint == build.plan(BuildConfig(repo_dir=repo_dir)).fingerprint
+    debug = build.plan(BuildConfig(repo_dir=repo_dir, build_type="Debug"))
+    assert debug.fingerprint != fingerprint
+    # link jobs change with the targets built together, do not rerun cmake for it
+    pool = build.plan(BuildConfig(repo_dir=repo_dir, ninja_jobs=8, link_jobs=1))
+    other_pool = build.plan(BuildConfig(repo_dir=repo_dir, ninja_jobs=8, link_jobs=2))
+    assert pool.fingerprint == other_pool.fingerprint
+    assert pool.fingerprint != fingerprint
+
+
+def test_fingerprint_of_toolchain(tmp_path, monkeypatch):
+    build = Build()
+    toolchain = tmp_path / "a.toolchain.cmake"
+    toolchain.write_text("set(CMAKE_SYSTEM_NAME Linux)\n")
+    cmd = f"cmake -DCMAKE_TOOLCHAIN_FILE={toolchain}"
+    fingerprint = build.config_fingerprint([cmd], {})
+    assert fingerprint == build.config_fingerprint([cmd], {})
+    toolchain.write_text("set(CMAKE_SYSTEM_NAME Android)\n")
+    assert build.config_fingerprint([cmd], {}) != fingerprint
+    fingerprint = build.config_fingerprint([cmd], {})
+    monkeypatch.setenv("NDK_ROOT", str(tmp_path))
+    assert build.config_fingerprint([cmd], {}) != fingerprint
+    assert build.config_fingerprint([cmd], {"NDK_ROOT": "other"}) != fingerprint
+
+
+def test_watch_build_keep_plan_on_error(repo_dir, monkeypatch, caplog):
+    build = Build()
+    config = BuildConfig(repo_dir=repo_dir)
+    plan = build.plan(config)
+
+    def bad_plan(config):
+        raise AssertionError("error config: bad toolchain")
+
+    def bad_execute(plan):
+        raise OSError("no space left")
+
+    monkeypatch.setattr(build, "plan", bad_plan)
+    assert build.watch_build(plan, True, config) == (plan, False)
+    assert "bad toolchain" in caplog.text
+    monkeypatch.setattr(build, "execute", bad_execute)
+    assert build.watch_build(plan, True) == (plan, False)
+    assert "no space left" in caplog.text
+
+
+def test_phases_stats_after_ninja(repo_dir):
+    plan = BuildPlan(BuildConfig(repo_dir=repo_dir))
+    plan.ninja_cmd = "ninja install/strip"
+    plan.pre_build_cmds.append("ccache --zero-stats")
+    plan.post_ninja_cmds.append("ccache --show-stats")
+    plan.install_cmd = "install"
+    plan.post_build_cmds.append("ln -snf install repo/install")
+    phases = dict(plan.phases(configure=False))
+    assert phases["build"] == [
+        "ccache --zero-stats",
+        "ninja install/strip",
+        "ccache --show-stats",
+    ]
+    assert phases["install"] == ["install"]
+    assert "ccache" not in plan.ninja_sh()
+
+
+def test_need_configure(tmp_path):
+    plan = BuildPlan(BuildConfig(build_dir=str(tmp_path)))
+    plan.fingerprint = "abc"
+    assert plan.need_configure()
+    with open(plan.fingerprint_file, "w") as f:
+        f.write("abc\n")
+    # cmake never run in the build dir
+    assert plan.need_configure()
+    for name in ["CMakeCache.txt", "build.ninja"]:
+        (tmp_path / name).write_text("")
+    assert not plan.need_configure()
+    plan.fingerprint = "def"
+    assert plan.need_configure()
+    plan.config.not_call_rerun_cmake = True
+    assert not plan.need_configure()
+    plan.config.force_rerun_cmake = True
+    assert plan.need_configure()
+
+
+def test_plan_in_threads(repo_dir):
+    """each plan have its own state, even if planned by one Build in many threads"""
+    build = Build()
+    configs = []
+    for i in range(16):
+        unity = i % 2 == 0
+        configs.append(
+            BuildConfig(
+                repo_dir=repo_dir,
+                build_type="Debug" if unity else "Release",
+                build_dir=os.path.join(repo_dir, f"build-{i}"),
+                unity_build=unity,
+                unity_exclude_targets="api_module_obj" if unity else None,
+            )
+        )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        plans = list(pool.map(build.plan, configs))
+    for i, plan in enumerate(plans):
+        unity = i % 2 == 0
+        assert plan.build_dir == os.path.join(repo_dir, f"build-{i}")
+        assert ("-DCMAKE_BUILD_TYPE=Debug" in plan.cmake_cmd) == unity
+        assert ("api_module_obj" in plan.project_include) == unity
+        assert ("CMAKE_PROJECT_INCLUDE" in plan.cmake_cmd) == unity
+
+
+def write_probe_build_dir(build_dir, compiler):
+    platform_dir = build_dir / "CMakeFiles" / "3.25.1"
+    platform_dir.mkdir(parents=True)
+    (platform_dir / "CMakeSystem.cmake").write_text("set(CMAKE_SYSTEM_NAME Linux)\n")
+    (platform_dir / "CMakeCXXCompiler.cmake").write_text(
+        f'set(CMAKE_CXX_COMPILER "{compiler}")\n'
+    )
+    (build_dir / "CMakeCache.txt").write_text(
+        "\n".join(
+            [
+                "# comment",
+                "CMAKE_CXX_COMPILER:FILEPATH=" + str(compiler),
+                f"CMAKE_INSTALL_PREFIX:PATH={build_dir}/install",
+                "CMAKE_PLATFORM_INFO_INITIALIZED:INTERNAL=1",
+                "HAVE_UNISTD_H:INTERNAL=1",
+                f"HOME_OF_BUILD:INTERNAL={build_dir}",
+            ]
+        )
+        + "\n"
+    )
+
+
+def test_probe_cache(tmp_path):
+    compiler = tmp_path / "g++"
+    compiler.write_text("compiler v1")
+    build_dir = tmp_path / "build"
+    repo_dir = str(tmp_path / "repo")
+    write_probe_build_dir(build_dir, compiler)
+    cache = ProbeCache(str(tmp_path / "cache"))
+    new_dir = tmp_path / "new_build"
+    assert not cache.restore("key", str(new_dir), repo_dir)
+    cache.store("key", str(build_dir), repo_dir)
+
+    assert cache.restore("key", str(new_dir), repo_dir)
+    assert (new_dir / "CMakeFiles" / "3.25.1" / "CMakeCXXCompiler.cmake").is_file()
+    seeded = (new_dir / "CMakeCache.txt").read_text()
+    assert "CMAKE_PLATFORM_INFO_INITIALIZED:INTERNAL=1" in seeded
+    assert "HAVE_UNISTD_H:INTERNAL=1" in seeded
+    # paths of the build dir are not cached
+    assert "CMAKE_INSTALL_PREFIX" not in seeded
+    assert "HOME_OF_BUILD" not in seeded
+
+    # checks are of the project
+    other_dir = tmp_path / "other_build"
+    assert cache.restore("key", str(other_dir), str(tmp_path / "other_repo"))
+    assert "HAVE_UNISTD_H" not in (other_dir / "CMakeCache.txt").read_text()
+
+    compiler.write_text("compiler v2, a new size")
+    assert not cache.restore("key", str(tmp_path / "build3"), repo_dir)
+    assert not os.path.exists(os.path.join(cache.cache_dir, "key"))
+
+
+def test_strip_rules(tmp_path):
+    (tmp_path / "CMakeCache.txt").write_text("CMAKE_STRIP:FILEPATH=/opt/strip\n")
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "cmake_install.cmake").write_text("""
+if(CMAKE_INSTALL_COMPONENT STREQUAL "Unspecified" OR NOT CMAKE_INSTALL_COMPONENT)
+  foreach(file
+      "$ENV{DESTDIR}${CMAKE_INSTALL_PREFIX}/lib/libfoo.so.1.0.0"
+      "$ENV{DESTDIR}${CMAKE_INSTALL_PREFIX}/lib/libfoo.so.1"
+      )
+    if(EXISTS "${file}" AND
+       NOT IS_SYMLINK "${file}")
+      if(CMAKE_INSTALL_DO_STRIP)
+        execute_process(COMMAND "/usr/bin/strip" "${file}")
+      endif()
+    endif()
+  endforeach()
+endif()
+if(CMAKE_INSTALL_COMPONENT STREQUAL "Unspecified" OR NOT CMAKE_INSTALL_COMPONENT)
+  if(EXISTS "$ENV{DESTDIR}${CMAKE_INSTALL_PREFIX}/bin/app" AND
+     NOT IS_SYMLINK "$ENV{DESTDIR}${CMAKE_INSTALL_PREFIX}/bin/app")
+    if(CMAKE_INSTALL_DO_STRIP)
+      execute_process(COMMAND "${CMAKE_STRIP}" "$ENV{DESTDIR}${CMAKE_INSTALL_PREFIX}/bin/app")
+    endif()
+  endif()
+endif()
+""")
+    rules = IncrementalInstall(str(tmp_path), str(tmp_path / "install")).strip_rules()
+    assert rules == {
+        "lib/libfoo.so.1.0.0": ["/usr/bin/strip"],
+        "lib/libfoo.so.1": ["/usr/bin/strip"],
+        "bin/app": ["/opt/strip"],
+    }
+
+
+@need_host_build
+@pytest.mark.parametrize("install_mode", IncrementalInstall.MODES)
+def test_incremental_install(repo_dir, tmp_path, install_mode, caplog):
+    config = BuildConfig(
+        repo_dir=repo_dir,
+        incremental_install=True,
+        install_mode=install_mode,
+        not_do_link_build_and_install=True,
+        cmake_options=HOST_COMPILERS,
+    )
+    build = Build()
+    plan = build.plan(config)
+    assert plan.install_cmd
+    build.execute(plan, str(tmp_path / "build.log"))
+    app = os.path.join(plan.install_dir, "bin", "test_exe")
+    lib = os.path.join(plan.install_dir, "lib", "libapi_module_shared.so.1.0.0")
+    stage = os.path.join(plan.build_dir, IncrementalInstall.STAGE_DIR)
+    for path in [app, lib]:
+        assert os.path.isfile(path)
+        # stripped, the stage file keep the debug info
+        rel = os.path.relpath(path, plan.install_dir)
+        assert os.path.getsize(path) < os.path.getsize(os.path.join(stage, rel))
+    assert os.readlink(
+        os.path.join(plan.install_dir, "lib", "libapi_module_shared.so")
+    ) == ("libapi_module_shared.so.1")
+    assert os.path.isfile(os.path.join(plan.install_dir, "include", "api.h"))
+    with open(os.path.join(plan.build_dir, IncrementalInstall.MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    assert "bin/test_exe" in manifest
+
+    # nothing changed, nothing installed
+    caplog.clear()
+    install = IncrementalInstall(
+        plan.build_dir, plan.install_dir, strip=True, mode=install_mode
+    )
+    with caplog.at_level("INFO"):
+        install.run()
+    assert " 0 changed" in caplog.text
+
+    # a removed file is installed again
+    os.remove(app)
+    caplog.clear()
+    with caplog.at_level("INFO"):
+        install.run()
+    assert " 1 changed" in caplog.text
+    assert os.path.isfile(app)
+
+
+def test_install_qnx_license(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    source = tmp_path / "qnx710_license"
+    (source / "license").mkdir(parents=True)
+    (source / "license" / "licenses").write_text("710")
+    (source / "license" / "old").write_text("old")
+    Build().install_qnx_license(str(source))
+    dst = tmp_path / "home" / ".qnx"
+    assert (dst / "license" / "old").read_text() == "old"
+
+    source = tmp_path / "qnx800_license"
+    (source / "license").mkdir(parents=True)
+    (source / "license" / "licenses").write_text("800")
+    (source / "sdp").mkdir()
+    (source / "sdp" / "key").write_text("key")
+    (dst / "stale_dir").mkdir()
+    (dst / "stale_dir" / "file").write_text("stale")
+    Build().install_qnx_license(str(source))
+    files = sorted(
+        os.path.relpath(os.path.join(root, f), dst)
+        for root, _, names in os.walk(dst)
+        for f in names
+    )
+    assert files == ["license/licenses", "sdp/key"]
+    assert sorted(os.listdir(dst)) == ["license", "sdp"]
+    assert (dst / "license" / "licenses").read_text() == "800"
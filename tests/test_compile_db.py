@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+
+from cmake_one import CompileDatabase
+
+
+def write_db(build_dir, entries):
+    os.makedirs(build_dir, exist_ok=True)
+    with open(os.path.join(build_dir, CompileDatabase.FILE_NAME), "w") as f:
+        json.dump(entries, f, indent=4)
+
+
+def entry(directory, file, command="cc -c"):
+    return {"directory": directory, "command": f"{command} {file}", "file": file}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_iter_entries(tmp_path, monkeypatch, chunk_size):
+    entries = [entry("/build", f"/src/{i}.cpp", 'cc -DA="x, ]"') for i in range(20)]
+    write_db(tmp_path, entries)
+    monkeypatch.setattr(CompileDatabase, "CHUNK_SIZE", chunk_size)
+    path = os.path.join(tmp_path, CompileDatabase.FILE_NAME)
+    assert list(CompileDatabase().iter_entries(path)) == entries
+    write_db(tmp_path, [])
+    assert list(CompileDatabase().iter_entries(path)) == []
+
+
+def test_iter_truncated(tmp_path):
+    path = tmp_path / CompileDatabase.FILE_NAME
+    path.write_text('[{"directory": "/build", "file": "a.cpp"}, {"dire')
+    with pytest.raises(AssertionError, match="truncated"):
+        list(CompileDatabase().iter_entries(str(path)))
+
+
+def test_merge(tmp_path, caplog):
+    write_db(tmp_path / "a", [entry("/build-a", "/src/a.cpp")])
+    write_db(
+        tmp_path / "b",
+        [entry("/build-b", "/src/a.cpp", "other"), entry("/build-b", "/src/b.cpp")],
+    )
+    output = str(tmp_path / CompileDatabase.FILE_NAME)
+    db = CompileDatabase({"/src": "/host/src"})
+    # a build dir to merge is not configured yet
+    dirs = [str(tmp_path / "a"), str(tmp_path / "not_built"), str(tmp_path / "b")]
+    assert db.write(dirs, output)
+    assert "not_built" in caplog.text
+    with open(output) as f:
+        merged = json.load(f)
+    assert merged == [
+        entry("/build-a", "/host/src/a.cpp"),
+        entry("/build-b", "/host/src/b.cpp"),
+    ]
+    mtime = os.stat(output).st_mtime_ns
+    assert not db.write(dirs, output)
+    assert os.stat(output).st_mtime_ns == mtime
+
+
+def test_remap_longest_first():
+    db = CompileDatabase({"/a": "/x", "/a/b": "/y"})
+    assert db.remap(["/a/b/c", "/a/c"]) == ["/y/c", "/x/c"]
+    assert db.remap(1) == 1
@@ -0,0 +1,137 @@
+import os
+import shutil
+import socket
+import sys
+
+import pytest
+
+from cmake_one import DistCompiler, DistWorker
+
+TOKEN = "test-token"
+
+
+@pytest.fixture
+def gcc():
+    path = shutil.which("gcc")
+    if path is None:
+        pytest.skip("need gcc")
+    return path
+
+
+def compile_header(compiler, args, ext=".i"):
+    return {
+        "type": "compile",
+        "token": TOKEN,
+        "compiler": compiler,
+        "compiler_id": DistCompiler.compiler_id(compiler),
+        "args": args,
+        "ext": ext,
+        "cwd": os.getcwd(),
+        "env": {k: os.environ[k] for k in DistCompiler.FORWARD_ENVS if k in os.environ},
+    }
+
+
+def test_worker_need_token_and_compilers(gcc):
+    with pytest.raises(AssertionError):
+        DistWorker(1, "", [gcc])
+    with pytest.raises(AssertionError):
+        DistWorker(1, TOKEN, [])
+    with pytest.raises(AssertionError):
+        DistWorker(1, TOKEN, ["gcc"])
+
+
+def test_worker_compile(gcc):
+    worker = DistWorker(1, TOKEN, [gcc])
+    resp, obj = worker.compile(
+        compile_header(gcc, ["-O2", "-g", "-fPIC"]), b"int f(void) { return 1; }\n"
+    )
+    assert resp["status"] == "ok", resp
+    assert resp["returncode"] == 0
+    assert obj.startswith(b"\x7fELF")
+
+
+def test_worker_refuse_compilers(gcc):
+    worker = DistWorker(1, TOKEN, [gcc])
+    # any absolute executable is not allowed, like an interpreter
+    header = compile_header(sys.executable, ["-O2"])
+    resp, obj = worker.compile(header, b"")
+    assert resp["status"] == "error"
+    assert "not allowed" in resp["error"]
+    assert obj == b""
+    header = compile_header(gcc, ["-O2"])
+    header["compiler_id"] = "0" * 64
+    assert worker.compile(header, b"")[0]["status"] == "error"
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["-c", "-o", "/tmp/x.o"],
+        ["-MD", "-MF", "/tmp/x.d"],
+        ["-fprofile-generate=/tmp/profile"],
+        ["-fprofile-instr-generate"],
+        ["-Wl,-o,/tmp/x"],
+        ["-Wp,-MD,/tmp/x.d"],
+        ["-Xclang", "-load"],
+        ["-mllvm", "-info-output-file=/tmp/x"],
+        ["-fplugin=/tmp/x.so"],
+        ["-fsave-optimization-record"],
+        ["-fcrash-diagnostics-dir=/tmp"],
+        ["-B/tmp"],
+        ["-specs=/tmp/x.specs"],
+        ["@/tmp/args"],
+        ["/etc/passwd"],
+        ["-fsome-new-flag=/tmp/x"],
+        ["-target"],
+    ],
+)
+def test_refuse_args(gcc, args):
+    assert not DistCompiler.remote_args_allowed(args)
+    worker = DistWorker(1, TOKEN, [gcc])
+    resp, _ = worker.compile(compile_header(gcc, args), b"")
+    assert resp["status"] == "error"
+
+
+def test_allow_codegen_args():
+    assert DistCompiler.remote_args_allowed(
+        [
+            "-O2",
+            "-g1",
+            "-fPIC",
+            "-fno-exceptions",
+            "-fvisibility=hidden",
+            "-fsanitize=address",
+            "-std=c++17",
+            "-march=armv8.2-a",
+            "-Wall",
+            "-Werror=return-type",
+            "-pthread",
+            "-target",
+            "aarch64-linux-android23",
+        ]
+    )
+
+
+def test_client_compile_locally_for_not_allowed_args(tmp_path):
+    source = tmp_path / "a.c"
+    source.write_text("int f(void) { return 1; }\n")
+    dist = DistCompiler()
+    args = ["-O2", "-c", str(source), "-o", str(tmp_path / "a.o")]
+    assert dist.remote_job(args) == ("C", str(source), str(tmp_path / "a.o"), ["-O2"])
+    # ninja depfile flags are done by the local preprocess
+    assert dist.remote_job(["-MD", "-MF", "a.d", "-DA=1", "-Iinc", *args])
+    assert dist.remote_job(["-fprofile-use=a.profdata", *args]) is None
+    assert dist.remote_job(["-Wa,-adhln", *args]) is None
+
+
+def test_worker_refuse_bad_token(gcc):
+    worker = DistWorker(1, TOKEN, [gcc])
+    client, server = socket.socketpair()
+    with client, server:
+        header = compile_header(gcc, ["-O2"])
+        header["token"] = ""
+        DistCompiler.send_msg(client, header, b"int a;\n")
+        worker.handle(server)
+        resp, obj = DistCompiler.recv_msg(client)
+    assert resp == {"status": "error", "error": "bad token"}
+    assert obj == b""
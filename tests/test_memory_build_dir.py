@@ -0,0 +1,112 @@
+import collections
+import os
+import shutil
+import time
+
+import pytest
+from conftest import HOST_COMPILERS, need_host_build
+
+from cmake_one import Build, BuildConfig, MemoryBuildDir
+
+DiskUsage = collections.namedtuple("DiskUsage", ["total", "used", "free"])
+
+
+@pytest.fixture
+def memory(tmp_path):
+    persistent_dir = tmp_path / "build"
+    persistent_dir.mkdir()
+    memory_dir = tmp_path / "shm"
+    memory_dir.mkdir()
+    build_dir = MemoryBuildDir.memory_build_dir(str(persistent_dir), str(memory_dir))
+    os.makedirs(build_dir)
+    return MemoryBuildDir(str(persistent_dir), build_dir)
+
+
+def test_sync(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "sub" / "a.o").write_text("a")
+    os.symlink("a.o", src / "sub" / "link")
+    dst = tmp_path / "dst"
+    (dst / "old").mkdir(parents=True)
+    assert MemoryBuildDir.sync(str(src), str(dst)) == (2, 1)
+    assert (dst / "sub" / "a.o").read_text() == "a"
+    assert os.readlink(dst / "sub" / "link") == "a.o"
+    assert not (dst / "old").exists()
+    # not changed by size and mtime
+    assert MemoryBuildDir.sync(str(src), str(dst)) == (0, 0)
+
+
+def test_check_space(memory, monkeypatch):
+    install_dir = os.path.join(memory.persistent_dir, "install")
+    os.makedirs(install_dir)
+    with open(os.path.join(install_dir, "app"), "wb") as f:
+        f.write(b"0" * 4096)
+    # the install dir is not in memory
+    monkeypatch.setattr(shutil, "disk_usage", lambda p: DiskUsage(0, 0, 1024))
+    memory.check_space(install_dir)
+
+    # a former build on disk
+    with open(os.path.join(memory.persistent_dir, "a.o"), "wb") as f:
+        f.write(b"0" * 4096)
+    with pytest.raises(AssertionError, match="only have"):
+        memory.check_space(install_dir)
+    # the build dir in memory is reused
+    with open(os.path.join(memory.build_dir, "a.o"), "wb") as f:
+        f.write(b"0" * 4096)
+    memory.check_space(install_dir)
+
+
+def test_restore_stale_snapshot(memory, caplog):
+    with open(os.path.join(memory.build_dir, "CMakeCache.txt"), "w") as f:
+        f.write("cache")
+    memory.mark_build()
+    memory.snapshot()
+    shutil.rmtree(memory.build_dir)
+    assert memory.restore()
+    assert "older than the last build" not in caplog.text
+
+    # built again without --memory_snapshot
+    future = time.time() + 10
+    memory.mark_build()
+    os.utime(memory.last_build_file, (future, future))
+    shutil.rmtree(memory.build_dir)
+    assert memory.restore()
+    assert "older than the last build" in caplog.text
+    with open(os.path.join(memory.build_dir, "CMakeCache.txt")) as f:
+        assert f.read() == "cache"
+    # not restored when the build dir in memory exists
+    assert not memory.restore()
+
+
+@need_host_build
+def test_build_in_memory(repo_dir, tmp_path, caplog):
+    memory_dir = tmp_path / "shm"
+    memory_dir.mkdir()
+    config = BuildConfig(
+        repo_dir=repo_dir,
+        build_in_memory=True,
+        memory_dir=str(memory_dir),
+        memory_snapshot=True,
+        not_do_link_build_and_install=True,
+        cmake_options=HOST_COMPILERS,
+    )
+    build = Build()
+    plan = build.plan(config)
+    persistent_dir = os.path.join(repo_dir, "build-host-Release")
+    assert plan.persistent_build_dir == persistent_dir
+    assert plan.build_dir.startswith(str(memory_dir))
+    build.execute(plan, str(tmp_path / "build.log"))
+    assert os.path.isfile(os.path.join(persistent_dir, "install", "bin", "test_exe"))
+    assert os.path.isfile(os.path.join(persistent_dir, "compile_commands.json"))
+
+    # lost after reboot
+    shutil.rmtree(plan.build_dir)
+    with caplog.at_level("INFO"):
+        build.execute(build.plan(config), str(tmp_path / "build2.log"))
+    assert "restore memory build dir" in caplog.text
+    with open(tmp_path / "build2.log") as f:
+        log = f.read()
+    # incremental build: cmake and compiles are not run again
+    assert "-- Configuring done" not in log
+    assert "Building CXX object" not in log
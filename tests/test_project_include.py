@@ -0,0 +1,80 @@
+import json
+import os
+
+from conftest import HOST_COMPILERS, need_host_build
+
+from cmake_one import Build, BuildConfig, BuildPlan, PrecompiledHeader
+
+
+def test_one_include_guard(tmp_path):
+    plan = BuildPlan(BuildConfig(build_dir=str(tmp_path)))
+    plan.project_include = "message(STATUS a)\nmessage(STATUS b)\n"
+    plan.write_project_include()
+    with open(plan.project_include_file, "r") as f:
+        lines = f.read().splitlines()
+    assert lines.count("include_guard(GLOBAL)") == 1
+    assert lines.index("include_guard(GLOBAL)") < lines.index("message(STATUS a)")
+
+
+def test_no_include_file_if_not_needed(tmp_path):
+    plan = BuildPlan(BuildConfig(build_dir=str(tmp_path)))
+    plan.write_project_include()
+    assert not os.path.exists(plan.project_include_file)
+
+
+@need_host_build
+def test_link_pool_unity_exclude_and_pch(repo_dir, tmp_path):
+    """all blocks of project include run when they are used together"""
+    config = BuildConfig(
+        repo_dir=repo_dir,
+        ninja_jobs=4,
+        link_jobs=1,
+        unity_build=True,
+        unity_exclude_targets="api_module_obj",
+        pch=True,
+        not_do_link_build_and_install=True,
+        cmake_options=HOST_COMPILERS,
+    )
+    build = Build()
+    plan = build.plan(config)
+    build.execute(plan, str(tmp_path / "build.log"))
+
+    with open(os.path.join(plan.build_dir, "build.ninja"), "r") as f:
+        build_ninja = f.read()
+    assert "pool = cmake_one_link" in build_ninja
+    # the pch file is included, so cmake rerun when it changed
+    assert PrecompiledHeader.CMAKE_FILE in build_ninja
+    with open(os.path.join(plan.build_dir, "compile_commands.json"), "r") as f:
+        files = [e["file"] for e in json.load(f)]
+    unity = [f for f in files if os.path.basename(os.path.dirname(f)) == "Unity"]
+    assert unity
+    assert not [f for f in unity if "api_module_obj.dir" in f]
+    assert os.path.join(repo_dir, "api_module", "src", "api.cpp") in files
+
+
+@need_host_build
+def test_unity_exclude_and_pch(repo_dir, tmp_path):
+    """without link pool, the pch block still run after the unity exclude block"""
+    config = BuildConfig(
+        repo_dir=repo_dir,
+        ninja_jobs=1,
+        link_jobs=1,
+        unity_build=True,
+        unity_exclude_targets="api_module_obj",
+        pch=True,
+        not_do_link_build_and_install=True,
+        cmake_options=HOST_COMPILERS,
+    )
+    build = Build()
+    plan = build.plan(config)
+    assert Build.LINK_JOB_POOL not in plan.project_include
+    build.execute(plan, str(tmp_path / "build.log"))
+    with open(os.path.join(plan.build_dir, "build.ninja"), "r") as f:
+        assert PrecompiledHeader.CMAKE_FILE in f.read()
+
+
+def test_pch_validate_is_best_effort(tmp_path, caplog):
+    pch = PrecompiledHeader(str(tmp_path), str(tmp_path))
+    # no ninja and no compile database
+    assert pch.validate(ninja=str(tmp_path / "not_exist_ninja")) == ([], [])
+    assert "skip check" in caplog.text
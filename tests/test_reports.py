@@ -0,0 +1,51 @@
+import json
+import os
+
+from conftest import HOST_COMPILERS, need_host_build
+
+from cmake_one import Build, BuildConfig, CompileDatabase
+
+
+def test_unity_build_summary(tmp_path):
+    unity_dir = tmp_path / "CMakeFiles" / "lib.dir" / "Unity"
+    unity_dir.mkdir(parents=True)
+    (unity_dir / "unity_0_cxx.cxx").write_text(
+        '#include "/src/a.cpp"\n\n#include "/src/b.cpp"\n\n#include "/src/c.cpp"\n'
+    )
+    entries = [
+        {
+            "directory": str(tmp_path),
+            "file": str(unity_dir / "unity_0_cxx.cxx"),
+            "command": "c++ -c",
+        },
+        {"directory": str(tmp_path), "file": "/src/d.cpp", "command": "c++ -c"},
+    ]
+    with open(tmp_path / CompileDatabase.FILE_NAME, "w") as f:
+        json.dump(entries, f)
+    assert Build().unity_build_summary(str(tmp_path)) == (3, 1, 1)
+
+
+def test_post_build_report_not_raise(tmp_path, caplog):
+    build = Build()
+    build.post_build_report(build.unity_build_summary, str(tmp_path))
+    assert "unity_build_summary" in caplog.text
+    assert "can not find compile database" in caplog.text
+
+
+@need_host_build
+def test_reports_not_fail_build(repo_dir, tmp_path, caplog):
+    config = BuildConfig(
+        repo_dir=repo_dir,
+        unity_build=True,
+        build_report=True,
+        not_do_link_build_and_install=True,
+        cmake_options=HOST_COMPILERS,
+    )
+    build = Build()
+    plan = build.plan(config)
+    build.execute(plan, str(tmp_path / "build.log"))
+    assert os.path.isfile(os.path.join(plan.build_dir, Build.BUILD_REPORT_FILE))
+    # lost compile database, a succeeded build still succeeds
+    os.remove(os.path.join(plan.build_dir, CompileDatabase.FILE_NAME))
+    build.execute(build.plan(config), str(tmp_path / "build2.log"))
+    assert "unity_build_summary" in caplog.text
@@ -0,0 +1,29 @@
+import os
+
+from cmake_one import Trash
+
+
+def test_clean_entry_added_after_last_scan(tmp_path, monkeypatch):
+    trash = Trash(1 << 30)
+    src = tmp_path / "build"
+    src.mkdir()
+    trash.remove(str(src))
+    trash_dir = Trash.trash_dir_of(str(src))
+    entries = Trash.entries
+    added = []
+
+    def racing_entries(trash_dir):
+        result = entries(trash_dir)
+        # other run move an entry in after the final scan, and can not lock to clean it
+        if not result and not added:
+            added.append(True)
+            (tmp_path / "build").mkdir()
+            trash.remove(str(tmp_path / "build"))
+            with trash.lock(trash_dir, False) as locked:
+                assert not locked
+        return result
+
+    monkeypatch.setattr(Trash, "entries", staticmethod(racing_entries))
+    trash.clean(trash_dir)
+    assert added
+    assert os.listdir(trash_dir) == [Trash.LOCK_FILE]